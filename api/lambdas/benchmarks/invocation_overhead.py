@@ -0,0 +1,144 @@
+"""
+Per-invocation overhead of the onboarding Lambda handlers, with AWS replaced by botocore Stubber.
+
+Cold: a fresh interpreter imports the handler (creating its module-level client) and serves
+one invocation, the way a new execution environment does. Warm: repeated invocations of an
+imported handler, compared with building the boto3 client inside every invocation as the
+handlers used to.
+
+Usage (from api/lambdas):
+    python benchmarks/invocation_overhead.py --invocations 200
+"""
+import argparse
+import contextlib
+import importlib
+import io
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+import boto3
+from botocore.stub import Stubber
+
+for name, value in {
+    "AWS_DEFAULT_REGION": "us-east-1",
+    "AWS_ACCESS_KEY_ID": "benchmark",
+    "AWS_SECRET_ACCESS_KEY": "benchmark",
+    "tableName": "benchmark-customers",
+    "bucketName": "benchmark-ids",
+}.items():
+    os.environ.setdefault(name, value)
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from onboarding import get_account, verify_id
+
+GET_ITEM_RESPONSE = {"Item": {"email": {"S": "jane@example.com"}}}
+ANALYZE_ID_RESPONSE = {
+    "IdentityDocuments": [{
+        "IdentityDocumentFields": [
+            {"Type": {"Text": "FIRST_NAME"}, "ValueDetection": {"Text": "JANE"}},
+            {"Type": {"Text": "LAST_NAME"}, "ValueDetection": {"Text": "DOE"}},
+        ]
+    }]
+}
+
+# handler module, its client attribute, the stubbed operation and response, and an event
+HANDLERS = {
+    "get-account": ("dynamodb_client", "get_item", GET_ITEM_RESPONSE, {"email": "jane@example.com"}),
+    "verify-id": ("textract_client", "analyze_id", ANALYZE_ID_RESPONSE, {
+        "file_name": "passport.png",
+        "required_field_values": {"FIRST_NAME": "Jane", "LAST_NAME": "Doe"},
+    }),
+}
+
+
+def stubbed(client, operation, response, count):
+    stubber = Stubber(client)
+    for _ in range(count):
+        stubber.add_response(operation, response)
+    stubber.activate()
+    return stubber
+
+
+def cold_child(handler_name):
+    """Runs in a fresh interpreter: import the handler and serve its first invocation."""
+    start = time.perf_counter()
+    handler = importlib.import_module(handler_name)
+    client_attr, operation, response, event = HANDLERS[handler_name]
+    stubbed(getattr(handler, client_attr), operation, response, 1)
+    handler.main(event, None)
+    print(time.perf_counter() - start)
+
+
+def measure_cold(handler_name, runs):
+    timings = []
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--cold-child", handler_name],
+            check=True, capture_output=True, text=True,
+        ).stdout
+        timings.append(float(output.strip().splitlines()[-1]))
+    return timings
+
+
+def measure_warm(handler_name, invocations):
+    handler = importlib.import_module(handler_name)
+    client_attr, operation, response, event = HANDLERS[handler_name]
+    stubbed(getattr(handler, client_attr), operation, response, invocations)
+    timings = []
+    # the handlers' timing records go to stdout, as they would to CloudWatch Logs
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(invocations):
+            start = time.perf_counter()
+            handler.main(event, None)
+            timings.append(time.perf_counter() - start)
+    return timings
+
+
+def measure_client_per_call(handler_name, invocations):
+    """The handlers' previous behaviour: a new boto3 client built inside every invocation."""
+    service = {"get-account": "dynamodb", "verify-id": "textract"}[handler_name]
+    _, operation, response, event = HANDLERS[handler_name]
+    timings = []
+    for _ in range(invocations):
+        start = time.perf_counter()
+        client = boto3.client(service)
+        stubbed(client, operation, response, 1)
+        if handler_name == "get-account":
+            get_account(client, os.environ["tableName"], event["email"])
+        else:
+            verify_id(client, os.environ["bucketName"], event["file_name"], event["required_field_values"])
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def report(label, timings):
+    ordered = sorted(timings)
+    p95 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+    print("  {:<22} mean {:8.2f} ms   p50 {:8.2f} ms   p95 {:8.2f} ms".format(
+        label, statistics.mean(timings) * 1000, statistics.median(timings) * 1000, p95 * 1000))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--invocations", type=int, default=200)
+    parser.add_argument("--cold-runs", type=int, default=5)
+    parser.add_argument("--cold-child")
+    args = parser.parse_args()
+
+    if args.cold_child:
+        cold_child(args.cold_child)
+        return
+
+    for handler_name in HANDLERS:
+        print(handler_name)
+        report("cold start", measure_cold(handler_name, args.cold_runs))
+        report("warm, client per call", measure_client_per_call(handler_name, args.invocations))
+        report("warm, shared client", measure_warm(handler_name, args.invocations))
+
+
+if __name__ == "__main__":
+    main()
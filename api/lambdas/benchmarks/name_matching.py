@@ -0,0 +1,100 @@
+"""
+ID verification accuracy and extraction cost over a fixture corpus of Textract AnalyzeID responses.
+
+Each fixture pairs an AnalyzeID response with the names a user typed and whether they are the
+same person. A rejected genuine user has to upload again (another Textract call and another
+LLM turn), so the benchmark reports false rejects, i.e. retries, next to false accepts for the
+previous exact matcher and the normalising matcher at a few thresholds.
+
+Usage (from api/lambdas):
+    python benchmarks/name_matching.py
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from onboarding.identity import NAME_MATCH_THRESHOLD, compare_fields, extract_fields
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "analyze_id_responses.json")
+VERIFIED = "Document has been verified"
+
+
+def previous_extract(response):
+    """verify-id's previous extraction: two passes over every field's keys, values only."""
+    id_field_values = {}
+    for doc_fields in response['IdentityDocuments']:
+        for id_field in doc_fields['IdentityDocumentFields']:
+            curr_type = ""
+            curr_val = ""
+            for key, val in id_field.items():
+                if "Type" in str(key):
+                    curr_type = str(val['Text'])
+            for key, val in id_field.items():
+                if "ValueDetection" in str(key):
+                    curr_val = str(val['Text'])
+            id_field_values[curr_type] = curr_val
+    return id_field_values
+
+
+def previous_compare(id_field_values, required_field_values):
+    # the tool used to strip spaces from the names before sending them
+    for key, val in required_field_values.items():
+        val = val.replace(" ", "")
+        if not ((key in id_field_values) and (val.lower() == id_field_values[key].lower())):
+            return "The details you provided for " + key + " do not match your ID"
+    return VERIFIED
+
+
+def accuracy(corpus, verify):
+    false_rejects, false_accepts = [], []
+    for case in corpus:
+        verified = verify(case) == VERIFIED
+        if case["same_person"] and not verified:
+            false_rejects.append(case["case"])
+        elif not case["same_person"] and verified:
+            false_accepts.append(case["case"])
+    return false_rejects, false_accepts
+
+
+def timed(fn, corpus, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for case in corpus:
+            fn(case["response"])
+    return (time.perf_counter() - start) / (repeat * len(corpus)) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=2000)
+    args = parser.parse_args()
+
+    with open(FIXTURES, encoding="utf-8") as f:
+        corpus = json.load(f)
+    genuine = sum(case["same_person"] for case in corpus)
+    print("{} fixtures, {} genuine users".format(len(corpus), genuine))
+
+    matchers = [("exact (previous)", lambda case: previous_compare(previous_extract(case["response"]), case["required_field_values"]))]
+    for threshold in (0.75, NAME_MATCH_THRESHOLD, 0.95):
+        matchers.append(("normalised @ {:.2f}".format(threshold), lambda case, threshold=threshold: compare_fields(
+            extract_fields(case["response"]), case["required_field_values"], threshold)))
+
+    for label, verify in matchers:
+        false_rejects, false_accepts = accuracy(corpus, verify)
+        print("  {:<18} retries {:>2}/{}   false accepts {:>2}/{}".format(
+            label, len(false_rejects), genuine, len(false_accepts), len(corpus) - genuine))
+        for name in false_rejects:
+            print("      retry: " + name)
+        for name in false_accepts:
+            print("      FALSE ACCEPT: " + name)
+
+    print("extraction per response: previous {:.1f} us, single pass {:.1f} us".format(
+        timed(previous_extract, corpus, args.repeat), timed(extract_fields, corpus, args.repeat)))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,41 +1,13 @@
-import boto3
-import json
 import os
 
-def main(event, context):
-    statusCode = 200 
-    isBase64Encoded = True
-    headers = {
-        "Content-Type": "application/json",
-        "Access-Control-Allow-Headers" : "Content-Type",
-        "Access-Control-Allow-Origin": "*",
-        "Access-Control-Allow-Methods": "GET"
-    }
-
-    try:
-        dynamodb_client = boto3.client('dynamodb')
+from onboarding import get_account, instrumented, lambda_response
+from onboarding.clients import get_client
 
-        get_response = dynamodb_client.get_item(
-            TableName=os.environ['tableName'],
-            Key = {
-                'email': {'S': event["email"]},
-            }
-        )
+# created during the init phase and reused by every warm invocation
+dynamodb_client = get_client('dynamodb')
 
-        if "Item" in get_response:
-            body = "Account with given email already exists"
-        else:
-            body = "Account with given email does not exist. Proceed with account opening."
-    
-    except Exception as e:
-        statusCode = 500
-        body += str(e)
 
-    finally:
-        response = {
-            "isBase64Encoded": isBase64Encoded,
-            "statusCode": statusCode,
-            "body": body,
-            "headers": headers
-        }
-        return response
+@instrumented('get-account')
+def main(event, context):
+    outcome = get_account(dynamodb_client, os.environ['tableName'], event["email"])
+    return lambda_response(outcome, "GET")
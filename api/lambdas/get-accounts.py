@@ -0,0 +1,13 @@
+import os
+
+from onboarding import get_accounts, instrumented, lambda_response
+from onboarding.clients import get_client
+
+# created during the init phase and reused by every warm invocation
+dynamodb_client = get_client('dynamodb')
+
+
+@instrumented('get-accounts')
+def main(event, context):
+    outcome = get_accounts(dynamodb_client, os.environ['tableName'], event["emails"])
+    return lambda_response(outcome, "POST")
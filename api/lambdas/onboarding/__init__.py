@@ -0,0 +1,28 @@
+"""
+Onboarding operations behind the AnyBank API: account lookup and creation, ID document
+and selfie verification, the queued welcome email, and the handlers' timing records.
+
+The AWS clients are passed in, so the same code runs in the Lambda functions and, with
+`toolBackend=local`, directly inside the LLM service. Face verification lives in
+`onboarding.faces` and is imported on its own, as it needs Pillow.
+"""
+from onboarding.accounts import create_account, get_account, get_accounts, idempotency_token
+from onboarding.identity import (
+    IdField,
+    compare_fields,
+    extract_fields,
+    extract_text,
+    name_similarity,
+    normalize_name,
+    verify_id,
+)
+from onboarding.notifications import (
+    DynamoDBSentLog,
+    LocalQueue,
+    MemorySentLog,
+    SqsQueue,
+    send_welcome_emails,
+    welcome_email_event,
+)
+from onboarding.responses import lambda_response, result
+from onboarding.telemetry import instrumented
@@ -0,0 +1,111 @@
+import hashlib
+import time
+
+from botocore.exceptions import ClientError
+
+from onboarding.notifications import welcome_email_event
+from onboarding.responses import result
+
+ACCOUNT_FIELDS = ('email', 'account_type', 'first_name', 'last_name', 'id_file_name', 'selfie_file_name')
+
+# BatchGetItem reads at most 100 keys per request
+BATCH_GET_LIMIT = 100
+BATCH_GET_RETRIES = 5
+
+
+def get_account(dynamodb_client, table_name, email):
+    """Check whether an account already exists for `email`."""
+    try:
+        get_response = dynamodb_client.get_item(
+            TableName=table_name,
+            Key = {
+                'email': {'S': email},
+            },
+            ProjectionExpression='email',
+        )
+    except Exception as e:
+        return result(500, str(e))
+
+    if "Item" in get_response:
+        return result(200, "Account with given email already exists")
+    return result(200, "Account with given email does not exist. Proceed with account opening.")
+
+
+def get_accounts(dynamodb_client, table_name, emails):
+    """
+    Check many emails at once with BatchGetItem; the body maps each email to whether an
+    account exists for it. Keys DynamoDB leaves unprocessed are retried with backoff.
+    """
+    emails = list(dict.fromkeys(email.lower() for email in emails))
+    existing = set()
+    try:
+        for start in range(0, len(emails), BATCH_GET_LIMIT):
+            request = {table_name: {
+                'Keys': [{'email': {'S': email}} for email in emails[start:start + BATCH_GET_LIMIT]],
+                'ProjectionExpression': 'email',
+            }}
+            for attempt in range(BATCH_GET_RETRIES):
+                response = dynamodb_client.batch_get_item(RequestItems=request)
+                existing.update(item['email']['S'] for item in response['Responses'].get(table_name, []))
+                request = response.get('UnprocessedKeys')
+                if not request:
+                    break
+                time.sleep(0.05 * 2 ** attempt)
+            else:
+                return result(500, "Lookup throttled, try again with fewer emails")
+    except Exception as e:
+        return result(500, str(e))
+
+    return result(200, {email: email in existing for email in emails})
+
+
+def idempotency_token(account):
+    """Token identifying one account opening; a retried SaveData with the same details carries the same token."""
+    return account.get('idempotency_token') or hashlib.sha256(
+        '\n'.join(str(account[field]) for field in ACCOUNT_FIELDS).encode()
+    ).hexdigest()
+
+
+def create_account(dynamodb_client, welcome_queue, table_name, account):
+    """
+    Save a new account and queue its welcome email.
+
+    The write only succeeds if no account exists for the email. A retry of the same opening
+    (same idempotency token) reports success without writing again; any other existing
+    account is a 409. The email is sent asynchronously by the send-welcome-email function,
+    so SES latency and failures do not affect account creation. If the email cannot be
+    queued the answer is a 503 even though the account was saved: the caller retries with
+    the same token, and the replay queues the email again.
+    """
+    account = dict(account, email=account['email'].lower())
+    token = idempotency_token(account)
+    try:
+        dynamodb_client.put_item(
+            TableName=table_name,
+            Item = {
+                'email': {'S': account['email']},
+                'account_type': {'S': account['account_type']},
+                'first_name': {'S': account['first_name']},
+                'last_name': {'S': account['last_name']},
+                'id_file_name': {'S': account['id_file_name']},
+                'selfie_file_name': {'S': account['selfie_file_name']},
+                'idempotency_token': {'S': token},
+            },
+            ConditionExpression='attribute_not_exists(email)',
+            ReturnValuesOnConditionCheckFailure='ALL_OLD',
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            return result(500, str(e))
+        if e.response.get('Item', {}).get('idempotency_token', {}).get('S') != token:
+            return result(409, "Account with given email already exists")
+        # replay of an opening that was already saved; fall through so a lost welcome email is queued again
+    except Exception as e:
+        return result(500, str(e))
+
+    try:
+        welcome_queue.enqueue(welcome_email_event(account))
+    except Exception as e:
+        print("Could not queue welcome email: " + str(e))
+        return result(503, "Account saved but the welcome email could not be queued. Retry the request")
+    return result(200, "New account created successfully. Welcome email on its way")
@@ -0,0 +1,23 @@
+import boto3
+from botocore.config import Config
+
+# Lambda runs one invocation at a time per execution environment, so a small pool is enough;
+# keep-alive lets warm invocations reuse the TLS connection opened by the first one
+CLIENT_CONFIG = Config(
+    connect_timeout=2,
+    read_timeout=10,
+    max_pool_connections=4,
+    tcp_keepalive=True,
+    retries={"max_attempts": 3, "mode": "standard"},
+)
+
+_clients = {}
+
+
+def get_client(service_name):
+    """Return the boto3 client for `service_name`, created once per execution environment."""
+    client = _clients.get(service_name)
+    if client is None:
+        client = boto3.client(service_name=service_name, config=CLIENT_CONFIG)
+        _clients[service_name] = client
+    return client
@@ -0,0 +1,113 @@
+import io
+import threading
+from collections import OrderedDict
+
+from PIL import Image, ImageOps
+
+from onboarding.responses import result
+
+FACE_SIMILARITY_THRESHOLD = 95
+# space kept around the detected face, as a fraction of its size, so Rekognition finds it again
+CROP_MARGIN = 0.3
+
+
+class IdFaceCache:
+    """
+    Cropped face of each identity document, detected once and reused by every selfie retry.
+
+    Entries are keyed by S3 object key and ETag, so a replaced object is detected again.
+    Documents without a face are cached too (as None).
+    """
+
+    def __init__(self, rekognition_client, s3_client, max_entries=64):
+        self.rekognition_client = rekognition_client
+        self.s3_client = s3_client
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._crops = OrderedDict()
+        self._lock = threading.Lock()
+
+    def id_face(self, bucket, id_file_name):
+        """JPEG bytes of the largest face on the document, or None if it has no face."""
+        etag = self.s3_client.head_object(Bucket=bucket, Key=id_file_name)['ETag']
+        key = (bucket, id_file_name, etag)
+        with self._lock:
+            if key in self._crops:
+                self._crops.move_to_end(key)
+                self.hits += 1
+                return self._crops[key]
+            self.misses += 1
+
+        image = self.s3_client.get_object(Bucket=bucket, Key=id_file_name, IfMatch=etag)['Body'].read()
+        crop = self._crop_face(image)
+        with self._lock:
+            self._crops[key] = crop
+            while len(self._crops) > self.max_entries:
+                self._crops.popitem(last=False)
+        return crop
+
+    def _crop_face(self, image_bytes):
+        faces = self.rekognition_client.detect_faces(Image={'Bytes': image_bytes})['FaceDetails']
+        if not faces:
+            return None
+        box = max((face['BoundingBox'] for face in faces), key=lambda box: box['Width'] * box['Height'])
+
+        image = ImageOps.exif_transpose(Image.open(io.BytesIO(image_bytes))).convert('RGB')
+        width, height = image.size
+        margin_x, margin_y = box['Width'] * CROP_MARGIN, box['Height'] * CROP_MARGIN
+        image = image.crop((
+            max(0, int((box['Left'] - margin_x) * width)),
+            max(0, int((box['Top'] - margin_y) * height)),
+            min(width, int((box['Left'] + box['Width'] + margin_x) * width)),
+            min(height, int((box['Top'] + box['Height'] + margin_y) * height)),
+        ))
+        output = io.BytesIO()
+        image.save(output, format='JPEG', quality=90)
+        return output.getvalue()
+
+    def stats(self):
+        return {"entries": len(self._crops), "hits": self.hits, "misses": self.misses}
+
+
+def verify_face(rekognition_client, id_faces, bucket, id_file_name, selfie_file_name):
+    """
+    Check that the selfie shows the person on the identity document.
+
+    The details carry the best similarity, the selfie face's bounding box and the number of
+    faces in the selfie, so the user can be told what to fix.
+    """
+    try:
+        id_face = id_faces.id_face(bucket, id_file_name)
+        if id_face is None:
+            return result(200, 'No face found on ID document', {"similarity": None, "bounding_box": None, "faces_in_selfie": None})
+
+        response = rekognition_client.compare_faces(
+            # every candidate is returned so its similarity can be reported
+            SimilarityThreshold = 0,
+            SourceImage = {'Bytes': id_face},
+            TargetImage = {
+                'S3Object': {
+                        'Bucket': bucket,
+                        'Name': selfie_file_name,
+                    }
+            } ,
+        )
+    except Exception as e:
+        return result(500, str(e))
+
+    faces_in_selfie = len(response['FaceMatches']) + len(response['UnmatchedFaces'])
+    best = max(response['FaceMatches'], key=lambda match: match['Similarity'], default=None)
+    if best is not None:
+        face, similarity = best['Face'], round(best['Similarity'], 1)
+    else:
+        face, similarity = (response['UnmatchedFaces'] or [None])[0], None
+    details = {
+        "similarity": similarity,
+        "bounding_box": face['BoundingBox'] if face else None,
+        "faces_in_selfie": faces_in_selfie,
+    }
+
+    if similarity is not None and similarity >= FACE_SIMILARITY_THRESHOLD:
+        return result(200, 'Face match verified', details)
+    return result(200, 'No face match found', details)
@@ -0,0 +1,103 @@
+import re
+import unicodedata
+from collections import namedtuple
+
+from onboarding.responses import result
+
+# minimum name_similarity for a provided name to match the ID
+NAME_MATCH_THRESHOLD = 0.85
+# shorter names must match exactly once normalised; one character is too much of them to guess
+MIN_FUZZY_LENGTH = 4
+# below this Textract confidence a mismatch is reported as unreadable rather than wrong
+LOW_CONFIDENCE = 80
+
+IdField = namedtuple('IdField', ['value', 'confidence'])
+
+
+def extract_fields(analyze_id_response):
+    """
+    Map each field type of an AnalyzeID response (e.g. FIRST_NAME) to its value and Textract's
+    confidence in it, in a single pass over the fields.
+    """
+    id_fields = {}
+    for document in analyze_id_response['IdentityDocuments']:
+        for id_field in document['IdentityDocumentFields']:
+            value = id_field.get('ValueDetection', {})
+            id_fields[id_field['Type']['Text']] = IdField(value.get('Text', ''), value.get('Confidence', 0.0))
+    return id_fields
+
+
+def extract_text(textract_client, bucket, id_file_name):
+    """Read the fields of an identity document with Textract AnalyzeID."""
+    response = textract_client.analyze_id(
+        DocumentPages = [
+            {
+                'S3Object': {
+                    'Bucket': bucket,
+                    'Name': id_file_name,
+                }
+            }
+        ],
+    )
+    return extract_fields(response)
+
+
+def normalize_name(value):
+    """Fold case and accents and turn hyphens, apostrophes and other punctuation into word breaks."""
+    decomposed = unicodedata.normalize('NFKD', value)
+    letters = ''.join(char for char in decomposed if not unicodedata.combining(char)).casefold()
+    return ' '.join(re.sub(r"[\W_]+", ' ', letters).split())
+
+
+def name_similarity(provided, on_id):
+    """
+    Similarity in [0, 1] between a name the user gave and the one on their ID.
+
+    Names match when one's words are a subset of the other's (a middle name given or left
+    out), or when they agree with the word breaks removed ("MaryAnn" and "MARY ANN"). Otherwise
+    they are compared by edit distance, which tolerates small OCR errors in names long
+    enough for one character to matter less (one edit in eight characters is 0.875).
+    """
+    provided, on_id = normalize_name(provided), normalize_name(on_id)
+    if not provided or not on_id:
+        return 0.0
+    provided_words, id_words = set(provided.split()), set(on_id.split())
+    if provided_words <= id_words or id_words <= provided_words:
+        return 1.0
+    provided, on_id = provided.replace(' ', ''), on_id.replace(' ', '')
+    if provided == on_id:
+        return 1.0
+    if min(len(provided), len(on_id)) < MIN_FUZZY_LENGTH:
+        return 0.0
+    return 1 - edit_distance(provided, on_id) / max(len(provided), len(on_id))
+
+
+def edit_distance(a, b):
+    """Levenshtein distance: insertions, deletions and substitutions turning `a` into `b`."""
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b)))
+        previous = current
+    return previous[-1]
+
+
+def compare_fields(id_fields, required_field_values, threshold=NAME_MATCH_THRESHOLD):
+    for key, val in required_field_values.items():
+        id_field = id_fields.get(key)
+        if id_field is None or name_similarity(val, id_field.value) < threshold:
+            if id_field is not None and id_field.confidence < LOW_CONFIDENCE:
+                return "The " + key + " on your ID could not be read clearly. Please upload a clearer photo of your ID"
+            return "The details you provided for " + key + " do not match your ID"
+
+    return "Document has been verified"
+
+
+def verify_id(textract_client, bucket, file_name, required_field_values, threshold=NAME_MATCH_THRESHOLD):
+    """Check that the identity document in `file_name` carries the `required_field_values`."""
+    try:
+        id_fields = extract_text(textract_client, bucket, file_name)
+    except Exception as e:
+        return result(500, str(e))
+    return result(200, compare_fields(id_fields, required_field_values, threshold))
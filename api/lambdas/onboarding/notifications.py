@@ -0,0 +1,128 @@
+import hashlib
+import json
+import uuid
+from collections import deque
+
+
+def welcome_email_event(account):
+    """Queue message asking for the welcome email of a newly created account."""
+    email = account['email'].lower()
+    return {
+        # one welcome email per account, however many times the message is delivered
+        'idempotency_key': hashlib.sha256(('welcome-email:' + email).encode()).hexdigest(),
+        'email': email,
+        'first_name': account['first_name'],
+        'last_name': account['last_name'],
+        'account_type': account['account_type'],
+    }
+
+
+class SqsQueue:
+    """Welcome-email queue on SQS; the send-welcome-email Lambda consumes it in batches."""
+
+    def __init__(self, sqs_client, queue_url):
+        self.sqs_client = sqs_client
+        self.queue_url = queue_url
+
+    def enqueue(self, event):
+        self.sqs_client.send_message(QueueUrl=self.queue_url, MessageBody=json.dumps(event))
+
+
+class LocalQueue:
+    """In-memory stand-in for SqsQueue that hands out SQS-shaped records, for local runs and tests."""
+
+    def __init__(self):
+        self.messages = deque()
+
+    def enqueue(self, event):
+        self.messages.append({'messageId': str(uuid.uuid4()), 'body': json.dumps(event)})
+
+    def receive(self, max_messages=10):
+        records = []
+        while self.messages and len(records) < max_messages:
+            records.append(self.messages.popleft())
+        return records
+
+    def drain(self, send_batch, max_messages=10):
+        """Feed queued records to `send_batch` until the queue is empty; failed records are re-queued once."""
+        retried = set()
+        while self.messages:
+            records = self.receive(max_messages)
+            by_id = {record['messageId']: record for record in records}
+            for failure in send_batch(records)['batchItemFailures']:
+                if failure['itemIdentifier'] not in retried:
+                    retried.add(failure['itemIdentifier'])
+                    self.messages.append(by_id[failure['itemIdentifier']])
+
+
+class DynamoDBSentLog:
+    """Records sent welcome emails on the customer's item, keyed by the message's idempotency key."""
+
+    def __init__(self, dynamodb_client, table_name):
+        self.dynamodb_client = dynamodb_client
+        self.table_name = table_name
+
+    def already_sent(self, event):
+        response = self.dynamodb_client.get_item(
+            TableName=self.table_name,
+            Key={'email': {'S': event['email']}},
+            ProjectionExpression='welcome_email_key',
+            ConsistentRead=True,
+        )
+        return response.get('Item', {}).get('welcome_email_key', {}).get('S') == event['idempotency_key']
+
+    def record_sent(self, event):
+        self.dynamodb_client.update_item(
+            TableName=self.table_name,
+            Key={'email': {'S': event['email']}},
+            UpdateExpression='SET welcome_email_key = :key',
+            ExpressionAttributeValues={':key': {'S': event['idempotency_key']}},
+        )
+
+
+class MemorySentLog:
+    """In-memory stand-in for DynamoDBSentLog."""
+
+    def __init__(self):
+        self.sent = set()
+
+    def already_sent(self, event):
+        return event['idempotency_key'] in self.sent
+
+    def record_sent(self, event):
+        self.sent.add(event['idempotency_key'])
+
+
+def send_welcome_email(ses_client, source_email, event):
+    ses_client.send_email(
+        Source=source_email,
+        Destination={
+            'ToAddresses': [event['email']]
+        },
+        Message={
+            'Subject': {'Data': 'Welcome to AnyBank!'},
+            'Body': {'Text': {'Data': 'Hello ' + event['first_name'] + ' ' + event['last_name'] + ', thank you for creating a new ' + event['account_type'] + ' account with AnyBank. We have completed your ID and face verification successfully and you should be ready to access your account!'}}
+        }
+    )
+
+
+def send_welcome_emails(ses_client, sent_log, source_email, records):
+    """
+    Send the welcome emails of a batch of queue records.
+
+    Returns the SQS partial batch response: only the records listed in `batchItemFailures`
+    are delivered again. Emails already recorded in `sent_log` are skipped, so redelivered
+    messages do not send a second email.
+    """
+    failures = []
+    for record in records:
+        try:
+            event = json.loads(record['body'])
+            if sent_log.already_sent(event):
+                continue
+            send_welcome_email(ses_client, source_email, event)
+            sent_log.record_sent(event)
+        except Exception as e:
+            print("Welcome email failed for message " + record['messageId'] + ": " + str(e))
+            failures.append({'itemIdentifier': record['messageId']})
+    return {'batchItemFailures': failures}
@@ -0,0 +1,24 @@
+def result(status_code, body, details=None):
+    """Outcome of an onboarding operation, in the shape the API returns it."""
+    outcome = {"statusCode": status_code, "body": body}
+    if details is not None:
+        outcome["details"] = details
+    return outcome
+
+
+def lambda_response(outcome, method):
+    """Wrap an onboarding outcome in the API Gateway integration response."""
+    response = {
+        "isBase64Encoded": True,
+        "statusCode": outcome["statusCode"],
+        "body": outcome["body"],
+        "headers": {
+            "Content-Type": "application/json",
+            "Access-Control-Allow-Headers" : "Content-Type",
+            "Access-Control-Allow-Origin": "*",
+            "Access-Control-Allow-Methods": method
+        }
+    }
+    if "details" in outcome:
+        response["details"] = outcome["details"]
+    return response
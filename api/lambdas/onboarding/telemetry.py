@@ -0,0 +1,51 @@
+import functools
+import json
+import time
+
+NAMESPACE = "Penny/Onboarding"
+
+_cold_start = True
+
+
+def timing_record(function_name, duration_ms, status_code, cold_start, request_id):
+    """
+    One invocation in CloudWatch Embedded Metric Format: logged as JSON, and turned by
+    CloudWatch into a Duration metric per function, so p50/p95/p99 can be graphed without
+    any agent. Carries no event data, so no customer details reach the logs.
+    """
+    return {
+        "_aws": {
+            "Timestamp": int(time.time() * 1000),
+            "CloudWatchMetrics": [{
+                "Namespace": NAMESPACE,
+                "Dimensions": [["Function"]],
+                "Metrics": [{"Name": "Duration", "Unit": "Milliseconds"}],
+            }],
+        },
+        "Function": function_name,
+        "Duration": duration_ms,
+        "StatusCode": status_code,
+        "ColdStart": cold_start,
+        "RequestId": request_id,
+    }
+
+
+def instrumented(function_name):
+    """Decorate a Lambda handler to log its duration and status code as a timing record."""
+    def decorate(handler):
+        @functools.wraps(handler)
+        def wrapper(event, context):
+            global _cold_start
+            cold_start, _cold_start = _cold_start, False
+            started = time.perf_counter()
+            status_code = 500
+            try:
+                response = handler(event, context)
+                status_code = response.get("statusCode", 200) if isinstance(response, dict) else 200
+                return response
+            finally:
+                duration_ms = round((time.perf_counter() - started) * 1000, 2)
+                print(json.dumps(timing_record(
+                    function_name, duration_ms, status_code, cold_start, getattr(context, "aws_request_id", None))))
+        return wrapper
+    return decorate
@@ -0,0 +1,13 @@
+import os
+
+from onboarding import DynamoDBSentLog, instrumented, send_welcome_emails
+from onboarding.clients import get_client
+
+# created during the init phase and reused by every warm invocation
+ses_client = get_client('ses')
+sent_log = DynamoDBSentLog(get_client('dynamodb'), os.environ['tableName'])
+
+
+@instrumented('send-welcome-email')
+def main(event, context):
+    return send_welcome_emails(ses_client, sent_log, os.environ['sesIdentityEmail'], event['Records'])
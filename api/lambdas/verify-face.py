@@ -1,66 +1,15 @@
-import boto3
-import json
 import os
 
+from onboarding import instrumented, lambda_response
+from onboarding.clients import get_client
+from onboarding.faces import IdFaceCache, verify_face
 
-def compare_faces(id_file_name, selfie_file_name):
-
-    rekognition_client = boto3.client('rekognition')
-    
-    response = rekognition_client.compare_faces(
-        SimilarityThreshold = 95,
-        SourceImage = {
-            'S3Object': {
-                    'Bucket': os.environ['bucketName'],
-                    'Name': id_file_name,
-                }
-        } ,
-        TargetImage = {
-            'S3Object': {
-                    'Bucket': os.environ['bucketName'],
-                    'Name': selfie_file_name,
-                }
-        } ,
-    )
-
-    for faceMatch in response['FaceMatches']:
-        position = faceMatch['Face']['BoundingBox']
-        similarity = str(faceMatch['Similarity'])
-
-    return len(response['FaceMatches'])
+# created during the init phase and reused by every warm invocation, as are the cached ID faces
+rekognition_client = get_client('rekognition')
+id_faces = IdFaceCache(rekognition_client, get_client('s3'))
 
 
+@instrumented('verify-face')
 def main(event, context):
-    statusCode = 200 
-    isBase64Encoded = True
-    headers = {
-        "Content-Type": "application/json",
-        "Access-Control-Allow-Headers" : "Content-Type",
-        "Access-Control-Allow-Origin": "*",
-        "Access-Control-Allow-Methods": "POST"
-    }
-    
-    id_file_name = event["id_file_name"]
-    selfie_file_name = event["selfie_file_name"]
-    body = ''
-
-    try:
-        face_matches = compare_faces(id_file_name, selfie_file_name)
-
-        if face_matches > 0: 
-            body = 'Face match verified'
-        else: 
-            body = 'No face match found'
-            
-    except Exception as e:
-        statusCode = 500
-        body += str(e)
-
-    finally:
-        response = {
-            "isBase64Encoded": isBase64Encoded,
-            "statusCode": statusCode,
-            "body": body,
-            "headers": headers
-        }
-        return response
\ No newline at end of file
+    outcome = verify_face(rekognition_client, id_faces, os.environ['bucketName'], event["id_file_name"], event["selfie_file_name"])
+    return lambda_response(outcome, "POST")
@@ -1,19 +1,82 @@
 from typing import Union
 from penny.PennyAgent import PennyAgent
+from penny.sessions import SessionRegistry, is_valid_session_id
+from penny.session_store import get_session_store
+from penny import resilience, tools
+from penny.tools import close_async_client, get_backend, get_knowledge_base, get_verification_pipeline
+from penny.clients import get_client
+from penny.resilience import get_bedrock_client, is_throttling
+from penny.streaming import stream_turn
+from penny.uploads import DocumentStore, UploadRejected
+from penny.images import ImagePreprocessor, ImageRejected
+from penny.limits import ConcurrencyLimiter, Overloaded
+from penny.telemetry import render_metrics, setup_tracing, span
+from concurrent.futures import ThreadPoolExecutor
+from starlette.concurrency import run_in_threadpool
 from langchain_community.chat_models import BedrockChat
 from fastapi import FastAPI, Request, Response, File, UploadFile, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-import boto3
+import asyncio
+import io
 import json
 import requests
-import time
 import os
+import threading
 
 
+# spans always feed /metrics; tracesExporter also sends them to "console" or "otlp"
+setup_tracing(os.environ.get("tracesExporter", "none"))
+
 #fastapi app init
 app = FastAPI()
-bedrock = boto3.client(service_name='bedrock-runtime')
+
+# photos are fixed up and quality-checked before they reach S3, Textract and Rekognition
+images = None
+if os.environ.get("imagePreprocessing", "on") != "off":
+    images = ImagePreprocessor(
+        max_workers=int(os.environ.get("imageWorkers", 2)),
+        max_side=int(os.environ.get("imageMaxSide", 2000)),
+        min_side=int(os.environ.get("imageMinSide", 300)),
+        min_sharpness=float(os.environ.get("minImageSharpness", 10)),
+    )
+
+# room for the multipart/form-data boundaries and headers around the file itself
+FORM_OVERHEAD_BYTES = 64 * 1024
+
+# conversation turns this worker runs at once (each makes its Bedrock calls one at a time);
+# more wait in a bounded queue, and beyond that are answered with 429 and Retry-After
+limiter = ConcurrencyLimiter(
+    max_concurrent=int(os.environ.get("bedrockMaxConcurrency", 16)),
+    max_queue=int(os.environ.get("turnQueueSize", 32)),
+    queue_timeout=float(os.environ.get("turnQueueTimeoutSeconds", 10)),
+)
+
+
+@app.middleware("http")
+async def trace_requests(request: Request, call_next):
+    # labelled with the route's template once routed, so ids in paths or unknown paths add no series
+    with span("http.request", **{"http.route": "unmatched", "http.method": request.method}) as current:
+        response = await call_next(request)
+        route = request.scope.get("route")
+        if route is not None:
+            current.set_attribute("http.route", route.path)
+        current.set_attribute("http.status_code", response.status_code)
+    return response
+
+
+@app.middleware("http")
+async def limit_upload_size(request: Request, call_next):
+    # reject oversized uploads from Content-Length before the body is read and spooled
+    content_length = request.headers.get("content-length")
+    if request.url.path == "/uploadDoc" and content_length and content_length.isdigit():
+        try:
+            documents = await run_in_threadpool(get_documents)
+            documents.check_declared(None, max(0, int(content_length) - FORM_OVERHEAD_BYTES))
+        except UploadRejected as e:
+            return JSONResponse(status_code=e.status_code, content={"detail": str(e)})
+    return await call_next(request)
+
 
 origins = [
     "*"
@@ -25,59 +88,276 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # so the demo application can wait as long as a 429 asks before sending a turn again
+    expose_headers=["Retry-After"],
 )
 
 config = dict(
     assistant_name="Penny",
     assistant_role="Banking Assistant",
     bank_name="AnyBank",
-    conversation_history=[],
-    use_tools=True
+    use_tools=True,
+    history_token_budget=int(os.environ.get("historyTokenBudget", 3000)),
+    use_stage_engine=os.environ.get("stageEngine", "on") != "off",
+    prompt_caching=os.environ.get("bedrockPromptCaching", "off") == "on",
+    agent_mode=os.environ.get("agentMode", "react"),
+    # smaller model for the greeting and the prompts for the next detail; unset uses the main model throughout
+    fast_model_id=os.environ.get("bedrockFastModel") or None,
 )
-llm = BedrockChat(
-        model_id='anthropic.claude-3-5-sonnet-20240620-v1:0', 
-        client=bedrock,
-        model_kwargs={
-            "temperature": 0.5,
-            "top_k": 250,
-            "top_p": 0.999,
-            "stop_sequences": ["\\n\\nHuman:"]
-        }
-    )
+
+# the agent, session registry and AWS clients are built on first use rather than at import,
+# so the app imports without any AWS configuration and the server is up before they exist
+_template_agent = None
+_sessions = None
+_documents = None
+_build_lock = threading.RLock()
+warm_up = None
+
+
+def get_template_agent() -> PennyAgent:
+    """The agent every conversation is spawned from: one executor and tool set shared by all."""
+    global _template_agent
+    with _build_lock:
+        if _template_agent is None:
+            llm = BedrockChat(
+                model_id='anthropic.claude-3-5-sonnet-20240620-v1:0',
+                client=get_bedrock_client(),
+                streaming=True,
+                model_kwargs={
+                    "temperature": 0.5,
+                    "top_k": 250,
+                    "top_p": 0.999,
+                    "stop_sequences": ["\\n\\nHuman:"]
+                }
+            )
+            _template_agent = PennyAgent.from_llm(llm, verbose=False, **config)
+    return _template_agent
+
+
+def get_sessions() -> SessionRegistry:
+    global _sessions
+    with _build_lock:
+        if _sessions is None:
+            _sessions = SessionRegistry(
+                agent_factory=get_template_agent().spawn,
+                max_sessions=int(os.environ.get("maxSessions", 500)),
+                idle_ttl_seconds=float(os.environ.get("sessionIdleTtlSeconds", 1800)),
+                max_memory_bytes=int(os.environ.get("sessionMemoryCapMb", 256)) * 1024 * 1024,
+                # with an external store any task can serve any turn; the in-memory sessions are its cache
+                store=get_session_store(),
+            )
+    return _sessions
+
+
+def get_documents() -> DocumentStore:
+    global _documents
+    with _build_lock:
+        if _documents is None:
+            _documents = DocumentStore(
+                s3_client=get_client('s3'),
+                bucket=os.environ["idBucketName"],
+                max_bytes=int(os.environ.get("maxUploadMb", 10)) * 1024 * 1024,
+                multipart_threshold=int(os.environ.get("uploadMultipartThresholdMb", 8)) * 1024 * 1024,
+            )
+    return _documents
+
+
+def build_service():
+    """Everything the first turn would otherwise build: agent, tools and their clients, worker pools."""
+    try:
+        get_template_agent()
+        get_sessions()
+        get_documents()
+        get_backend()
+        get_verification_pipeline()
+        # the product search chain, with its retriever (for retrieverBackend=local, the index)
+        get_knowledge_base().chain
+        if images is not None:
+            images.warm_up()
+    except Exception as e:
+        print("Startup failed: " + type(e).__name__ + ": " + str(e))
+        raise
+
+
+@app.on_event("startup")
+async def startup():
+    global warm_up
+    # Bedrock calls made through langchain run on the loop's default executor; size it for
+    # concurrent conversations rather than the cpu-bound default of min(32, cpus + 4)
+    max_workers = int(os.environ.get("llmMaxConcurrency", 64))
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=max_workers))
+    # built in the background: /health answers straight away, /ready once turns can be served
+    warm_up = loop.run_in_executor(None, build_service)
 
 
+@app.on_event("shutdown")
+async def shutdown():
+    if _sessions is not None:
+        await run_in_threadpool(_sessions.close)
+    await close_async_client()
+    # only what was built: startup may have failed or not got that far
+    if tools._verification_pipeline is not None:
+        tools._verification_pipeline.shutdown()
+    if resilience._bedrock is not None:
+        resilience._bedrock.shutdown()
+    if images is not None:
+        images.shutdown()
+
+
+SESSION_HEADER = "X-Session-Id"
+SESSION_COOKIE = "penny_session"
+
+
+def get_session_id(request: Request) -> str:
+    session_id = request.headers.get(SESSION_HEADER) or request.cookies.get(SESSION_COOKIE)
+    if not is_valid_session_id(session_id):
+        raise HTTPException(status_code=400, detail='Missing or invalid session id')
+    return session_id
+
+
+@app.exception_handler(Overloaded)
+async def overloaded(request: Request, e: Overloaded):
+    return JSONResponse(status_code=e.status_code, content={"detail": str(e)}, headers={"Retry-After": str(e.retry_after)})
+
+async def run_turn(agent: PennyAgent) -> str:
+    # Bedrock still throttling after the client's retries is answered like a full worker: 429 with Retry-After
+    try:
+        return await agent.astep()
+    except Exception as e:
+        if is_throttling(e):
+            raise Overloaded(limiter.retry_after()) from e
+        raise
+
+@app.get("/health")
+def health():
+    # liveness only: the process is up and serving requests
+    return {"status": "ok"}
+
+@app.get("/ready")
+async def ready():
+    if warm_up is None or not warm_up.done():
+        return JSONResponse(status_code=503, content={"status": "starting"})
+    if warm_up.exception() is not None:
+        return JSONResponse(status_code=503, content={"status": "failed"})
+    return {"status": "ready"}
+
 @app.get("/")
-def read_root():
-    global agent
-    agent = PennyAgent.from_llm(llm, verbose=False, **config)
-    agent.seed_agent()
-    return {"response": "Agent is ready"}
+def read_root(request: Request, response: Response):
+    sessions = get_sessions()
+    previous_session_id = request.headers.get(SESSION_HEADER) or request.cookies.get(SESSION_COOKIE)
+    if previous_session_id:
+        sessions.discard(previous_session_id)
+
+    session_id, _ = sessions.create()
+    response.set_cookie(SESSION_COOKIE, session_id, httponly=True, samesite="none", secure=True)
+    return {"response": "Agent is ready", "session_id": session_id}
+
+@app.get("/stats")
+def stats():
+    return {
+        "sessions": get_sessions().stats(),
+        "product_search_cache": get_knowledge_base().stats(),
+        "verification": get_verification_pipeline().stats(),
+        "uploads": {"duplicates": get_documents().duplicates, "rejected_images": images.rejected if images else 0},
+        "prompt": get_template_agent().prompt_stats(),
+        "turns": limiter.stats(),
+        "bedrock": get_bedrock_client().stats(),
+    }
+
+@app.get("/metrics")
+def metrics():
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
 
 @app.post("/question")
 async def question(request: Request) -> Response:
-    requestJson = await request.json()
-    message = requestJson["message"]
-    agent.human_step(message)
-    response = agent.step()
+    session_id = get_session_id(request)
+    # built on first use under a lock, which the event loop must not wait on
+    sessions = await run_in_threadpool(get_sessions)
+    # one turn of a session at a time, from loading its agent until the turn is saved
+    async with sessions.turn(session_id), limiter.slot():
+        agent = await run_in_threadpool(sessions.get_or_create, session_id)
+        requestJson = await request.json()
+        message = requestJson["message"]
+        agent.human_step(message)
+        response = await run_turn(agent)
+        sessions.save(session_id, agent)
     return JSONResponse(content={"message": response})
 
-@app.post("/uploadDoc")
-async def id(file: UploadFile = File(...)) -> Response:
+@app.post("/questionStream")
+async def question_stream(request: Request) -> Response:
+    session_id = get_session_id(request)
+    sessions = await run_in_threadpool(get_sessions)
+    turn = await sessions.acquire_turn(session_id)
+    try:
+        granted_at = await limiter.acquire()
+    except BaseException:
+        sessions.release_turn(session_id, turn)
+        raise
+    try:
+        agent = await run_in_threadpool(sessions.get_or_create, session_id)
+        requestJson = await request.json()
+        message = requestJson["message"]
+        agent.human_step(message)
+    except BaseException:
+        limiter.release(granted_at)
+        sessions.release_turn(session_id, turn)
+        raise
+    return StreamingResponse(
+        release_after(stream_turn(agent), granted_at, sessions, session_id, agent, turn),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+async def release_after(events, granted_at, sessions, session_id, agent, turn):
+    # the slot and the session's turn are held until the reply has been streamed and saved,
+    # or the client has gone away
     try:
-        contents = file.file.read()
-        file.file.seek(0)
-        s3_client = boto3.client('s3')
+        async for event in events:
+            yield event
+        await run_in_threadpool(sessions.save, session_id, agent)
+    finally:
+        limiter.release(granted_at)
+        sessions.release_turn(session_id, turn)
 
-        obj_name = "my-doc-" + str(time.time()).replace(".", "") + ".png"
-        print("Uploading object with name: " + obj_name)
-        response = s3_client.upload_fileobj(file.file, os.environ["idBucketName"], obj_name)
-        print(response)
+@app.post("/uploadDoc")
+async def id(request: Request, file: UploadFile = File(...)) -> Response:
+    session_id = get_session_id(request)
+    sessions = await run_in_threadpool(get_sessions)
+    turn = await sessions.acquire_turn(session_id)
+    try:
+        granted_at = await limiter.acquire()
+    except BaseException:
+        sessions.release_turn(session_id, turn)
+        file.file.close()
+        raise
+    try:
+        documents = await run_in_threadpool(get_documents)
+        agent = await run_in_threadpool(sessions.get_or_create, session_id)
+        if images is None:
+            obj_name, _ = await run_in_threadpool(documents.store, file.file, file.content_type)
+        else:
+            contents, content_type = await run_in_threadpool(documents.read, file.file, file.content_type)
+            image = await images.prepare(contents, content_type)
+            obj_name, _ = await run_in_threadpool(documents.store, io.BytesIO(image.data), image.content_type)
 
         agent.human_step("[System] uploaded file-name: " + obj_name)
-        response = agent.step()
+        # start Textract/Rekognition checks now; the verification tools pick up the results
+        get_verification_pipeline().prefetch(agent.history.state)
+        response = await run_turn(agent)
+        sessions.save(session_id, agent)
+    except Overloaded:
+        raise
+    except ImageRejected as e:
+        # answered as Penny, before any AWS call, so the user can retake the photo right away
+        return JSONResponse(status_code=e.status_code, content={"message": str(e)})
+    except UploadRejected as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail='Something went wrong: ' + str(e))
     finally:
+        limiter.release(granted_at)
+        sessions.release_turn(session_id, turn)
         file.file.close()
 
     return JSONResponse(content={"message": response})
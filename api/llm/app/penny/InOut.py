@@ -1,28 +1,122 @@
 import re
+import textwrap
+from contextlib import contextmanager
+from contextvars import ContextVar
 from langchain.prompts.base import StringPromptTemplate
 from langchain.schema import AgentAction, AgentFinish
 from langchain.agents.conversational.prompt import FORMAT_INSTRUCTIONS
 from langchain.agents.agent import AgentOutputParser
-from typing import Dict, List, Any, Union, Callable
+from langchain_core.messages import HumanMessage
+from langchain_core.prompt_values import ChatPromptValue, PromptValue, StringPromptValue
+from typing import Dict, List, Any, Union, Callable, Tuple
+from penny.history import estimate_tokens
+
+# everything before the history is the same on every call of a conversation's turns
+HISTORY_VARIABLE = "{conversation_history}"
+
+
+def compact_prompt(template: str) -> str:
+    """Drop the indentation, trailing spaces and extra blank lines of a prompt; they are billed on every call."""
+    lines = [re.sub(r" {2,}", " ", line.rstrip()) for line in textwrap.dedent(template).splitlines()]
+    return re.sub(r"\n{3,}", "\n\n", "\n".join(lines)).strip() + "\n"
+
+
+class PromptUsage:
+    """Prompt renders of one turn and the input tokens they saved."""
+
+    def __init__(self):
+        self.renders = 0
+        self.trimmed_tokens = 0
+        self.cached_tokens = 0
+
+    @property
+    def tokens_saved(self) -> int:
+        return self.trimmed_tokens + self.cached_tokens
+
+
+_prompt_usage: ContextVar = ContextVar("prompt_usage", default=None)
+
+
+@contextmanager
+def prompt_usage_scope():
+    """Count the prompts rendered by the current turn, however many model calls the executor makes."""
+    usage = PromptUsage()
+    token = _prompt_usage.set(usage)
+    try:
+        yield usage
+    finally:
+        _prompt_usage.reset(token)
 
 
 class CustomPromptTemplateForTools(StringPromptTemplate):
+    """
+    Agent prompt split at the conversation history: the static prefix (persona, stages, tools,
+    format) is rendered once per assistant and tool set, and only the history and scratchpad
+    are rendered per call. With `prompt_caching` the prefix is sent as its own content block
+    marked for Bedrock prompt caching.
+    """
     template: str
     tools_getter: Callable
+    prompt_caching: bool = False
+    # tokens the compacted template saves over the original on every call
+    trimmed_tokens: int = 0
+    prefixes: Dict[Tuple, Tuple[str, int]] = {}
+    renders: int = 0
+    tokens_saved: int = 0
 
     def format(self, **kwargs) -> str:
+        prefix, _, suffix = self._render(**kwargs)
+        return prefix + suffix
+
+    def format_prompt(self, **kwargs) -> PromptValue:
+        prefix, prefix_tokens, suffix = self._render(**kwargs)
+        self._record(prefix_tokens if self.prompt_caching else 0)
+        if not self.prompt_caching:
+            return StringPromptValue(text=prefix + suffix)
+        return ChatPromptValue(messages=[HumanMessage(content=[
+            {"type": "text", "text": prefix, "cache_control": {"type": "ephemeral"}},
+            {"type": "text", "text": suffix},
+        ])])
+
+    def _render(self, **kwargs) -> Tuple[str, int, str]:
         intermediate_steps = kwargs.pop("intermediate_steps")
         thoughts = ""
         for action, observation in intermediate_steps:
             thoughts += action.log
             thoughts += f"\nObservation: {observation}\nThought: "
-        kwargs["agent_scratchpad"] = thoughts
         tools = self.tools_getter(kwargs["input"])
-        kwargs["tools"] = "\n".join(
-            [f"{tool.name}: {tool.description}" for tool in tools]
-        )
-        kwargs["tool_names"] = ", ".join([tool.name for tool in tools])
-        return self.template.format(**kwargs)
+        key = (tuple(tool.name for tool in tools), kwargs["assistant_name"], kwargs["assistant_role"], kwargs["bank_name"])
+        if key not in self.prefixes:
+            prefix_template = self.template.split(HISTORY_VARIABLE, 1)[0]
+            prefix = prefix_template.format(
+                tools="\n".join([f"{tool.name}: {tool.description}" for tool in tools]),
+                tool_names=", ".join([tool.name for tool in tools]),
+                **kwargs,
+            )
+            self.prefixes[key] = (prefix, estimate_tokens(prefix))
+        suffix_template = HISTORY_VARIABLE + self.template.split(HISTORY_VARIABLE, 1)[1]
+        suffix = suffix_template.format(conversation_history=kwargs["conversation_history"], agent_scratchpad=thoughts)
+        prefix, prefix_tokens = self.prefixes[key]
+        return prefix, prefix_tokens, suffix
+
+    def _record(self, cached_tokens: int) -> None:
+        self.renders += 1
+        self.tokens_saved += self.trimmed_tokens + cached_tokens
+        usage = _prompt_usage.get()
+        if usage is not None:
+            usage.renders += 1
+            usage.trimmed_tokens += self.trimmed_tokens
+            usage.cached_tokens += cached_tokens
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "prompt_caching": self.prompt_caching,
+            "prefixes": len(self.prefixes),
+            "prefix_tokens": max((tokens for _, tokens in self.prefixes.values()), default=0),
+            "trimmed_tokens_per_call": self.trimmed_tokens,
+            "renders": self.renders,
+            "tokens_saved": self.tokens_saved,
+        }
     
 
 class ConvoOutputParser(AgentOutputParser):
@@ -43,7 +137,6 @@ class ConvoOutputParser(AgentOutputParser):
             )
         regex = r"Action: (.*?)[\n]*Action Input: (.*)"
         match = re.search(regex, text)
-        print(match)
         if not match:
             return AgentFinish(
                 {
@@ -1,5 +1,5 @@
-import boto3
 import json
+import os
 import time
 from pydantic import BaseModel, Field
 from langchain.chains import LLMChain
@@ -8,13 +8,17 @@ from langchain_community.llms import BaseLLM
 from langchain.chains.base import Chain
 from typing import Dict, List, Any, Union, Callable
 from langchain.agents import Tool, LLMSingleActionAgent, AgentExecutor
-from penny.InOut import CustomPromptTemplateForTools, ConvoOutputParser
-from penny.tools import get_tools
+from penny.InOut import CustomPromptTemplateForTools, ConvoOutputParser, compact_prompt, prompt_usage_scope
+from penny.tools import AccountLookupCache, conversation_scope, get_tools
+from penny.tool_calling import ToolCallingAgent
 from penny.ConversationChain import ConversationChain
+from penny.history import ConversationHistory, estimate_tokens
+from penny.stages import PROMPT_STAGES, STAGE_BY_AWAITING, StageEngine, ToolStep, is_short_answer
+from penny.resilience import model_scope
+from penny.telemetry import span, tracing_handler
+from opentelemetry import trace
 
-bedrock = boto3.client(service_name='bedrock-runtime')
-
-AGENT_TOOLS_PROMPT = """
+AGENT_PERSONA_PROMPT = """
     Never forget your name is {assistant_name}. You work as a {assistant_role}.
     You work at company named {bank_name}
 
@@ -79,6 +83,12 @@ AGENT_TOOLS_PROMPT = """
     4. It is critical that you never reveal any details provided by the System including file names. 
     5. If ever the user deviates by asking general question during your account opening process, Retrieve the necessary information using 'ProductSearch' tool and answer the question. With confidence, ask user if they want to resume the account opening process and continue from where we left off. 
 
+"""
+
+# Everything before {conversation_history} is the static prefix rendered once and cached by
+# Bedrock, so it must not depend on the turn: the format's Thought line no longer repeats the
+# latest message ({input}), which is already the last line of the history.
+AGENT_TOOLS_PROMPT = AGENT_PERSONA_PROMPT + """
     TOOLS:
     ------
     Penny has access to the following tools:
@@ -89,7 +99,7 @@ AGENT_TOOLS_PROMPT = """
 
     To use a tool, please always use the following format:
     ```
-    Thought: {input}
+    Thought: your reasoning about the latest message
     Decision: Do I need to use a tool? y
     Action: what tool to use, should be one of [{tool_names}]
     Action Input: the input to the action
@@ -107,21 +117,46 @@ AGENT_TOOLS_PROMPT = """
 
     {agent_scratchpad}
 """
+
+# the tools and their arguments are given to the model through the tool-use API
+TOOL_CALLING_PROMPT = AGENT_PERSONA_PROMPT + """
+    Use a tool by calling it; never describe tool calls in your reply.
+    Be confident that you are a banking assistant and only respond with your answer to the customer.
+    The conversation so far is in the first message.
+"""
         
 
+def new_lookup_cache() -> AccountLookupCache:
+    return AccountLookupCache(ttl_seconds=float(os.environ.get("emailLookupTtlSeconds", 60)))
+
+
 class PennyAgent(Chain):
     """Controller model for the agent."""
 
-    conversation_history: List[str] = []
+    history: Union[ConversationHistory, None] = None
+    account_lookups: Union[AccountLookupCache, None] = None
+    history_token_budget: int = 3000
+    static_prompt_tokens: int = 0
+    turn_prompt_tokens: List[int] = []
+    turn_tokens_saved: List[int] = []
     current_conversation_stage: str = "1"
     conversation_utterance_chain: ConversationChain = Field(...)
 
     agent_executor: Union[AgentExecutor, None] = Field(...)
+    tool_calling_agent: Union[ToolCallingAgent, None] = None
+    stage_engine: Union[StageEngine, None] = None
+    tools_by_name: Dict[str, Any] = {}
+    llm_turns: int = 0
+    deterministic_turns: int = 0
     use_tools: bool = False
     assistant_name: str = "Penny"
     assistant_role: str = "Banking Executive"
     bank_name: str = "AnyBank"
     inputd: str = ""
+    # turns saved to the session store; a snapshot with a lower version is out of date
+    state_version: int = 0
+    # model for turns that only greet or ask for the next detail; None uses the llm's own
+    fast_model_id: Union[str, None] = None
 
     @property
     def input_keys(self) -> List[str]:
@@ -131,54 +166,206 @@ class PennyAgent(Chain):
     def output_keys(self) -> List[str]:
         return []
 
+    @property
+    def conversation_history(self) -> List[str]:
+        return self.history.lines()
+
     def seed_agent(self):
         # Step 1: seed the conversation
-        self.conversation_history = []
+        self.history = ConversationHistory(token_budget=self.history_token_budget)
+        self.account_lookups = new_lookup_cache()
+        self.turn_prompt_tokens = []
+        self.turn_tokens_saved = []
+        self.current_conversation_stage = "1"
+
+    def spawn(self) -> "PennyAgent":
+        """Create a new conversation that shares this agent's chains, executor and tools."""
+        return self.__class__(
+            conversation_utterance_chain=self.conversation_utterance_chain,
+            agent_executor=self.agent_executor,
+            tool_calling_agent=self.tool_calling_agent,
+            stage_engine=self.stage_engine,
+            tools_by_name=self.tools_by_name,
+            use_tools=self.use_tools,
+            assistant_name=self.assistant_name,
+            assistant_role=self.assistant_role,
+            bank_name=self.bank_name,
+            history_token_budget=self.history_token_budget,
+            static_prompt_tokens=self.static_prompt_tokens,
+            fast_model_id=self.fast_model_id,
+            history=ConversationHistory(token_budget=self.history_token_budget),
+            account_lookups=new_lookup_cache(),
+            verbose=self.verbose,
+        )
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Conversation state kept in the session store: history, onboarding slots and stage."""
+        return {"h": self.history.snapshot(), "s": self.current_conversation_stage, "i": self.inputd}
+
+    def restore(self, snapshot: Dict[str, Any], version: int) -> None:
+        """Continue the conversation from a snapshot taken by any service task."""
+        self.history = ConversationHistory(token_budget=self.history_token_budget)
+        self.history.restore(snapshot["h"])
+        self.current_conversation_stage = snapshot["s"]
+        self.inputd = snapshot["i"]
+        self.state_version = version
 
-    
     def human_step(self, human_input):
         # process human input
         human_input = "User: " + human_input
         self.inputd = human_input
-        self.conversation_history.append(human_input)
+        self.history.append(human_input)
 
     def system_step(self, system_input):
         # process system input
         system_input = "System: " + system_input
         self.inputd = system_input
-        self.conversation_history.append(system_input)
+        self.history.append(system_input)
 
     def step(self):
-        response = self._call(inputs={})
+        with conversation_scope(self.account_lookups, self.history.state), span("agent.turn", **{"penny.stage": self.current_conversation_stage}):
+            response = self._call(inputs={})
+        return response
+
+    async def astep(self, callbacks=None):
+        with conversation_scope(self.account_lookups, self.history.state), span("agent.turn", **{"penny.stage": self.current_conversation_stage}):
+            response = await self._acall(inputs={}, callbacks=callbacks)
         return response
 
     def _call(self, inputs: Dict[str, Any]) -> None:
         """Run one step of the agent."""
 
+        # Onboarding steps with a deterministic answer skip the LLM
+        stage_step = self._next_stage_step()
+        if isinstance(stage_step, ToolStep):
+            tool = self.tools_by_name[stage_step.tool]
+            with span("tool.run", **{"penny.tool": stage_step.tool}):
+                result = getattr(tool, stage_step.method)(*stage_step.args)
+            return self._finish_stage_turn(stage_step.respond(result))
+        if stage_step is not None:
+            return self._finish_stage_turn(stage_step)
+
         # Generate agent's utterance
+        self.llm_turns += 1
+        with model_scope(self._turn_model()):
+            if self.use_tools and self.tool_calling_agent is not None:
+                ai_message = self.tool_calling_agent.run(self._turn_inputs()["conversation_history"])
+            elif self.use_tools:
+                with prompt_usage_scope() as usage:
+                    ai_message = self.agent_executor.run(callbacks=[tracing_handler], **self._turn_inputs())
+                self._record_prompt_usage(usage)
+            else:
+                ai_message = self.conversation_utterance_chain.run(callbacks=[tracing_handler], **self._turn_inputs())
+
+        return self._finish_turn(ai_message)
+
+    async def _acall(self, inputs: Dict[str, Any], callbacks=None) -> None:
+        """Run one step of the agent without blocking the event loop."""
+
+        # Onboarding steps with a deterministic answer skip the LLM
+        stage_step = self._next_stage_step()
+        if isinstance(stage_step, ToolStep):
+            tool = self.tools_by_name[stage_step.tool]
+            with span("tool.run", **{"penny.tool": stage_step.tool}):
+                result = await getattr(tool, "a" + stage_step.method)(*stage_step.args)
+            return self._finish_stage_turn(stage_step.respond(result))
+        if stage_step is not None:
+            return self._finish_stage_turn(stage_step)
+
+        # Generate agent's utterance
+        self.llm_turns += 1
+        with model_scope(self._turn_model()):
+            if self.use_tools and self.tool_calling_agent is not None:
+                ai_message = await self.tool_calling_agent.arun(self._turn_inputs()["conversation_history"])
+            elif self.use_tools:
+                with prompt_usage_scope() as usage:
+                    ai_message = await self.agent_executor.arun(callbacks=[tracing_handler, *(callbacks or [])], **self._turn_inputs())
+                self._record_prompt_usage(usage)
+            else:
+                ai_message = await self.conversation_utterance_chain.arun(callbacks=[tracing_handler, *(callbacks or [])], **self._turn_inputs())
+
+        return self._finish_turn(ai_message)
+
+    def _turn_model(self) -> Union[str, None]:
+        # a greeting, or the answer to a prompt for the next detail, doesn't need the larger model.
+        # The stage engine answers those prompts itself, so with it only the greeting qualifies:
+        # the other turns that reach the LLM are free-form
+        if self.fast_model_id is None:
+            return None
+        short_answer = is_short_answer(self.inputd.removeprefix("User: ").strip())
+        greeting = len(self.history.lines()) <= 1 and short_answer
+        slot_answer = (
+            self.stage_engine is None
+            and STAGE_BY_AWAITING.get(self.history.state.awaiting) in PROMPT_STAGES
+            and short_answer
+        )
+        if greeting or slot_answer:
+            trace.get_current_span().set_attribute("penny.fast_model", True)
+            return self.fast_model_id
+        return None
+
+    def _next_stage_step(self) -> Union[str, ToolStep, None]:
+        if self.stage_engine is None or not self.use_tools:
+            return None
+        return self.stage_engine.next_step(self.history.state, self.inputd)
+
+    def _finish_stage_turn(self, ai_message: str) -> str:
+        self.deterministic_turns += 1
+        trace.get_current_span().set_attribute("penny.deterministic", True)
+        # the engine already decided the next stage and the verification results; don't let the reply's wording override them
+        state = self.history.state
+        decided = (state.awaiting, state.id_verified, state.face_verified)
+        response = self._finish_turn(ai_message)
+        state.awaiting, state.id_verified, state.face_verified = decided
+        if self.stage_engine is not None:
+            self.current_conversation_stage = self.stage_engine.stage_of(self.history.state)
+        return response
+
+    def _turn_inputs(self) -> Dict[str, Any]:
+        prompt_tokens = self.static_prompt_tokens + self.history.tokens + estimate_tokens(self.inputd)
+        self.turn_prompt_tokens.append(prompt_tokens)
+        trace.get_current_span().set_attributes({
+            "penny.prompt_tokens": prompt_tokens,
+            "penny.history_tokens": self.history.tokens,
+            "penny.summarised_turns": self.history.summarised_turns,
+        })
+
+        turn_inputs = dict(
+            conversation_history=self.history.render(),
+            assistant_name=self.assistant_name,
+            assistant_role=self.assistant_role,
+            bank_name=self.bank_name,
+        )
         if self.use_tools:
-            ai_message = self.agent_executor.run(
-                input=self.inputd,
-                conversation_history="\n".join(self.conversation_history),
-                assistant_name=self.assistant_name,
-                assistant_role=self.assistant_role,
-                bank_name=self.bank_name,
-                )
-        else:
-            ai_message = self.conversation_utterance_chain.run(
-                assistant_name=self.assistant_name,
-                assistant_role=self.assistant_role,
-                bank_name=self.bank_name,
-                conversation_history="\n".join(self.conversation_history),
-                )
-           
+            turn_inputs["input"] = self.inputd
+        return turn_inputs
+
+    def _record_prompt_usage(self, usage) -> None:
+        self.turn_tokens_saved.append(usage.tokens_saved)
+        trace.get_current_span().set_attributes({
+            "penny.prompt_tokens_saved": usage.tokens_saved,
+            "penny.prompt_tokens_trimmed": usage.trimmed_tokens,
+            "penny.prompt_tokens_cached": usage.cached_tokens,
+            "penny.model_calls": usage.renders,
+        })
+
+    def prompt_stats(self) -> Dict[str, Any]:
+        if self.agent_executor is None:
+            return {}
+        stats = self.agent_executor.agent.llm_chain.prompt.stats()
+        if self.tool_calling_agent is not None:
+            stats["tool_calling"] = self.tool_calling_agent.stats()
+        return stats
+
+    def _finish_turn(self, ai_message: str) -> str:
         # Add agent's response to conversation history
-        print(f"{self.assistant_name}: ", ai_message)
         agent_name = self.assistant_name
         ai_message = agent_name + ": " + ai_message
         if "<END_OF_TURN>" not in ai_message:
             ai_message += " <END_OF_TURN>"
-        self.conversation_history.append(ai_message)
+        self.history.append(ai_message)
+        if self.stage_engine is not None:
+            self.current_conversation_stage = self.stage_engine.stage_of(self.history.state)
 
         return ai_message.removeprefix("Penny: ").replace("<END_OF_TURN>", "").replace("Final Answer: ",  "").replace("<END_OF_CONVERSATION>", "").rstrip()
 
@@ -189,24 +376,45 @@ class PennyAgent(Chain):
             llm, verbose=verbose
         )
 
+        prompt_caching = kwargs.pop("prompt_caching", False)
+        agent_mode = kwargs.pop("agent_mode", "react")
+
         if "use_tools" in kwargs.keys() and kwargs["use_tools"] is False:
             agent_executor = None
 
         else:
             tools = get_tools()
 
-            prompt = CustomPromptTemplateForTools(
-                template=AGENT_TOOLS_PROMPT,
-                tools_getter=lambda x: tools,
-                input_variables=[
-                    "input",
-                    "intermediate_steps",
-                    "assistant_name",
-                    "assistant_role",
-                    "bank_name",
-                    "conversation_history"                   
-                ],
-            )
+            def tools_prompt(template, **options):
+                return CustomPromptTemplateForTools(
+                    template=template,
+                    tools_getter=lambda x: tools,
+                    input_variables=[
+                        "input",
+                        "intermediate_steps",
+                        "assistant_name",
+                        "assistant_role",
+                        "bank_name",
+                        "conversation_history"
+                    ],
+                    **options,
+                )
+
+            # size of the prompt before any history or scratchpad is added
+            def static_tokens(prompt):
+                return estimate_tokens(prompt.format(
+                    input="",
+                    intermediate_steps=[],
+                    assistant_name=kwargs.get("assistant_name", cls.__fields__["assistant_name"].default),
+                    assistant_role=kwargs.get("assistant_role", cls.__fields__["assistant_role"].default),
+                    bank_name=kwargs.get("bank_name", cls.__fields__["bank_name"].default),
+                    conversation_history="",
+                ))
+
+            # the static prefix is rendered here, once, and reused by every conversation
+            prompt = tools_prompt(compact_prompt(AGENT_TOOLS_PROMPT), prompt_caching=prompt_caching)
+            kwargs["static_prompt_tokens"] = static_tokens(prompt)
+            prompt.trimmed_tokens = max(0, static_tokens(tools_prompt(AGENT_TOOLS_PROMPT)) - kwargs["static_prompt_tokens"])
             llm_chain = LLMChain(llm=llm, prompt=prompt, verbose=verbose)
 
             tool_names = [tool.name for tool in tools]
@@ -222,9 +430,35 @@ class PennyAgent(Chain):
             )
 
             agent_executor = AgentExecutor.from_agent_and_tools(
-                agent=agent_with_tools, tools=tools, verbose=True, max_iterations=4, stop=["\nPenny", "\nFinal Answer:"]
+                agent=agent_with_tools, tools=tools, verbose=verbose, max_iterations=4, stop=["\nPenny", "\nFinal Answer:"]
             )
 
+            if agent_mode == "tool_calling":
+                kwargs["tool_calling_agent"] = ToolCallingAgent(
+                    client=llm.client,
+                    model_id=llm.model_id,
+                    system_prompt=compact_prompt(TOOL_CALLING_PROMPT).format(
+                        assistant_name=kwargs.get("assistant_name", cls.__fields__["assistant_name"].default),
+                        assistant_role=kwargs.get("assistant_role", cls.__fields__["assistant_role"].default),
+                        bank_name=kwargs.get("bank_name", cls.__fields__["bank_name"].default),
+                    ),
+                    tools=tools,
+                    temperature=llm.model_kwargs.get("temperature", 0.5) if llm.model_kwargs else 0.5,
+                    prompt_caching=prompt_caching,
+                )
+                tool_calling_agent = kwargs["tool_calling_agent"]
+                kwargs["static_prompt_tokens"] = estimate_tokens(tool_calling_agent.system_prompt + json.dumps(tool_calling_agent.tool_specs))
+            elif agent_mode != "react":
+                raise ValueError("Unknown agent mode: " + agent_mode)
+
+            kwargs["tools_by_name"] = {tool.name: tool for tool in tools}
+            if kwargs.pop("use_stage_engine", True):
+                kwargs["stage_engine"] = StageEngine()
+
+        if "history" not in kwargs:
+            kwargs["history"] = ConversationHistory(token_budget=kwargs.get("history_token_budget", 3000))
+        kwargs.setdefault("account_lookups", new_lookup_cache())
+
         return cls(
             conversation_utterance_chain=conversation_utterance_chain,
             agent_executor=agent_executor,
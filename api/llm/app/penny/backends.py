@@ -0,0 +1,157 @@
+import asyncio
+import os
+import threading
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+
+from penny.clients import get_client
+
+HTTP_TIMEOUT = 300
+
+_http_session = None
+_async_client = None
+# the getters run on request threads, the event loop and the warm-up thread at once
+_lock = threading.Lock()
+
+
+def get_http_session() -> requests.Session:
+    """Shared keep-alive session used by the sync tool path."""
+    global _http_session
+    if _http_session is None:
+        with _lock:
+            if _http_session is None:
+                pool_size = int(os.environ.get("awsMaxPoolConnections", 50))
+                adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+                session = requests.Session()
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                _http_session = session
+    return _http_session
+
+
+def get_async_client() -> httpx.AsyncClient:
+    """Shared keep-alive HTTP client used by the async tool path."""
+    global _async_client
+    if _async_client is None or _async_client.is_closed:
+        with _lock:
+            if _async_client is None or _async_client.is_closed:
+                _async_client = httpx.AsyncClient(timeout=HTTP_TIMEOUT)
+    return _async_client
+
+
+async def close_async_client():
+    if _async_client is not None:
+        await _async_client.aclose()
+
+
+def _api_response(status_code, get_json):
+    if status_code != 200:
+        return {"statusCode": status_code, "body": ""}
+    return get_json()
+
+
+class HttpBackend:
+    """Onboarding operations through API Gateway and the Lambda functions."""
+
+    def __init__(self, api_endpoint):
+        self.api_endpoint = api_endpoint
+
+    def call_api(self, method, path, **kwargs):
+        """Call the onboarding API; returns the Lambda response with its statusCode and body."""
+        r = get_http_session().request(method, self.api_endpoint + path, timeout=HTTP_TIMEOUT, **kwargs)
+        return _api_response(r.status_code, r.json)
+
+    async def acall_api(self, method, path, **kwargs):
+        r = await get_async_client().request(method, self.api_endpoint + path, **kwargs)
+        return _api_response(r.status_code, r.json)
+
+    def get_account(self, email):
+        return self.call_api('GET', '/account', params={'email': email})
+
+    async def aget_account(self, email):
+        return await self.acall_api('GET', '/account', params={'email': email})
+
+    def create_account(self, account):
+        return self.call_api('POST', '/account', json=account)
+
+    async def acreate_account(self, account):
+        return await self.acall_api('POST', '/account', json=account)
+
+    def verify_id(self, file_name, required_field_values):
+        body = {
+            'file_name': file_name,
+            'required_field_values': required_field_values
+        }
+        return self.call_api('POST', '/verifyId', json=body)
+
+    def verify_face(self, id_file_name, selfie_file_name):
+        body = {
+            'id_file_name': id_file_name,
+            'selfie_file_name': selfie_file_name
+        }
+        return self.call_api('POST', '/verifyFace', json=body)
+
+
+class LocalBackend:
+    """
+    Onboarding operations run in-process with the library the Lambda functions use, skipping
+    API Gateway and Lambda cold starts. Uses the shared boto3 clients; the async variants run
+    on the default executor.
+    """
+
+    def __init__(self, table_name, welcome_queue_url, bucket_name):
+        import onboarding
+        import onboarding.faces
+
+        self.onboarding = onboarding
+        self.id_faces = onboarding.faces.IdFaceCache(get_client('rekognition'), get_client('s3'))
+        self.table_name = table_name
+        self.welcome_queue = onboarding.SqsQueue(get_client('sqs'), welcome_queue_url)
+        self.bucket_name = bucket_name
+        self.name_match_threshold = float(os.environ.get("nameMatchThreshold", onboarding.identity.NAME_MATCH_THRESHOLD))
+
+    def get_account(self, email):
+        return self.onboarding.get_account(get_client('dynamodb'), self.table_name, email)
+
+    async def aget_account(self, email):
+        return await asyncio.to_thread(self.get_account, email)
+
+    def create_account(self, account):
+        return self.onboarding.create_account(get_client('dynamodb'), self.welcome_queue, self.table_name, account)
+
+    async def acreate_account(self, account):
+        return await asyncio.to_thread(self.create_account, account)
+
+    def verify_id(self, file_name, required_field_values):
+        return self.onboarding.verify_id(get_client('textract'), self.bucket_name, file_name, required_field_values, self.name_match_threshold)
+
+    def verify_face(self, id_file_name, selfie_file_name):
+        return self.onboarding.faces.verify_face(get_client('rekognition'), self.id_faces, self.bucket_name, id_file_name, selfie_file_name)
+
+
+_backend = None
+
+
+def get_backend():
+    """
+    Backend the onboarding tools call, selected with `toolBackend`: "http" (default) goes
+    through the API, "local" runs the onboarding library in this process.
+    """
+    global _backend
+    if _backend is None:
+        with _lock:
+            if _backend is None:
+                backend = os.environ.get("toolBackend", "http")
+                if backend == "local":
+                    _backend = LocalBackend(
+                        table_name=os.environ["customerTableName"],
+                        welcome_queue_url=os.environ["welcomeQueueUrl"],
+                        bucket_name=os.environ["idBucketName"],
+                    )
+                elif backend == "http":
+                    _backend = HttpBackend(os.environ["apiEndpoint"])
+                else:
+                    raise ValueError("Unknown toolBackend: " + backend)
+    return _backend
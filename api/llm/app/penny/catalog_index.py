@@ -0,0 +1,165 @@
+import csv
+import hashlib
+import json
+import os
+import sys
+import threading
+from typing import Any, Callable, List, Optional, Sequence, Tuple
+
+import numpy as np
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+EMBEDDINGS_FILE = "embeddings.npy"
+CHUNKS_FILE = "chunks.json"
+
+# product descriptions in the catalog run to several KB, so fields are larger than the default limit
+csv.field_size_limit(sys.maxsize)
+
+
+def chunk_catalog(csv_path: str, chunk_size: int = 1000) -> List[Tuple[str, str]]:
+    """
+    Split AnyBankProductCatalog.csv into (product, text) chunks of roughly `chunk_size`
+    characters, breaking on paragraph boundaries and prefixing each chunk with its product
+    so it stays meaningful on its own.
+    """
+    chunks = []
+    with open(csv_path, newline="", encoding="utf-8") as catalog:
+        for row in csv.DictReader(catalog):
+            product = row["product"].strip()
+            paragraphs = [p.strip() for p in row["product information"].split("\n") if p.strip()]
+            current = ""
+            for paragraph in paragraphs:
+                if current and len(current) + len(paragraph) > chunk_size:
+                    chunks.append((product, f"{product}\n{current}"))
+                    current = ""
+                current = f"{current}\n{paragraph}" if current else paragraph
+            if current:
+                chunks.append((product, f"{product}\n{current}"))
+    return chunks
+
+
+def chunk_key(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class SentenceTransformerEmbedder:
+    """Batched CPU embeddings; the model is only loaded on first use."""
+
+    def __init__(self, model_name: str = "sentence-transformers/all-MiniLM-L6-v2", batch_size: int = 64):
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self._model = None
+        self._lock = threading.Lock()
+
+    def __call__(self, texts: Sequence[str]) -> np.ndarray:
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    from sentence_transformers import SentenceTransformer
+
+                    self._model = SentenceTransformer(self.model_name, device="cpu")
+        embeddings = self._model.encode(
+            list(texts), batch_size=self.batch_size, normalize_embeddings=True, show_progress_bar=False
+        )
+        return np.asarray(embeddings, dtype=np.float32)
+
+
+class CatalogIndex:
+    """
+    Dense index over the product catalog.
+
+    Embeddings live in an unit-normalised float32 matrix persisted as `embeddings.npy` and
+    memory-mapped on load, so cosine similarity for every chunk is a single matrix-vector
+    product. When the CSV changes only chunks whose text changed are re-embedded; when the
+    embedding model or its dimension changes every chunk is.
+    """
+
+    def __init__(self, texts: List[str], products: List[str], embeddings: np.ndarray, embed: Callable[[Sequence[str]], np.ndarray]):
+        self.texts = texts
+        self.products = products
+        self.embeddings = embeddings
+        self.embed = embed
+
+    def __len__(self) -> int:
+        return len(self.texts)
+
+    @classmethod
+    def build(
+        cls,
+        csv_path: str,
+        index_dir: str,
+        embed: Callable[[Sequence[str]], np.ndarray],
+        chunk_size: int = 1000,
+        model_name: Optional[str] = None,
+    ) -> "CatalogIndex":
+        """
+        Load the persisted index in `index_dir`, embedding any chunk of `csv_path` it does not have yet.
+        `model_name` (by default the embedder's `model_name` attribute) is stored with the index.
+        """
+        model_name = model_name or getattr(embed, "model_name", None)
+        chunks = chunk_catalog(csv_path, chunk_size)
+        keys = [chunk_key(text) for _, text in chunks]
+
+        embeddings_path = os.path.join(index_dir, EMBEDDINGS_FILE)
+        chunks_path = os.path.join(index_dir, CHUNKS_FILE)
+        previous_rows = {}
+        previous = None
+        if os.path.exists(embeddings_path) and os.path.exists(chunks_path):
+            with open(chunks_path, encoding="utf-8") as f:
+                metadata = json.load(f)
+            previous = np.load(embeddings_path, mmap_mode="r")
+            # vectors of another model, or of another size, are not comparable with the new ones
+            if metadata.get("model") == model_name and metadata.get("dimension") == previous.shape[1]:
+                if metadata["keys"] == keys:
+                    return cls([text for _, text in chunks], [product for product, _ in chunks], previous, embed)
+                previous_rows = {key: row for row, key in enumerate(metadata["keys"])}
+
+        missing = [i for i, key in enumerate(keys) if key not in previous_rows]
+        fresh = embed([chunks[i][1] for i in missing]) if missing else None
+        if fresh is not None and previous_rows and fresh.shape[1] != previous.shape[1]:
+            previous_rows = {}
+            missing = list(range(len(chunks)))
+            fresh = embed([text for _, text in chunks])
+
+        dimension = fresh.shape[1] if fresh is not None else previous.shape[1]
+        matrix = np.empty((len(chunks), dimension), dtype=np.float32)
+        for i, key in enumerate(keys):
+            if key in previous_rows:
+                matrix[i] = previous[previous_rows[key]]
+        if fresh is not None:
+            matrix[missing] = fresh
+
+        os.makedirs(index_dir, exist_ok=True)
+        # write next to the live files and swap, so a concurrent reader never sees a partial index
+        np.save(embeddings_path + ".tmp.npy", matrix)
+        with open(chunks_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump({"model": model_name, "dimension": dimension, "keys": keys}, f)
+        os.replace(embeddings_path + ".tmp.npy", embeddings_path)
+        os.replace(chunks_path + ".tmp", chunks_path)
+        print(f"Catalog index rebuilt: {len(missing)} of {len(chunks)} chunks embedded")
+
+        return cls([text for _, text in chunks], [product for product, _ in chunks], np.load(embeddings_path, mmap_mode="r"), embed)
+
+    def search(self, query: str, k: int = 4) -> List[Tuple[int, float]]:
+        """Return the (chunk index, cosine similarity) of the `k` best chunks, best first."""
+        query_vector = self.embed([query])[0]
+        scores = self.embeddings @ query_vector
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(int(i), float(scores[i])) for i in top]
+
+
+class LocalCatalogRetriever(BaseRetriever):
+    """Retriever backed by a CatalogIndex; a drop-in, offline alternative to AmazonKendraRetriever."""
+
+    index: Any
+    k: int = 4
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        return [
+            Document(page_content=self.index.texts[i], metadata={"product": self.index.products[i], "score": score})
+            for i, score in self.index.search(query, self.k)
+        ]
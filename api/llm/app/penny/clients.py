@@ -0,0 +1,37 @@
+import os
+import threading
+
+import boto3
+from botocore.config import Config
+
+# one keep-alive connection pool per service, shared by every conversation in the process
+CLIENT_CONFIG = Config(
+    max_pool_connections=int(os.environ.get("awsMaxPoolConnections", 50)),
+    tcp_keepalive=True,
+    retries={"max_attempts": 3, "mode": "standard"},
+)
+
+# Bedrock calls are retried and rate limited by penny.resilience instead
+SERVICE_CONFIGS = {
+    "bedrock-runtime": Config(
+        retries={"max_attempts": 1, "mode": "standard"},
+        read_timeout=int(os.environ.get("bedrockReadTimeoutSeconds", 60)),
+    ),
+}
+
+_clients = {}
+_lock = threading.Lock()
+
+
+def get_client(service_name: str):
+    """Return the process-wide boto3 client for `service_name`, creating it on first use."""
+    client = _clients.get(service_name)
+    if client is None:
+        # boto3's default session is not thread safe, so client creation is serialised
+        with _lock:
+            client = _clients.get(service_name)
+            if client is None:
+                config = CLIENT_CONFIG.merge(SERVICE_CONFIGS[service_name]) if service_name in SERVICE_CONFIGS else CLIENT_CONFIG
+                client = boto3.client(service_name=service_name, config=config)
+                _clients[service_name] = client
+    return client
@@ -0,0 +1,202 @@
+import re
+from collections import deque
+from dataclasses import asdict, dataclass
+from typing import Callable, Deque, Iterator, List, Optional, Tuple
+
+EMAIL_PATTERN = re.compile(r"[\w.+-]+@[\w-]+(?:\.[\w-]+)+")
+ACCOUNT_TYPE_PATTERN = re.compile(r"\b(chequing|checking|savings)\b", re.IGNORECASE)
+UPLOAD_PATTERN = re.compile(r"uploaded file-name: (\S+)")
+# a given name or surname of up to four parts; a question or a sentence is not a name
+NAME_PATTERN = re.compile(r"^[^\W\d_][^\W\d_'.-]*(?:[ '.-][^\W\d_]+){0,3}\.?$")
+
+
+def estimate_tokens(text: str) -> int:
+    """Cheap token estimate for Claude on English text (~4 characters per token)."""
+    return (len(text) + 3) // 4
+
+
+@dataclass
+class OnboardingState:
+    """Onboarding details collected so far in a conversation."""
+
+    email: Optional[str] = None
+    account_type: Optional[str] = None
+    first_name: Optional[str] = None
+    last_name: Optional[str] = None
+    id_file_name: Optional[str] = None
+    selfie_file_name: Optional[str] = None
+    email_validated: bool = False
+    # set only from the IDVerification / SelfieVerification results, never from what Penny says
+    id_verified: bool = False
+    face_verified: bool = False
+    # what Penny asked for last; used to attribute the user's next answer to a slot
+    awaiting: Optional[str] = None
+
+    def observe(self, line: str) -> None:
+        """Update the slots from one new line of the conversation."""
+        speaker, _, text = line.partition(": ")
+        if speaker == "User":
+            self._observe_user(text)
+        elif speaker != "System":
+            self._observe_assistant(text.lower())
+
+    def _observe_user(self, text: str) -> None:
+        upload = UPLOAD_PATTERN.search(text)
+        if upload:
+            if self.id_verified:
+                # a new selfie has to be compared again before the account can be opened
+                self.selfie_file_name = upload.group(1)
+                self.face_verified = False
+            else:
+                self.id_file_name = upload.group(1)
+            return
+
+        email = EMAIL_PATTERN.search(text)
+        if email and self.awaiting == "email":
+            self.email = email.group(0).lower()
+        account_type = ACCOUNT_TYPE_PATTERN.search(text)
+        if account_type and self.awaiting == "account_type":
+            self.account_type = "SAVINGS" if account_type.group(1).lower() == "savings" else "CHEQUING"
+        # only a reply that reads as a name fills the slot, as the stage engine requires to move on
+        name = text.strip()
+        if self.awaiting == "first_name" and NAME_PATTERN.match(name):
+            self.first_name = name
+        elif self.awaiting == "last_name" and NAME_PATTERN.match(name):
+            self.last_name = name
+
+    def _observe_assistant(self, text: str) -> None:
+        if "confirm" in text and self.face_verified:
+            self.awaiting = "confirmation"
+        elif "selfie" in text and self.id_verified:
+            self.awaiting = "selfie"
+        elif "identity document" in text or ("upload" in text and " id" in text):
+            self.awaiting = "id"
+        elif "first name" in text:
+            self.awaiting = "first_name"
+        elif "last name" in text:
+            self.awaiting = "last_name"
+        elif ("chequing" in text and "savings" in text) or "account type" in text:
+            self.awaiting = "account_type"
+            self.email_validated = self.email is not None
+        elif "email" in text and self.email is None:
+            self.awaiting = "email"
+        else:
+            self.awaiting = None
+
+    def record_id_verification(self, file_name: str, verified: bool) -> None:
+        """The result of IDVerification for `file_name`."""
+        self.id_file_name = file_name
+        self.id_verified = verified
+        self.face_verified = False
+        self.awaiting = "selfie" if verified else "id"
+
+    def record_face_verification(self, selfie_file_name: str, verified: bool) -> None:
+        """The result of SelfieVerification for `selfie_file_name`."""
+        self.selfie_file_name = selfie_file_name
+        self.face_verified = verified
+        self.awaiting = "confirmation" if verified else "selfie"
+
+    def ready_to_save(self, id_file_name: str, selfie_file_name: str) -> bool:
+        """Whether an account may be opened with these documents: both were verified in this conversation."""
+        return (
+            self.id_verified and self.face_verified
+            and id_file_name == self.id_file_name and selfie_file_name == self.selfie_file_name
+        )
+
+    def render(self) -> str:
+        collected = ", ".join(
+            f"{name}={value}" for name, value in asdict(self).items() if value not in (None, False) and name != "awaiting"
+        )
+        return "System: Earlier turns were summarised. Onboarding details collected so far: " + (collected or "none")
+
+
+class ConversationHistory:
+    """
+    Conversation history rendered into the prompt, kept within a token budget.
+
+    The rendered text is maintained as a running buffer so appending a turn never re-joins
+    the whole history. When the budget is exceeded the oldest turns are dropped down to
+    `compact_to` of the budget and replaced by a single line summarising the onboarding
+    state extracted from every turn seen so far.
+    """
+
+    def __init__(
+        self,
+        token_budget: int = 3000,
+        keep_recent: int = 6,
+        compact_to: float = 0.6,
+        count_tokens: Callable[[str], int] = estimate_tokens,
+    ):
+        self.token_budget = token_budget
+        self.keep_recent = keep_recent
+        self.compact_to = compact_to
+        self.count_tokens = count_tokens
+        self.state = OnboardingState()
+        self.summarised_turns = 0
+        self._lines: Deque[Tuple[str, int]] = deque()
+        self._summary = ""
+        self._rendered = ""
+        self._tokens = 0
+
+    def __len__(self) -> int:
+        return len(self._lines)
+
+    def __iter__(self) -> Iterator[str]:
+        return (line for line, _ in self._lines)
+
+    @property
+    def tokens(self) -> int:
+        return self._tokens
+
+    def lines(self) -> List[str]:
+        return list(self)
+
+    def append(self, line: str) -> None:
+        self.state.observe(line)
+        tokens = self.count_tokens(line)
+        self._lines.append((line, tokens))
+        self._rendered = f"{self._rendered}\n{line}" if self._rendered else line
+        self._tokens += tokens
+        if self._tokens > self.token_budget:
+            self._compact()
+
+    def render(self) -> str:
+        return self._rendered
+
+    def clear(self) -> None:
+        self.__init__(self.token_budget, self.keep_recent, self.compact_to, self.count_tokens)
+
+    def snapshot(self) -> dict:
+        """The history and collected slots as plain data; token counts are recomputed on restore."""
+        snapshot = {"l": self.lines(), "o": {name: value for name, value in asdict(self.state).items() if value not in (None, False)}}
+        if self._summary:
+            snapshot["m"] = self._summary
+            snapshot["n"] = self.summarised_turns
+        return snapshot
+
+    def restore(self, snapshot: dict) -> None:
+        """Replace the history with one taken by `snapshot`."""
+        self.clear()
+        self.state = OnboardingState(**snapshot["o"])
+        self.summarised_turns = snapshot.get("n", 0)
+        self._summary = snapshot.get("m", "")
+        for line in snapshot["l"]:
+            tokens = self.count_tokens(line)
+            self._lines.append((line, tokens))
+            self._tokens += tokens
+        if self._summary:
+            self._tokens += self.count_tokens(self._summary)
+        self._rendered = "\n".join([self._summary, *self] if self._summary else self)
+
+    def _compact(self) -> None:
+        target = int(self.token_budget * self.compact_to)
+        while self._tokens > target and len(self._lines) > self.keep_recent:
+            _, tokens = self._lines.popleft()
+            self._tokens -= tokens
+            self.summarised_turns += 1
+
+        if self._summary:
+            self._tokens -= self.count_tokens(self._summary)
+        self._summary = self.state.render()
+        self._tokens += self.count_tokens(self._summary)
+        self._rendered = "\n".join([self._summary, *self])
@@ -0,0 +1,133 @@
+import asyncio
+import io
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from functools import partial
+
+import numpy as np
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+from penny.uploads import UploadRejected
+
+# longest side sent to Textract/Rekognition; ID text stays well above the 150 DPI Textract needs
+MAX_SIDE = 2000
+# Rekognition needs faces of at least 50 pixels, so smaller images cannot be verified
+MIN_SIDE = 300
+# variance of the Laplacian at 512 px below which an image is too blurry to read
+MIN_SHARPNESS = 10.0
+JPEG_QUALITY = 90
+SHARPNESS_SIDE = 512
+
+
+class ImageRejected(UploadRejected):
+    """The image cannot be verified as it is; the message tells the user what to change."""
+
+    def __init__(self, message: str):
+        super().__init__(message, status_code=422)
+
+
+@dataclass
+class PreparedImage:
+    data: bytes
+    content_type: str
+    width: int
+    height: int
+    sharpness: float
+
+
+def sharpness(image: Image.Image) -> float:
+    """Variance of the Laplacian of a grayscale thumbnail; low values mean few edges, i.e. blur."""
+    gray = ImageOps.grayscale(image)
+    gray.thumbnail((SHARPNESS_SIDE, SHARPNESS_SIDE))
+    pixels = np.asarray(gray, dtype=np.float32)
+    if min(pixels.shape) < 3:
+        return 0.0
+    laplacian = (
+        pixels[1:-1, :-2] + pixels[1:-1, 2:] + pixels[:-2, 1:-1] + pixels[2:, 1:-1] - 4 * pixels[1:-1, 1:-1]
+    )
+    return float(laplacian.var())
+
+
+def prepare_image(
+    data: bytes,
+    max_side: int = MAX_SIDE,
+    min_side: int = MIN_SIDE,
+    min_sharpness: float = MIN_SHARPNESS,
+    quality: int = JPEG_QUALITY,
+) -> PreparedImage:
+    """
+    Make an uploaded photo ready for Textract and Rekognition: apply its EXIF orientation,
+    downscale it to `max_side`, drop transparency and metadata and re-encode it as JPEG.
+    Raises ImageRejected for images that cannot be decoded safely, or are too small or too blurry to verify.
+
+    Runs in a worker process, so it only takes and returns picklable values.
+    """
+    try:
+        image = Image.open(io.BytesIO(data))
+        image = ImageOps.exif_transpose(image)
+    except (UnidentifiedImageError, OSError):
+        raise ImageRejected("We couldn't read that image. Please upload a PNG or JPEG photo.")
+    except Image.DecompressionBombError:
+        # a small file that would decode to a huge bitmap, far beyond any phone camera
+        raise ImageRejected("That image is too large to process. Please upload a regular photo from your phone or camera.")
+
+    if min(image.size) < min_side:
+        raise ImageRejected(
+            "That image is too small to verify ({}x{} pixels). Please upload a photo at least {} pixels on each side.".format(
+                image.width, image.height, min_side)
+        )
+
+    if image.mode in ("RGBA", "LA", "P"):
+        image = image.convert("RGBA")
+        background = Image.new("RGB", image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel("A"))
+        image = background
+    elif image.mode != "RGB":
+        image = image.convert("RGB")
+
+    image.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+
+    score = sharpness(image)
+    if score < min_sharpness:
+        raise ImageRejected("That photo is too blurry to verify. Please hold the camera steady and upload a sharper photo.")
+
+    output = io.BytesIO()
+    image.save(output, format="JPEG", quality=quality, optimize=True)
+    return PreparedImage(output.getvalue(), "image/jpeg", image.width, image.height, score)
+
+
+def worker_ready() -> bool:
+    return True
+
+
+class ImagePreprocessor:
+    """
+    Prepares uploaded photos in a process pool, so decoding and resizing neither block the
+    event loop nor contend for the GIL with the request threads. PDFs are passed through.
+    """
+
+    def __init__(self, max_workers: int = 2, **options):
+        self.max_workers = max_workers
+        self.options = options
+        self.rejected = 0
+        # "spawn" keeps the workers free of the parent's threads and sockets
+        self._executor = ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn"))
+
+    async def prepare(self, data: bytes, content_type: str) -> PreparedImage:
+        if content_type == "application/pdf":
+            return PreparedImage(data, content_type, 0, 0, 0.0)
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(self._executor, partial(prepare_image, data, **self.options))
+        except ImageRejected:
+            self.rejected += 1
+            raise
+
+    def warm_up(self) -> None:
+        """Start the workers now, so the first upload doesn't wait for them to spawn and import."""
+        for future in [self._executor.submit(worker_ready) for _ in range(self.max_workers)]:
+            future.result()
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,177 @@
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from penny.history import estimate_tokens
+
+# how ProductSearch answers: the retrieval chain's model summarises the passages, the
+# passages go to the agent as they are, or passages when short and a summary otherwise
+PRODUCT_SEARCH_ROUTES = ("synthesize", "passages", "auto")
+
+# words that do not change what a product question is asking for
+FILLER_WORDS = frozenset(
+    "a an the is are was what whats which how do does can could would you your me my i "
+    "please tell about of for to on in at with there any give know".split()
+)
+
+
+def normalize_question(question: str) -> str:
+    """
+    Reduce a question to a cache key: lowercase words without punctuation or filler words,
+    de-duplicated, so "What's the savings interest rate?" and "savings interest rate" share
+    an answer. The words keep their order: "move savings to chequing" and "move chequing to
+    savings" are different questions.
+    """
+    words = re.findall(r"[a-z0-9]+", question.lower().replace("'", ""))
+    keywords = dict.fromkeys(word for word in words if word not in FILLER_WORDS)
+    return " ".join(keywords) or question.strip().lower()
+
+
+class AnswerCache:
+    """Size-bounded LRU of normalised question -> answer, each entry valid for `ttl_seconds`."""
+
+    def __init__(self, max_entries: int = 1024, ttl_seconds: float = 3600, clock: Callable[[], float] = time.monotonic):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, question: str) -> Optional[str]:
+        key = normalize_question(question)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] > self.clock():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            if entry is not None:
+                del self._entries[key]
+                self.evictions += 1
+            self.misses += 1
+            return None
+
+    def put(self, question: str, answer: str) -> None:
+        key = normalize_question(question)
+        with self._lock:
+            self._entries[key] = (answer, self.clock() + self.ttl_seconds)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+def format_passages(documents: List[Any]) -> str:
+    """Retrieved passages as ProductSearch's result, for the agent to answer from."""
+    excerpts = "\n\n".join(document.page_content.strip() for document in documents)
+    return "Excerpts from the AnyBank product catalog:\n\n" + excerpts
+
+
+class KnowledgeBase:
+    """
+    Process-wide product knowledge base.
+
+    The retrieval chain is built once, on first use, by `chain_factory` and answers are
+    served from `cache` when the same question was asked recently.
+
+    The agent rephrases whatever ProductSearch returns, so summarising the passages first
+    costs a second model call per question. With `route="passages"` the retrieved passages
+    are returned as they are; with `route="auto"` they are returned when they fit in
+    `passage_token_budget` and summarised by the chain's model otherwise.
+    """
+
+    def __init__(
+        self,
+        chain_factory: Callable[[], Any],
+        cache: Optional[AnswerCache] = None,
+        route: str = "synthesize",
+        passage_token_budget: int = 600,
+    ):
+        self.chain_factory = chain_factory
+        self.cache = cache
+        self.route = route
+        self.passage_token_budget = passage_token_budget
+        self.passages = 0
+        self.synthesized = 0
+        self._chain = None
+        self._lock = threading.Lock()
+
+    @property
+    def chain(self):
+        if self._chain is None:
+            with self._lock:
+                if self._chain is None:
+                    self._chain = self.chain_factory()
+        return self._chain
+
+    def run(self, question: str) -> str:
+        answer = self.cache.get(question) if self.cache else None
+        if answer is None:
+            answer = self._answer(question)
+            if self.cache:
+                self.cache.put(question, answer)
+        return answer
+
+    async def arun(self, question: str) -> str:
+        answer = self.cache.get(question) if self.cache else None
+        if answer is None:
+            answer = await self._aanswer(question)
+            if self.cache:
+                self.cache.put(question, answer)
+        return answer
+
+    def _answer(self, question: str) -> str:
+        if self.route == "synthesize":
+            self._count("synthesized")
+            return self.chain.run(question)
+        documents = self.chain.retriever.invoke(question)
+        passages = format_passages(documents)
+        if self._use_passages(passages):
+            return passages
+        # the passages already retrieved are summarised; the chain doesn't search again
+        return self.chain.combine_documents_chain.run(input_documents=documents, question=question)
+
+    async def _aanswer(self, question: str) -> str:
+        if self.route == "synthesize":
+            self._count("synthesized")
+            return await self.chain.arun(question)
+        documents = await self.chain.retriever.ainvoke(question)
+        passages = format_passages(documents)
+        if self._use_passages(passages):
+            return passages
+        return await self.chain.combine_documents_chain.arun(input_documents=documents, question=question)
+
+    def _use_passages(self, passages: str) -> bool:
+        if self.route == "passages" or estimate_tokens(passages) <= self.passage_token_budget:
+            self._count("passages")
+            return True
+        self._count("synthesized")
+        return False
+
+    def _count(self, route: str) -> None:
+        with self._lock:
+            setattr(self, route, getattr(self, route) + 1)
+
+    def stats(self) -> Dict[str, Any]:
+        stats = self.cache.stats() if self.cache else {}
+        stats["answered_from"] = {"passages": self.passages, "synthesized": self.synthesized}
+        return stats
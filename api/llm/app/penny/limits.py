@@ -0,0 +1,100 @@
+import asyncio
+import math
+import time
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Callable, Dict
+
+
+class Overloaded(Exception):
+    """The worker already has as many turns running and queued as it accepts."""
+
+    status_code = 429
+
+    def __init__(self, retry_after: int):
+        super().__init__("Penny is busy right now. Please try again in a few seconds.")
+        self.retry_after = retry_after
+
+
+class ConcurrencyLimiter:
+    """
+    Caps the conversation turns in progress in one worker, and so its concurrent Bedrock
+    calls: a turn makes its model calls one after another.
+
+    Turns beyond `max_concurrent` wait in turn order; a turn that finds `max_queue` turns
+    already waiting, or waits longer than `queue_timeout`, is rejected with Overloaded and
+    a Retry-After estimated from recent turn durations, instead of adding to Bedrock
+    throttling. Slots are taken before the conversation is touched, so a rejected turn can
+    simply be sent again.
+    """
+
+    def __init__(
+        self,
+        max_concurrent: int = 16,
+        max_queue: int = 32,
+        queue_timeout: float = 10,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.clock = clock
+        self.active = 0
+        self.waiting = 0
+        self.rejected = 0
+        self.completed = 0
+        # moving average of how long a turn holds its slot
+        self.turn_seconds = 1.0
+        self._semaphore = None
+
+    def _get_semaphore(self) -> asyncio.Semaphore:
+        # created on first use, inside the worker's event loop
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrent)
+        return self._semaphore
+
+    async def acquire(self) -> float:
+        """Wait for a slot; returns the time it was granted, to pass to `release`."""
+        # counted here rather than read off the semaphore, which only updates once the
+        # waiting turns get to run
+        if self.active + self.waiting >= self.max_concurrent + self.max_queue:
+            self.rejected += 1
+            raise Overloaded(self.retry_after())
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self._get_semaphore().acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            raise Overloaded(self.retry_after())
+        finally:
+            self.waiting -= 1
+        self.active += 1
+        return self.clock()
+
+    def release(self, granted_at: float) -> None:
+        self.active -= 1
+        self.completed += 1
+        self.turn_seconds += 0.1 * (self.clock() - granted_at - self.turn_seconds)
+        self._get_semaphore().release()
+
+    @asynccontextmanager
+    async def slot(self) -> AsyncIterator[None]:
+        granted_at = await self.acquire()
+        try:
+            yield
+        finally:
+            self.release(granted_at)
+
+    def retry_after(self) -> int:
+        """Seconds until the turns ahead of a new one have likely finished."""
+        rounds = (self.active + self.waiting + 1) / self.max_concurrent
+        return max(1, min(60, math.ceil(rounds * self.turn_seconds)))
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "max_concurrent": self.max_concurrent,
+            "active": self.active,
+            "waiting": self.waiting,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "turn_seconds": round(self.turn_seconds, 3),
+        }
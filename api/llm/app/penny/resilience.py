@@ -0,0 +1,409 @@
+"""
+Resilience for Bedrock calls. Every model call the service makes (the agent's BedrockChat,
+the tool-calling agent and the product search chain) goes through one `ResilientBedrock`
+per worker, which wraps the bedrock-runtime client with:
+
+- an adaptive client-side rate limit: a token bucket whose rate drops when Bedrock throttles
+  and creeps back up while calls succeed;
+- retries with exponential backoff and full jitter on throttling, timeouts and 5xx errors;
+- optional hedging: a second identical request when the first has not answered in time;
+- an optional fallback model, called when the requested model is still failing after its
+  retries, and for a while after that without trying the failing model first;
+- per-model latency and error statistics.
+
+A turn can also ask for a smaller, faster model with `model_scope` (PennyAgent does for the
+greeting and the answers to prompts for the next detail), without the chains knowing about
+it; a chain that picks its own model, like the product search, opts out with
+`model_scope(None)`.
+"""
+import os
+import random
+import statistics
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+from typing import Any, Callable, Dict, Iterator, Optional
+
+from botocore.exceptions import ClientError, ConnectionError, HTTPClientError
+
+from penny.clients import get_client
+from penny.telemetry import bedrock_latency
+
+THROTTLING_ERRORS = {"ThrottlingException", "TooManyRequestsException", "ServiceQuotaExceededException"}
+RETRYABLE_ERRORS = THROTTLING_ERRORS | {
+    "ServiceUnavailableException",
+    "InternalServerException",
+    "ModelNotReadyException",
+    "ModelTimeoutException",
+    "ConnectionError",
+}
+
+# model the running turn asked for, in place of the one its chain was built with
+_preferred_model: ContextVar = ContextVar("preferred_model", default=None)
+
+
+@contextmanager
+def model_scope(model_id: Optional[str]) -> Iterator[None]:
+    """Send the Bedrock calls made in this context to `model_id` (None keeps each chain's own model)."""
+    token = _preferred_model.set(model_id)
+    try:
+        yield
+    finally:
+        _preferred_model.reset(token)
+
+
+def error_code(error: Exception) -> str:
+    if isinstance(error, ClientError):
+        return error.response.get("Error", {}).get("Code", "ClientError")
+    if isinstance(error, (ConnectionError, HTTPClientError)):
+        return "ConnectionError"
+    return type(error).__name__
+
+
+def is_throttling(error: BaseException) -> bool:
+    """Whether `error` is Bedrock throttling, including when a chain raised another error in its place."""
+    seen = set()
+    while error is not None and id(error) not in seen:
+        if error_code(error) in THROTTLING_ERRORS:
+            return True
+        seen.add(id(error))
+        error = error.__cause__ or error.__context__
+    return False
+
+
+class AdaptiveRateLimiter:
+    """
+    Token bucket in front of Bedrock. Without `max_rate` calls go out unlimited until the
+    first throttle. From then on the rate is cut by `DECREASE` on a throttle, and raised by
+    about `INCREASE` requests/s per second of successful calls, up to `max_rate` or twice
+    the rate calls are actually being sent at. The rate is cut at most once a second, and
+    not for requests sent before the last cut, as Bedrock's quota only shows a cut once the
+    requests before it are out of its window; a burst of throttles counts once.
+    """
+
+    DECREASE = 0.7
+    INCREASE = 0.5
+    CUT_INTERVAL_SECONDS = 1
+    WINDOW_SECONDS = 10
+
+    def __init__(
+        self,
+        max_rate: Optional[float] = None,
+        min_rate: float = 0.5,
+        clock: Callable[[], float] = time.monotonic,
+        sleep: Callable[[float], None] = time.sleep,
+    ):
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.clock = clock
+        self.sleep = sleep
+        self.rate = max_rate
+        self.tokens = max_rate or 0.0
+        self.throttles = 0
+        self.waited_seconds = 0.0
+        self._cut_at = None
+        self._refilled_at = clock()
+        self._sent = deque()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> float:
+        """Take a token, waiting while the bucket is empty; returns when the request may be sent."""
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = self.clock()
+                if self.rate is not None:
+                    self._refill(now)
+                if self.rate is None or self.tokens >= 1:
+                    if self.rate is not None:
+                        self.tokens -= 1
+                    self._record_send(now)
+                    self.waited_seconds += waited
+                    return now
+                # looked at again at least every second, so a new rate applies to waiting calls too
+                delay = min(1.0, (1 - self.tokens) / self.rate)
+            self.sleep(delay)
+            waited += delay
+
+    def try_acquire(self) -> bool:
+        """Take a token only if one is available right away (used for hedged requests)."""
+        with self._lock:
+            now = self.clock()
+            if self.rate is not None:
+                self._refill(now)
+                if self.tokens < 1:
+                    return False
+                self.tokens -= 1
+            self._record_send(now)
+            return True
+
+    def throttled(self, sent_at: float) -> None:
+        """Bedrock throttled a request sent at `sent_at` (as returned by `acquire`)."""
+        with self._lock:
+            self.throttles += 1
+            now = self.clock()
+            if self._cut_at is not None and (sent_at < self._cut_at or now - self._cut_at < self.CUT_INTERVAL_SECONDS):
+                return
+            current = self._send_rate(now) if self.rate is None else min(self.rate, self._send_rate(now))
+            self.rate = max(self.min_rate, current * self.DECREASE)
+            # no burst straight after a throttle
+            self.tokens = min(self.tokens, 0.0)
+            self._refilled_at = self._cut_at = now
+
+    def succeeded(self) -> None:
+        with self._lock:
+            if self.rate is None:
+                return
+            ceiling = self.max_rate or 2 * self._send_rate(self.clock())
+            # calls at `rate` succeed 1/rate seconds apart, so this adds ~INCREASE per second
+            self.rate = min(self.rate + self.INCREASE / self.rate, max(self.rate, ceiling))
+
+    def _refill(self, now: float) -> None:
+        # up to a second's worth of calls can go out in a burst
+        self.tokens = min(max(1.0, self.rate), self.tokens + (now - self._refilled_at) * self.rate)
+        self._refilled_at = now
+
+    def _record_send(self, now: float) -> None:
+        self._sent.append(now)
+        while self._sent and self._sent[0] < now - self.WINDOW_SECONDS:
+            self._sent.popleft()
+
+    def _send_rate(self, now: float) -> float:
+        if not self._sent:
+            return self.min_rate
+        return max(self.min_rate, len(self._sent) / max(1.0, min(self.WINDOW_SECONDS, now - self._sent[0])))
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "requests_per_second": None if self.rate is None else round(self.rate, 2),
+            "max_requests_per_second": self.max_rate,
+            "throttles": self.throttles,
+            "waited_seconds": round(self.waited_seconds, 3),
+        }
+
+
+class ModelStats:
+    """Calls, errors and latency of one model, as seen by this worker."""
+
+    def __init__(self, samples: int = 512):
+        self.calls = 0
+        self.retries = 0
+        self.hedged = 0
+        self.hedges_won = 0
+        self.fallbacks = 0
+        self.errors = Counter()
+        # seconds to a complete response, or to the start of the stream for streaming calls
+        self.latencies = deque(maxlen=samples)
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float, error: Optional[str] = None) -> None:
+        with self._lock:
+            self.calls += 1
+            if error is None:
+                self.latencies.append(seconds)
+            else:
+                self.errors[error] += 1
+
+    def add(self, counter: str) -> None:
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            latencies = sorted(self.latencies)
+            stats = {
+                "calls": self.calls,
+                "errors": dict(self.errors),
+                "retries": self.retries,
+                "hedged": self.hedged,
+                "hedges_won": self.hedges_won,
+                "fallbacks": self.fallbacks,
+            }
+        if latencies:
+            stats["p50_ms"] = round(statistics.median(latencies) * 1000, 1)
+            stats["p95_ms"] = round(latencies[min(len(latencies) - 1, int(0.95 * len(latencies)))] * 1000, 1)
+        return stats
+
+
+class ResilientBedrock:
+    """
+    Drop-in for the bedrock-runtime client: `invoke_model` and
+    `invoke_model_with_response_stream` get the rate limit, retries, hedging and fallback,
+    any other operation is passed through. The wrapped client should not retry itself
+    (see penny.clients).
+
+    Errors that are not worth retrying (e.g. a ValidationException) are raised at once, and
+    a call that still fails after its retries and the fallback raises the last error, as the
+    client would have. A streaming call is retried until its stream has started; an error
+    in the middle of a stream reaches the caller.
+    """
+
+    def __init__(
+        self,
+        client,
+        rate_limiter: Optional[AdaptiveRateLimiter] = None,
+        max_attempts: int = 4,
+        backoff_base: float = 0.25,
+        backoff_cap: float = 8.0,
+        hedge_after: Optional[float] = None,
+        fallback_model_id: Optional[str] = None,
+        fallback_seconds: float = 30,
+        hedge_workers: int = 64,
+        clock: Callable[[], float] = time.monotonic,
+        sleep: Callable[[float], None] = time.sleep,
+        seed: Optional[int] = None,
+    ):
+        self.client = client
+        self.rate_limiter = rate_limiter or AdaptiveRateLimiter()
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.hedge_after = hedge_after
+        self.fallback_model_id = fallback_model_id
+        self.fallback_seconds = fallback_seconds
+        self.clock = clock
+        self.sleep = sleep
+        self.models: Dict[str, ModelStats] = {}
+        # models that failed every attempt, and until when their calls go to the fallback model
+        self._unavailable_until: Dict[str, float] = {}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        # hedged calls run both requests here while the caller waits for the first answer
+        self._hedges = ThreadPoolExecutor(max_workers=hedge_workers, thread_name_prefix="bedrock-hedge") if hedge_after else None
+
+    def invoke_model(self, **kwargs):
+        return self._invoke("invoke_model", kwargs)
+
+    def invoke_model_with_response_stream(self, **kwargs):
+        return self._invoke("invoke_model_with_response_stream", kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def _invoke(self, operation: str, kwargs: Dict[str, Any]):
+        model_id = _preferred_model.get() or kwargs["modelId"]
+        if self.fallback_model_id in (None, model_id):
+            return self._with_retries(operation, dict(kwargs, modelId=model_id))
+        if self.clock() < self._unavailable_until.get(model_id, 0):
+            self._stats(model_id).add("fallbacks")
+            return self._with_retries(operation, dict(kwargs, modelId=self.fallback_model_id))
+        try:
+            return self._with_retries(operation, dict(kwargs, modelId=model_id))
+        except Exception as e:
+            if error_code(e) not in RETRYABLE_ERRORS:
+                raise
+            if self._unavailable_until.get(model_id, 0) <= self.clock():
+                print("Bedrock model " + model_id + " unavailable (" + error_code(e) + "), falling back to " + self.fallback_model_id)
+            self._unavailable_until[model_id] = self.clock() + self.fallback_seconds
+            self._stats(model_id).add("fallbacks")
+            return self._with_retries(operation, dict(kwargs, modelId=self.fallback_model_id))
+
+    def _with_retries(self, operation: str, kwargs: Dict[str, Any]):
+        stats = self._stats(kwargs["modelId"])
+        for attempt in range(1, self.max_attempts + 1):
+            sent_at = self.rate_limiter.acquire()
+            try:
+                response = self._call(operation, kwargs, stats)
+            except Exception as e:
+                code = error_code(e)
+                if code in THROTTLING_ERRORS:
+                    self.rate_limiter.throttled(sent_at)
+                if code not in RETRYABLE_ERRORS or attempt == self.max_attempts:
+                    raise
+                stats.add("retries")
+                self.sleep(self.backoff(attempt))
+            else:
+                self.rate_limiter.succeeded()
+                return response
+
+    def backoff(self, attempt: int) -> float:
+        """Full jitter: anywhere between no wait and the exponential backoff for this attempt."""
+        with self._lock:
+            return self._random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** (attempt - 1)))
+
+    def _call(self, operation: str, kwargs: Dict[str, Any], stats: ModelStats):
+        if self._hedges is None:
+            return self._timed(operation, kwargs, stats)
+
+        primary = self._hedges.submit(copy_context().run, self._timed, operation, kwargs, stats)
+        done, _ = wait([primary], timeout=self.hedge_after)
+        # a hedge is only sent when the rate limit has room for it, so it never adds to throttling
+        if done or not self.rate_limiter.try_acquire():
+            return primary.result()
+
+        stats.add("hedged")
+        hedge = self._hedges.submit(copy_context().run, self._timed, operation, kwargs, stats)
+        pending = {primary, hedge}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is hedge:
+                        stats.add("hedges_won")
+                    for other in pending:
+                        other.add_done_callback(close_unused)
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    def _timed(self, operation: str, kwargs: Dict[str, Any], stats: ModelStats):
+        started = self.clock()
+        try:
+            response = getattr(self.client, operation)(**kwargs)
+        except Exception as e:
+            stats.record(self.clock() - started, error_code(e))
+            bedrock_latency.observe(self.clock() - started, model=kwargs["modelId"], outcome=error_code(e))
+            raise
+        stats.record(self.clock() - started)
+        bedrock_latency.observe(self.clock() - started, model=kwargs["modelId"], outcome="ok")
+        return response
+
+    def _stats(self, model_id: str) -> ModelStats:
+        with self._lock:
+            if model_id not in self.models:
+                self.models[model_id] = ModelStats()
+            return self.models[model_id]
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            models = dict(self.models)
+        return {
+            "rate_limit": self.rate_limiter.stats(),
+            "models": {model_id: model.snapshot() for model_id, model in models.items()},
+        }
+
+    def shutdown(self) -> None:
+        if self._hedges is not None:
+            self._hedges.shutdown(wait=False)
+
+
+def close_unused(future) -> None:
+    # the slower of two hedged streaming calls: its stream would otherwise stay open
+    if future.exception() is None:
+        close = getattr(future.result().get("body"), "close", None)
+        if close is not None:
+            close()
+
+
+_bedrock = None
+_bedrock_lock = threading.Lock()
+
+
+def get_bedrock_client() -> ResilientBedrock:
+    """The process-wide Bedrock client every model call goes through, configured from the environment."""
+    global _bedrock
+    with _bedrock_lock:
+        if _bedrock is None:
+            hedge_after_ms = float(os.environ.get("bedrockHedgeAfterMs", 0))
+            _bedrock = ResilientBedrock(
+                get_client("bedrock-runtime"),
+                rate_limiter=AdaptiveRateLimiter(max_rate=float(os.environ.get("bedrockRequestsPerSecond", 0)) or None),
+                max_attempts=int(os.environ.get("bedrockMaxAttempts", 4)),
+                hedge_after=hedge_after_ms / 1000 if hedge_after_ms > 0 else None,
+                fallback_model_id=os.environ.get("bedrockFallbackModel") or None,
+            )
+    return _bedrock
@@ -0,0 +1,290 @@
+import json
+import os
+import random
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from botocore.exceptions import ClientError
+
+from penny.clients import get_client
+
+SNAPSHOT_FORMAT = 1
+
+
+def encode_snapshot(version: int, snapshot: Dict[str, Any]) -> bytes:
+    """Compact form of a conversation snapshot: minified JSON, zlib-compressed."""
+    document = {"f": SNAPSHOT_FORMAT, "v": version, "a": snapshot}
+    return zlib.compress(json.dumps(document, separators=(",", ":"), ensure_ascii=False).encode("utf-8"))
+
+
+def decode_snapshot(data: bytes) -> Tuple[int, Dict[str, Any]]:
+    """(version, snapshot) from `encode_snapshot`'s output."""
+    document = json.loads(zlib.decompress(data).decode("utf-8"))
+    if document["f"] != SNAPSHOT_FORMAT:
+        raise ValueError("Unknown session snapshot format: {}".format(document["f"]))
+    return document["v"], document["a"]
+
+
+class MemorySessionStore:
+    """
+    In-process stand-in for the external stores, for tests and benchmarks. Registries sharing
+    one instance behave like service tasks sharing a table.
+    """
+
+    def __init__(self, clock: Callable[[], float] = time.time):
+        self.clock = clock
+        # session id -> (version, snapshot, expiry time)
+        self._items: Dict[str, Tuple[int, bytes, float]] = {}
+        self._lock = threading.Lock()
+
+    def load(self, session_id: str) -> Optional[bytes]:
+        with self._lock:
+            item = self._items.get(session_id)
+            if item is None or item[2] <= self.clock():
+                return None
+            return item[1]
+
+    def save(self, session_id: str, version: int, data: bytes, ttl_seconds: float) -> bool:
+        with self._lock:
+            item = self._items.get(session_id)
+            if item is not None and item[0] >= version:
+                return False
+            self._items[session_id] = (version, data, self.clock() + ttl_seconds)
+            return True
+
+    def delete(self, session_id: str) -> None:
+        with self._lock:
+            self._items.pop(session_id, None)
+
+
+class DynamoDBSessionStore:
+    """
+    One item per session: the snapshot, its version and an `expiresAt` TTL attribute. Writes
+    are conditional on the version, so a late write never replaces a newer turn.
+    """
+
+    def __init__(self, client, table_name: str, clock: Callable[[], float] = time.time):
+        self.client = client
+        self.table_name = table_name
+        self.clock = clock
+
+    def load(self, session_id: str) -> Optional[bytes]:
+        item = self.client.get_item(
+            TableName=self.table_name, Key={"sessionId": {"S": session_id}}, ConsistentRead=True
+        ).get("Item")
+        # DynamoDB deletes expired items lazily, so they can still be read for a while
+        if item is None or int(item["expiresAt"]["N"]) <= self.clock():
+            return None
+        return item["state"]["B"]
+
+    def save(self, session_id: str, version: int, data: bytes, ttl_seconds: float) -> bool:
+        try:
+            self.client.put_item(
+                TableName=self.table_name,
+                Item={
+                    "sessionId": {"S": session_id},
+                    "version": {"N": str(version)},
+                    "state": {"B": data},
+                    "expiresAt": {"N": str(int(self.clock() + ttl_seconds))},
+                },
+                ConditionExpression="attribute_not_exists(sessionId) OR version < :version",
+                ExpressionAttributeValues={":version": {"N": str(version)}},
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
+                return False
+            raise
+        return True
+
+    def delete(self, session_id: str) -> None:
+        self.client.delete_item(TableName=self.table_name, Key={"sessionId": {"S": session_id}})
+
+
+class RedisSessionStore:
+    """
+    Snapshots in a Redis-compatible store (e.g. ElastiCache), expiring with the session. The
+    version check and write run as one script, so a late write never replaces a newer turn.
+    """
+
+    SAVE_SCRIPT = """
+    local current = redis.call('GET', KEYS[2])
+    if current and tonumber(current) >= tonumber(ARGV[1]) then return 0 end
+    redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[3])
+    redis.call('SET', KEYS[2], ARGV[1], 'EX', ARGV[3])
+    return 1
+    """
+
+    def __init__(self, client, prefix: str = "penny:session:"):
+        self.client = client
+        self.prefix = prefix
+        self._save = client.register_script(self.SAVE_SCRIPT)
+
+    def load(self, session_id: str) -> Optional[bytes]:
+        return self.client.get(self.prefix + session_id)
+
+    def save(self, session_id: str, version: int, data: bytes, ttl_seconds: float) -> bool:
+        key = self.prefix + session_id
+        return bool(self._save(keys=[key, key + ":version"], args=[version, data, max(1, int(ttl_seconds))]))
+
+    def delete(self, session_id: str) -> None:
+        key = self.prefix + session_id
+        self.client.delete(key, key + ":version")
+
+
+def get_session_store():
+    """
+    Store for conversation state, selected with `sessionStore`: "memory" (default) keeps
+    conversations in this process only, "dynamodb" uses the `sessionTableName` table and
+    "redis" the Redis-compatible server at `redisUrl` (needs the redis package).
+    """
+    backend = os.environ.get("sessionStore", "memory")
+    if backend == "memory":
+        return None
+    if backend == "dynamodb":
+        return DynamoDBSessionStore(get_client('dynamodb'), os.environ["sessionTableName"])
+    if backend == "redis":
+        import redis
+
+        return RedisSessionStore(redis.Redis.from_url(os.environ["redisUrl"]))
+    raise ValueError("Unknown sessionStore: " + backend)
+
+
+class WriteBehind:
+    """
+    Writes session snapshots to a store from a background thread, so requests never wait on
+    the store. Only the latest snapshot of a session is kept while its write is pending, so
+    a session costs at most one write per turn. A failed write is retried with exponential
+    backoff; a snapshot that still cannot be written is remembered as unwritten, so the
+    registry keeps serving it from memory instead of the store's older state.
+    """
+
+    def __init__(
+        self,
+        store,
+        ttl_seconds: float,
+        max_attempts: int = 5,
+        retry_base_seconds: float = 0.2,
+        retry_max_seconds: float = 5.0,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.store = store
+        self.ttl_seconds = ttl_seconds
+        self.max_attempts = max_attempts
+        self.retry_base_seconds = retry_base_seconds
+        self.retry_max_seconds = retry_max_seconds
+        self.clock = clock
+        self.writes = 0
+        self.stale_writes = 0
+        self.failures = 0
+        self.abandoned = 0
+        # session id -> (version, snapshot), or None to delete the session
+        self._pending: "OrderedDict[str, Optional[Tuple[int, bytes]]]" = OrderedDict()
+        # session id -> (failed attempts, earliest time of the next one) for writes being retried
+        self._retries: Dict[str, Tuple[int, float]] = {}
+        # session id -> version of the snapshot given up on
+        self._unwritten: Dict[str, int] = {}
+        self._in_flight: Optional[str] = None
+        self._closed = False
+        self._condition = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self._random = random.Random()
+
+    def submit(self, session_id: str, version: int, data: bytes) -> None:
+        self._put(session_id, (version, data))
+
+    def delete(self, session_id: str) -> None:
+        self._put(session_id, None)
+
+    def pending(self, session_id: str) -> bool:
+        """Whether this process holds a newer state of the session than the store."""
+        with self._condition:
+            return session_id in self._pending or session_id == self._in_flight
+
+    def unwritten_version(self, session_id: str) -> Optional[int]:
+        """Version of the session's latest snapshot if its write was given up on."""
+        with self._condition:
+            return self._unwritten.get(session_id)
+
+    def backlog(self) -> int:
+        with self._condition:
+            return len(self._pending)
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Wait until every submitted snapshot is written or given up on; False on timeout."""
+        with self._condition:
+            return self._condition.wait_for(lambda: not self._pending and self._in_flight is None, timeout)
+
+    def close(self, timeout: Optional[float] = 10) -> None:
+        self.flush(timeout)
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+    def _put(self, session_id: str, entry: Optional[Tuple[int, bytes]]) -> None:
+        with self._condition:
+            self._pending[session_id] = entry
+            self._pending.move_to_end(session_id)
+            self._retries.pop(session_id, None)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="session-writer", daemon=True)
+                self._thread.start()
+            self._condition.notify_all()
+
+    def _next(self) -> Optional[str]:
+        """The oldest session whose write is due, waiting for one; None once closed."""
+        while True:
+            now = self.clock()
+            for session_id in self._pending:
+                if session_id not in self._retries or self._retries[session_id][1] <= now:
+                    return session_id
+            if self._closed:
+                return None
+            retry_times = [retry_at for _, retry_at in self._retries.values()]
+            self._condition.wait(min(retry_times) - now if retry_times else None)
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                session_id = self._next()
+                if session_id is None:
+                    return
+                entry = self._pending.pop(session_id)
+                self._in_flight = session_id
+            try:
+                if entry is None:
+                    self.store.delete(session_id)
+                elif self.store.save(session_id, entry[0], entry[1], self.ttl_seconds):
+                    self.writes += 1
+                else:
+                    self.stale_writes += 1
+                with self._condition:
+                    self._retries.pop(session_id, None)
+                    self._unwritten.pop(session_id, None)
+            except Exception as e:
+                self.failures += 1
+                self._failed(session_id, entry, e)
+            finally:
+                with self._condition:
+                    self._in_flight = None
+                    self._condition.notify_all()
+
+    def _failed(self, session_id: str, entry: Optional[Tuple[int, bytes]], error: Exception) -> None:
+        with self._condition:
+            if session_id in self._pending:
+                # a newer turn was submitted meanwhile and replaces this snapshot
+                return
+            attempts = self._retries.pop(session_id, (0, 0))[0] + 1
+            if attempts < self.max_attempts:
+                # full jitter, so tasks that lost the store together do not retry together
+                delay = self._random.uniform(0, min(self.retry_max_seconds, self.retry_base_seconds * 2 ** attempts))
+                self._pending[session_id] = entry
+                self._retries[session_id] = (attempts, self.clock() + delay)
+                print("Session write failed, retrying: " + type(error).__name__ + ": " + str(error))
+                return
+            self.abandoned += 1
+            if entry is not None:
+                self._unwritten[session_id] = entry[0]
+            print("Session write failed " + str(attempts) + " times, keeping the session in memory: " + type(error).__name__ + ": " + str(error))
@@ -0,0 +1,240 @@
+import asyncio
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Callable, Dict, List, Optional, Tuple
+
+from penny.PennyAgent import PennyAgent
+from penny.session_store import WriteBehind, decode_snapshot, encode_snapshot
+
+SESSION_ID_PATTERN = re.compile(r"^[A-Za-z0-9-]{8,64}$")
+
+# rough fixed cost of one PennyAgent (pydantic model, lists, bookkeeping) on top of its history
+SESSION_BASE_BYTES = 4 * 1024
+
+
+def new_session_id() -> str:
+    return uuid.uuid4().hex
+
+
+def is_valid_session_id(session_id: Optional[str]) -> bool:
+    return bool(session_id) and SESSION_ID_PATTERN.match(session_id) is not None
+
+
+def estimate_agent_bytes(agent: PennyAgent) -> int:
+    """Approximate memory held by one conversation."""
+    return SESSION_BASE_BYTES + len(agent.history.render())
+
+
+class SessionRegistry:
+    """
+    Session-keyed store of PennyAgents with LRU + idle-TTL eviction and a memory cap.
+
+    Every agent is created by `agent_factory`, which is expected to hand out agents sharing
+    one prebuilt AgentExecutor and tool set (see PennyAgent.spawn), so a new session only
+    costs its own conversation history.
+
+    With a `store` (see penny.session_store) the registry is a cache in front of it: `save`
+    writes each turn's snapshot behind the response, and `get` continues from the store
+    whenever another task served a later turn, so no sticky sessions are needed and a task
+    restart loses no conversation.
+
+    The turns of one session run one at a time (see `turn`), so a retried or doubled request
+    never steps the same agent concurrently.
+    """
+
+    def __init__(
+        self,
+        agent_factory: Callable[[], PennyAgent],
+        max_sessions: int = 500,
+        idle_ttl_seconds: float = 1800,
+        max_memory_bytes: int = 256 * 1024 * 1024,
+        clock: Callable[[], float] = time.monotonic,
+        store=None,
+    ):
+        self.agent_factory = agent_factory
+        self.max_sessions = max_sessions
+        self.idle_ttl_seconds = idle_ttl_seconds
+        self.max_memory_bytes = max_memory_bytes
+        self.clock = clock
+        self.evictions = 0
+        self.restores = 0
+        self.store = store
+        self.writer = WriteBehind(store, idle_ttl_seconds) if store is not None else None
+        # session id -> (agent, last access time, estimated bytes); ordered from least to most recently used
+        self._sessions: "OrderedDict[str, Tuple[PennyAgent, float, int]]" = OrderedDict()
+        # running total of the sessions' estimated bytes, so the memory cap costs nothing to check
+        self._memory_bytes = 0
+        # session id -> [turn lock, requests holding or waiting for it]
+        self._turn_locks: Dict[str, List] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def __contains__(self, session_id: str) -> bool:
+        return session_id in self._sessions
+
+    def create(self, session_id: Optional[str] = None) -> Tuple[str, PennyAgent]:
+        """Start a fresh conversation, replacing any existing one under the same id."""
+        session_id = session_id or new_session_id()
+        agent = self.agent_factory()
+        agent.seed_agent()
+        with self._lock:
+            self._put(session_id, agent)
+            self._evict()
+        return session_id, agent
+
+    def get(self, session_id: str) -> Optional[PennyAgent]:
+        with self._lock:
+            self._evict_expired()
+            entry = self._sessions.get(session_id)
+        agent = entry[0] if entry is not None else None
+        if self.store is not None and not self.writer.pending(session_id):
+            agent = self._load(session_id, agent)
+        if agent is None:
+            return None
+        with self._lock:
+            self._put(session_id, agent)
+            self._evict()
+            return agent
+
+    async def acquire_turn(self, session_id: str) -> List:
+        """Wait until no other turn of the session is running; pass the result to `release_turn`."""
+        with self._lock:
+            turn = self._turn_locks.get(session_id)
+            if turn is None:
+                turn = self._turn_locks[session_id] = [asyncio.Lock(), 0]
+            turn[1] += 1
+        try:
+            await turn[0].acquire()
+        except BaseException:
+            self._leave_turn(session_id, turn)
+            raise
+        return turn
+
+    def release_turn(self, session_id: str, turn: List) -> None:
+        turn[0].release()
+        self._leave_turn(session_id, turn)
+
+    @asynccontextmanager
+    async def turn(self, session_id: str) -> AsyncIterator[None]:
+        """Hold the session's turn lock, from loading its agent until its turn is saved."""
+        turn = await self.acquire_turn(session_id)
+        try:
+            yield
+        finally:
+            self.release_turn(session_id, turn)
+
+    def _leave_turn(self, session_id: str, turn: List) -> None:
+        with self._lock:
+            turn[1] -= 1
+            # kept while the session is cached; an evicted session's lock goes with its last request
+            if turn[1] == 0 and session_id not in self._sessions and self._turn_locks.get(session_id) is turn:
+                del self._turn_locks[session_id]
+
+    def get_or_create(self, session_id: str) -> PennyAgent:
+        agent = self.get(session_id)
+        if agent is None:
+            _, agent = self.create(session_id)
+        return agent
+
+    def save(self, session_id: str, agent: PennyAgent) -> None:
+        """Write the conversation to the store after a turn; returns without waiting for the write."""
+        with self._lock:
+            # the turn grew the history; recount the session, unless it was evicted meanwhile
+            entry = self._sessions.get(session_id)
+            if entry is not None and entry[0] is agent:
+                size = estimate_agent_bytes(agent)
+                self._memory_bytes += size - entry[2]
+                self._sessions[session_id] = (agent, entry[1], size)
+                self._evict()
+        if self.store is None:
+            return
+        agent.state_version += 1
+        self.writer.submit(session_id, agent.state_version, encode_snapshot(agent.state_version, agent.snapshot()))
+
+    def discard(self, session_id: str) -> None:
+        with self._lock:
+            self._pop(session_id)
+        if self.store is not None:
+            self.writer.delete(session_id)
+
+    def close(self) -> None:
+        """Finish the pending writes, e.g. before the task stops."""
+        if self.writer is not None:
+            self.writer.close()
+
+    def _load(self, session_id: str, agent: Optional[PennyAgent]) -> Optional[PennyAgent]:
+        data = self.store.load(session_id)
+        # the store never received this process's latest turn, so it holds an older state or none
+        unwritten = agent is not None and agent.state_version == self.writer.unwritten_version(session_id)
+        if data is None:
+            # otherwise a conversation that was saved but is gone from the store was reset or expired
+            return agent if agent is not None and (agent.state_version == 0 or unwritten) else None
+        version, snapshot = decode_snapshot(data)
+        if agent is not None and (agent.state_version == version or (unwritten and version < agent.state_version)):
+            return agent
+        agent = agent or self.agent_factory()
+        agent.restore(snapshot, version)
+        self.restores += 1
+        return agent
+
+    def memory_bytes(self) -> int:
+        return self._memory_bytes
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            stats = {
+                "sessions": len(self._sessions),
+                "memory_bytes": self.memory_bytes(),
+                "evictions": self.evictions,
+            }
+        if self.writer is not None:
+            stats.update(
+                restores=self.restores,
+                writes=self.writer.writes,
+                pending_writes=self.writer.backlog(),
+                stale_writes=self.writer.stale_writes,
+                failed_writes=self.writer.failures,
+                abandoned_writes=self.writer.abandoned,
+            )
+        return stats
+
+    def _evict_expired(self) -> None:
+        deadline = self.clock() - self.idle_ttl_seconds
+        while self._sessions:
+            session_id, (_, last_access, _) = next(iter(self._sessions.items()))
+            if last_access > deadline:
+                break
+            self._pop(session_id)
+            self.evictions += 1
+
+    def _evict(self) -> None:
+        self._evict_expired()
+        while len(self._sessions) > self.max_sessions:
+            self._pop(next(iter(self._sessions)))
+            self.evictions += 1
+        # never evict the session that was just touched
+        while len(self._sessions) > 1 and self._memory_bytes > self.max_memory_bytes:
+            self._pop(next(iter(self._sessions)))
+            self.evictions += 1
+
+    def _put(self, session_id: str, agent: PennyAgent) -> None:
+        """Insert or touch a session as the most recently used, keeping the byte total current."""
+        self._pop(session_id)
+        size = estimate_agent_bytes(agent)
+        self._sessions[session_id] = (agent, self.clock(), size)
+        self._memory_bytes += size
+
+    def _pop(self, session_id: str) -> None:
+        entry = self._sessions.pop(session_id, None)
+        if entry is not None:
+            self._memory_bytes -= entry[2]
+        # a lock still held or awaited stays, so the session's next turn still waits for it
+        turn = self._turn_locks.get(session_id)
+        if turn is not None and turn[1] == 0:
+            del self._turn_locks[session_id]
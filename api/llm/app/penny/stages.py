@@ -0,0 +1,164 @@
+import re
+from dataclasses import dataclass
+from typing import Callable, Optional, Tuple, Union
+
+from email_validator import EmailNotValidError, validate_email
+
+from penny.history import EMAIL_PATTERN, NAME_PATTERN, OnboardingState
+
+OPEN_ACCOUNT_PATTERN = re.compile(r"\b(open|start|create|new)\b.*\baccount\b|\bsign(ing)? up\b", re.IGNORECASE)
+YES_PATTERN = re.compile(r"^(yes|yep|yeah|y|sure|correct|confirm(ed)?|looks good|that'?s (right|correct))\b", re.IGNORECASE)
+
+# selfie faces narrower than this fraction of the photo are too far from the camera
+MIN_SELFIE_FACE_WIDTH = 0.15
+
+UNAVAILABLE = "Sorry, our onboarding service is currently unavailable. Please try again later."
+
+# the stage of AGENT_TOOLS_PROMPT the conversation is in, keyed by what Penny is waiting for
+STAGE_BY_AWAITING = {
+    "email": "Account Open 1",
+    "account_type": "Account Open 2",
+    "first_name": "Account Open 3",
+    "last_name": "Account Open 4",
+    "id": "Account Open 5",
+    "selfie": "Account Open 7",
+    "confirmation": "Account Open 9",
+}
+
+# stages where Penny's next reply asks for the next detail and needs no tool
+PROMPT_STAGES = ("Account Open 2", "Account Open 3", "Account Open 4")
+
+
+def is_short_answer(text: str) -> bool:
+    """Whether a message reads as a reply to a prompt (a name, a choice) rather than a question."""
+    return "?" not in text and len(text.split()) <= 5
+
+
+def selfie_feedback(details: Optional[dict]) -> str:
+    """What the user should change about their selfie, from the details SelfieVerification returns."""
+    if not details:
+        return "We couldn't match your selfie to your identity document. Please upload another selfie, facing the camera in good light."
+    if details.get("faces_in_selfie") is None:
+        return "We couldn't find a face on your identity document. Please upload a clear photo of your ID again."
+    if details["faces_in_selfie"] == 0:
+        return "We couldn't find a face in your selfie. Please upload a photo of your face, looking at the camera."
+    if details["faces_in_selfie"] > 1:
+        return "Your selfie shows more than one face. Please upload a photo with only you in it."
+    if details.get("bounding_box") and details["bounding_box"]["Width"] < MIN_SELFIE_FACE_WIDTH:
+        return "Your face is too small in the selfie. Please move closer to the camera and upload another one."
+    return "Your selfie doesn't match the photo on your ID (similarity {}%). Please upload another selfie, facing the camera in good light.".format(
+        details.get("similarity") or 0)
+
+
+@dataclass
+class ToolStep:
+    """A tool call decided without the LLM; `respond` turns the tool's API response into Penny's reply."""
+
+    tool: str
+    method: str
+    args: Tuple
+    respond: Callable[[dict], str]
+
+
+class StageEngine:
+    """
+    Drives the "Account Open" stages of AGENT_TOOLS_PROMPT deterministically.
+
+    For each user turn `next_step` either returns Penny's templated reply, a ToolStep to run
+    directly, or None when the turn is free-form and needs the LLM. Slots come from the
+    conversation's OnboardingState; on the turns it handles, the engine is the authority on
+    which stage comes next.
+    """
+
+    def next_step(self, state: OnboardingState, user_input: str) -> Union[str, ToolStep, None]:
+        text = user_input.removeprefix("User: ").strip()
+        short_answer = is_short_answer(text)
+
+        if state.awaiting is None and state.email is None and OPEN_ACCOUNT_PATTERN.search(text) and "?" not in text:
+            state.awaiting = "email"
+            return "I'd be happy to help you open an account! To get started, what is your email address?"
+
+        if state.awaiting == "email":
+            return self._email_step(state, text)
+
+        if state.awaiting == "account_type" and state.account_type and short_answer:
+            state.awaiting = "first_name"
+            return "Great, a {} account it is. What is your first name?".format(state.account_type)
+
+        if state.awaiting == "first_name" and NAME_PATTERN.match(text):
+            state.awaiting = "last_name"
+            return "Thanks, {}! What is your last name?".format(state.first_name)
+
+        if state.awaiting == "last_name" and NAME_PATTERN.match(text):
+            state.awaiting = "id"
+            return "Thank you. Please upload an identity document, such as your passport or driver's licence, so we can verify your identity."
+
+        if state.awaiting == "id" and text.startswith("[System] uploaded") and state.first_name and state.last_name:
+            return ToolStep("IDVerification", "verify", (state.id_file_name, state.first_name, state.last_name), lambda r: self._id_verified(state, r))
+
+        if state.awaiting == "selfie" and text.startswith("[System] uploaded") and state.selfie_file_name:
+            return ToolStep("SelfieVerification", "compare", (state.id_file_name, state.selfie_file_name), lambda r: self._face_verified(state, r))
+
+        if state.awaiting == "confirmation" and state.id_verified and state.face_verified and YES_PATTERN.match(text):
+            args = (state.email, state.account_type, state.first_name, state.last_name, state.id_file_name, state.selfie_file_name)
+            return ToolStep("SaveData", "save", args, lambda r: self._saved(state, r))
+
+        return None
+
+    def stage_of(self, state: OnboardingState) -> str:
+        if state.awaiting in STAGE_BY_AWAITING:
+            return STAGE_BY_AWAITING[state.awaiting]
+        return "Account Open 10" if state.face_verified and not state.awaiting else "General Banking Questions"
+
+    def _email_step(self, state: OnboardingState, text: str) -> Union[str, ToolStep, None]:
+        match = EMAIL_PATTERN.search(text)
+        if match is None:
+            return None
+        try:
+            email = validate_email(match.group(0), check_deliverability=False).normalized.lower()
+        except EmailNotValidError:
+            state.email = None
+            return "That email address doesn't look valid. Could you please check it and try again?"
+        state.email = email
+        return ToolStep("EmailValidation", "lookup", (email,), lambda r: self._email_checked(state, r))
+
+    def _email_checked(self, state: OnboardingState, response: dict) -> str:
+        if response["statusCode"] != 200:
+            return UNAVAILABLE
+        if "already exists" in response["body"]:
+            state.email = None
+            return "It looks like an account already exists with that email address. Could you please try a different email?"
+        state.email_validated = True
+        state.awaiting = "account_type"
+        return "Thanks, your email has been validated. Which type of account would you like to open: CHEQUING or SAVINGS?"
+
+    def _id_verified(self, state: OnboardingState, response: dict) -> str:
+        if response["statusCode"] != 200:
+            return UNAVAILABLE
+        if response["body"] != "Document has been verified":
+            state.record_id_verification(state.id_file_name, False)
+            return "We couldn't verify your identity document: {}. Please upload it again.".format(response["body"])
+        state.record_id_verification(state.id_file_name, True)
+        return "Your identity document has been verified. Next, please upload a selfie so we can compare it with the photo on your ID."
+
+    def _face_verified(self, state: OnboardingState, response: dict) -> str:
+        if response["statusCode"] != 200:
+            return UNAVAILABLE
+        if response["body"] != "Face match verified":
+            state.record_face_verification(state.selfie_file_name, False)
+            return selfie_feedback(response.get("details"))
+        state.record_face_verification(state.selfie_file_name, True)
+        return (
+            "Your selfie matches your ID. Here is a summary of your application:\n"
+            "Name: {} {}\nEmail: {}\nAccount type: {}\n"
+            "Can you confirm these details are correct?".format(state.first_name, state.last_name, state.email, state.account_type)
+        )
+
+    def _saved(self, state: OnboardingState, response: dict) -> str:
+        if response["statusCode"] == 409:
+            state.awaiting = None
+            return "It looks like an account already exists with the email {}, so we couldn't open a new one.".format(state.email)
+        if response["statusCode"] != 200:
+            return "Something went wrong with creating your account. Please try again later."
+        state.awaiting = None
+        return "Your new {} account has been created! A welcome email is on its way to you.".format(state.account_type)
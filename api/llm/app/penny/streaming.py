@@ -0,0 +1,141 @@
+import asyncio
+import json
+from typing import Any, AsyncIterator, Optional
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+END_TAGS = ("<END_OF_TURN>", "<END_OF_CONVERSATION>")
+
+
+class FinalAnswerStreamHandler(BaseCallbackHandler):
+    """
+    Forwards the agent's Final Answer tokens to an asyncio queue as the LLM produces them.
+
+    Everything before "Final Answer:" (or "<ai_prefix>:") in an LLM call is Thought/Action
+    scratchpad and is suppressed, as are tokens from LLM calls made inside tools (e.g. the
+    ProductSearch retrieval chain). Streaming stops at <END_OF_TURN>, matching the stripping
+    done at the end of PennyAgent._call.
+
+    Bedrock tokens arrive on an executor thread, so they are handed to the loop thread-safely.
+    """
+
+    run_inline = True
+
+    def __init__(self, ai_prefix: str = "Penny", loop: Optional[asyncio.AbstractEventLoop] = None):
+        self.markers = ("Final Answer:", f"{ai_prefix}:")
+        self.loop = loop or asyncio.get_running_loop()
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.tool_depth = 0
+        self._buffer = ""
+        self._emitted = 0
+        self._answering = False
+        self._streamed_any = False
+        self._finished = False
+
+    def on_llm_start(self, serialized: Any, prompts: Any, **kwargs: Any) -> None:
+        self._reset()
+
+    def on_chat_model_start(self, serialized: Any, messages: Any, **kwargs: Any) -> None:
+        self._reset()
+
+    def on_tool_start(self, serialized: Any, input_str: str, **kwargs: Any) -> None:
+        self.tool_depth += 1
+
+    def on_tool_end(self, output: Any, **kwargs: Any) -> None:
+        self.tool_depth -= 1
+
+    def on_tool_error(self, error: BaseException, **kwargs: Any) -> None:
+        self.tool_depth -= 1
+
+    def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        if self.tool_depth > 0 or self._finished:
+            return
+        self._buffer += token
+
+        if not self._answering:
+            found = [(self._buffer.find(marker), marker) for marker in self.markers if marker in self._buffer]
+            if not found:
+                return
+            position, marker = min(found)
+            self._answering = True
+            self._emitted = position + len(marker)
+
+        pending = self._buffer[self._emitted:]
+        if not self._streamed_any:
+            stripped = pending.lstrip()
+            self._emitted += len(pending) - len(stripped)
+            pending = stripped
+
+        for tag in END_TAGS:
+            if tag in pending:
+                pending = pending[:pending.index(tag)]
+                self._finished = True
+        if not self._finished:
+            # hold back what may be the beginning of an end tag until the next token decides it
+            pending = pending[:len(pending) - self._partial_tag_length(pending)]
+
+        if pending:
+            self._emitted += len(pending)
+            self._streamed_any = True
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, pending)
+
+    def on_llm_end(self, response: Any, **kwargs: Any) -> None:
+        if self.tool_depth > 0 or not self._answering or self._finished:
+            return
+        # flush anything held back as a possible end tag
+        pending = self._buffer[self._emitted:]
+        pending = pending if self._streamed_any else pending.lstrip()
+        self._finished = True
+        if pending:
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, pending)
+
+    async def tokens(self, turn: "asyncio.Future") -> AsyncIterator[str]:
+        """Yield streamed tokens until `turn` (the running agent step) completes."""
+        while True:
+            getter = asyncio.ensure_future(self.queue.get())
+            done, _ = await asyncio.wait({getter, turn}, return_when=asyncio.FIRST_COMPLETED)
+            if getter in done:
+                yield getter.result()
+                continue
+            getter.cancel()
+            while not self.queue.empty():
+                yield self.queue.get_nowait()
+            return
+
+    def _reset(self) -> None:
+        if self.tool_depth == 0 and not self._answering:
+            self._buffer = ""
+            self._emitted = 0
+
+    @staticmethod
+    def _partial_tag_length(text: str) -> int:
+        """Length of a suffix of `text` that could be the start of an end tag."""
+        for length in range(min(len(text), max(len(tag) for tag in END_TAGS)), 0, -1):
+            if any(tag.startswith(text[-length:]) for tag in END_TAGS):
+                return length
+        return 0
+
+
+def sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+async def stream_turn(agent) -> AsyncIterator[str]:
+    """
+    Run one agent step, yielding server-sent events: a "token" event per streamed piece of the
+    final answer, then "done" with the whole reply (or "error"). Turns answered without the
+    LLM produce no tokens, only "done".
+    """
+    handler = FinalAnswerStreamHandler(ai_prefix=agent.assistant_name)
+    turn = asyncio.ensure_future(agent.astep(callbacks=[handler]))
+    streamed = ""
+    async for token in handler.tokens(turn):
+        streamed += token
+        yield sse("token", {"token": token})
+
+    try:
+        response = turn.result()
+    except Exception as e:
+        yield sse("error", {"detail": "Something went wrong: " + str(e)})
+        return
+    yield sse("done", {"message": streamed.strip() or response})
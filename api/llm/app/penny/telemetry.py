@@ -0,0 +1,188 @@
+import bisect
+import threading
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional, Sequence, Tuple
+from uuid import UUID
+
+from langchain_core.callbacks import BaseCallbackHandler
+from opentelemetry import trace
+from opentelemetry.sdk.trace import ReadableSpan, SpanProcessor, TracerProvider
+from opentelemetry.sdk.trace.export import BatchSpanProcessor, ConsoleSpanExporter, SimpleSpanProcessor
+from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+from opentelemetry.trace import Status, StatusCode
+
+from penny.history import estimate_tokens
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+TOKEN_BUCKETS = (64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384)
+
+# span attributes that become labels of the span duration histogram
+LABEL_ATTRIBUTES = {
+    "penny.stage": "stage",
+    "penny.tool": "tool",
+    "http.route": "route",
+    "llm.model": "model",
+}
+
+tracer = trace.get_tracer("penny")
+
+
+class Histogram:
+    """Prometheus-style cumulative histogram, one series per label set."""
+
+    def __init__(self, name: str, help: str, buckets: Sequence[float]):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self._series: Dict[Tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._series.setdefault(key, [[0] * len(self.buckets), 0, 0.0])
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                series[0][index] += 1
+            series[1] += 1
+            series[2] += value
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (counts, count, total) in sorted(self._series.items()):
+                labels = ",".join(f'{name}="{value}"' for name, value in key)
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    lines.append(f'{self.name}_bucket{{{labels}{"," if labels else ""}le="{bound}"}} {cumulative}')
+                lines.append(f'{self.name}_bucket{{{labels}{"," if labels else ""}le="+Inf"}} {count}')
+                lines.append(f"{self.name}_count{{{labels}}} {count}")
+                lines.append(f"{self.name}_sum{{{labels}}} {total}")
+        return "\n".join(lines)
+
+
+span_duration = Histogram("penny_span_duration_seconds", "Duration of agent turns, model calls, tool calls, uploads and requests", LATENCY_BUCKETS)
+llm_tokens = Histogram("penny_llm_tokens", "Input and output tokens per model call", TOKEN_BUCKETS)
+bedrock_latency = Histogram("penny_bedrock_request_seconds", "Bedrock requests by model and outcome (ok or error code), retries and hedges included", LATENCY_BUCKETS)
+
+
+def render_metrics() -> str:
+    """All histograms in the Prometheus text exposition format."""
+    return "\n".join(histogram.render() for histogram in (span_duration, llm_tokens, bedrock_latency)) + "\n"
+
+
+class SpanMetricsProcessor(SpanProcessor):
+    """Feeds every finished span into the /metrics histograms, whatever exporter is configured."""
+
+    def on_end(self, span: ReadableSpan) -> None:
+        attributes = span.attributes or {}
+        labels = {label: str(attributes[key]) for key, label in LABEL_ATTRIBUTES.items() if key in attributes}
+        span_duration.observe((span.end_time - span.start_time) / 1e9, span=span.name, **labels)
+        for direction in ("input", "output"):
+            tokens = attributes.get(f"llm.{direction}_tokens")
+            if tokens is not None:
+                llm_tokens.observe(tokens, direction=direction, **{k: v for k, v in labels.items() if k == "model"})
+
+
+memory_exporter: Optional[InMemorySpanExporter] = None
+
+
+def setup_tracing(exporter: str = "none") -> TracerProvider:
+    """
+    Install the process-wide tracer provider. Spans always feed /metrics; `exporter` also sends
+    them to "memory" (kept in `memory_exporter`, for tests), "console" or "otlp" (needs the
+    opentelemetry-exporter-otlp package and the standard OTEL_EXPORTER_OTLP_* variables).
+    """
+    global memory_exporter
+    provider = TracerProvider()
+    provider.add_span_processor(SpanMetricsProcessor())
+    if exporter == "memory":
+        memory_exporter = InMemorySpanExporter()
+        provider.add_span_processor(SimpleSpanProcessor(memory_exporter))
+    elif exporter == "console":
+        provider.add_span_processor(SimpleSpanProcessor(ConsoleSpanExporter()))
+    elif exporter == "otlp":
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+
+        provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+    elif exporter != "none":
+        raise ValueError("Unknown tracesExporter: " + exporter)
+    trace.set_tracer_provider(provider)
+    return provider
+
+
+@contextmanager
+def span(name: str, **attributes: Any) -> Iterator[trace.Span]:
+    """Span around a block; exceptions are recorded on it and re-raised."""
+    with tracer.start_as_current_span(name, attributes={k: v for k, v in attributes.items() if v is not None}) as current:
+        yield current
+
+
+class TracingCallbackHandler(BaseCallbackHandler):
+    """
+    Spans for the model and tool calls langchain makes inside an agent turn. Token counts come
+    from Bedrock's usage when it reports them and are estimated from the text otherwise
+    (streamed responses carry no usage).
+    """
+
+    # called in place rather than on an executor, so spans start and end in the caller's order
+    run_inline = True
+
+    def __init__(self):
+        self._spans: Dict[UUID, Tuple[trace.Span, int]] = {}
+
+    def _start(self, run_id: UUID, name: str, attributes: Dict[str, Any], input_tokens: int = 0) -> None:
+        # a child of the span current when langchain calls back, i.e. the agent turn; not made
+        # current itself, as start and end callbacks may run in different contexts
+        current = tracer.start_span(name, attributes={k: v for k, v in attributes.items() if v is not None})
+        self._spans[run_id] = (current, input_tokens)
+
+    def _end(self, run_id: UUID, error: Optional[BaseException] = None) -> None:
+        entry = self._spans.pop(run_id, None)
+        if entry is None:
+            return
+        current = entry[0]
+        if error is not None:
+            current.record_exception(error)
+            current.set_status(Status(StatusCode.ERROR, type(error).__name__))
+        current.end()
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+        text = "".join(str(message.content) for batch in messages for message in batch)
+        self._start(run_id, "llm.call", {"llm.model": _model_id(serialized, kwargs)}, estimate_tokens(text))
+
+    def on_llm_start(self, serialized, prompts, *, run_id, **kwargs):
+        self._start(run_id, "llm.call", {"llm.model": _model_id(serialized, kwargs)}, estimate_tokens("".join(prompts)))
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        entry = self._spans.get(run_id)
+        if entry is not None:
+            current, estimated_input = entry
+            usage = (response.llm_output or {}).get("usage") or {}
+            output = "".join(generation.text for generations in response.generations for generation in generations)
+            current.set_attribute("llm.input_tokens", usage.get("prompt_tokens") or estimated_input)
+            current.set_attribute("llm.output_tokens", usage.get("completion_tokens") or estimate_tokens(output))
+            current.set_attribute("llm.tokens_estimated", not usage.get("prompt_tokens"))
+        self._end(run_id)
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self._end(run_id, error)
+
+    def on_tool_start(self, serialized, input_str, *, run_id, **kwargs):
+        self._start(run_id, "tool.run", {"penny.tool": serialized.get("name")})
+
+    def on_tool_end(self, output, *, run_id, **kwargs):
+        self._end(run_id)
+
+    def on_tool_error(self, error, *, run_id, **kwargs):
+        self._end(run_id, error)
+
+
+def _model_id(serialized: Dict[str, Any], kwargs: Dict[str, Any]) -> Optional[str]:
+    params = kwargs.get("invocation_params") or {}
+    return params.get("model_id") or (serialized.get("kwargs") or {}).get("model_id")
+
+
+tracing_handler = TracingCallbackHandler()
+
@@ -0,0 +1,144 @@
+import asyncio
+import json
+from typing import Any, Dict, List
+
+from pydantic import ValidationError
+
+from penny.telemetry import span
+
+ANTHROPIC_VERSION = "bedrock-2023-05-31"
+STOPPED = "Sorry, I couldn't finish that just now. Could you say that again?"
+
+
+class ToolCallingAgent:
+    """
+    Runs an agent turn with Claude's tool-use API on Bedrock instead of ReAct text.
+
+    Tools are offered with the JSON schema of their `args_model`, and Claude answers with
+    structured tool_use blocks, so there is no Action/Action Input to parse and arguments
+    arrive typed. Arguments that fail validation go back to the model as an error result
+    for that call. A turn ends when the model replies with text, or after `max_iterations`
+    model calls.
+    """
+
+    def __init__(
+        self,
+        client,
+        model_id: str,
+        system_prompt: str,
+        tools: List[Any],
+        max_iterations: int = 4,
+        max_tokens: int = 1024,
+        temperature: float = 0.5,
+        prompt_caching: bool = False,
+    ):
+        self.client = client
+        self.model_id = model_id
+        self.system_prompt = system_prompt
+        self.tools_by_name = {tool.name: tool for tool in tools}
+        self.max_iterations = max_iterations
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.prompt_caching = prompt_caching
+        # rendered once; the same for every call
+        self.tool_specs = [
+            {"name": tool.name, "description": tool.description, "input_schema": tool.args_model.model_json_schema()}
+            for tool in tools
+        ]
+        self.model_calls = 0
+        self.tool_calls = 0
+        self.invalid_tool_calls = 0
+
+    def run(self, conversation_history: str) -> str:
+        messages = self._first_messages(conversation_history)
+        for _ in range(self.max_iterations):
+            response = self._invoke(messages)
+            tool_uses = self._tool_uses(response)
+            if not tool_uses:
+                return self._text(response)
+            results = [self._tool_result(tool_use, *self._run_tool(tool_use)) for tool_use in tool_uses]
+            messages += [{"role": "assistant", "content": response["content"]}, {"role": "user", "content": results}]
+        return self._text(response) or STOPPED
+
+    async def arun(self, conversation_history: str) -> str:
+        messages = self._first_messages(conversation_history)
+        for _ in range(self.max_iterations):
+            response = await asyncio.to_thread(self._invoke, messages)
+            tool_uses = self._tool_uses(response)
+            if not tool_uses:
+                return self._text(response)
+            results = [self._tool_result(tool_use, *await self._arun_tool(tool_use)) for tool_use in tool_uses]
+            messages += [{"role": "assistant", "content": response["content"]}, {"role": "user", "content": results}]
+        return self._text(response) or STOPPED
+
+    def _first_messages(self, conversation_history: str) -> List[Dict[str, Any]]:
+        return [{"role": "user", "content": "<Conversation history>\n" + conversation_history}]
+
+    def _invoke(self, messages: List[Dict[str, Any]]) -> Dict[str, Any]:
+        system: Any = self.system_prompt
+        if self.prompt_caching:
+            system = [{"type": "text", "text": self.system_prompt, "cache_control": {"type": "ephemeral"}}]
+        body = {
+            "anthropic_version": ANTHROPIC_VERSION,
+            "max_tokens": self.max_tokens,
+            "temperature": self.temperature,
+            "system": system,
+            "messages": messages,
+            "tools": self.tool_specs,
+            "stop_sequences": ["\nUser:"],
+        }
+        self.model_calls += 1
+        with span("llm.call", **{"llm.model": self.model_id}) as current:
+            response = self.client.invoke_model(
+                modelId=self.model_id, body=json.dumps(body), accept="application/json", contentType="application/json"
+            )
+            response = json.loads(response["body"].read())
+            usage = response.get("usage") or {}
+            current.set_attributes({
+                "llm.input_tokens": usage.get("input_tokens", 0),
+                "llm.output_tokens": usage.get("output_tokens", 0),
+                "llm.stop_reason": response.get("stop_reason") or "",
+            })
+        return response
+
+    def _tool_uses(self, response: Dict[str, Any]) -> List[Dict[str, Any]]:
+        return [block for block in response["content"] if block["type"] == "tool_use"]
+
+    def _text(self, response: Dict[str, Any]) -> str:
+        return "".join(block["text"] for block in response["content"] if block["type"] == "text").strip()
+
+    def _parse(self, tool_use: Dict[str, Any]):
+        tool = self.tools_by_name.get(tool_use["name"])
+        if tool is None:
+            raise ValueError("Unknown tool " + tool_use["name"])
+        return tool, tool.args_model.model_validate(tool_use["input"])
+
+    def _run_tool(self, tool_use: Dict[str, Any]):
+        try:
+            tool, args = self._parse(tool_use)
+        except (ValueError, ValidationError) as e:
+            self.invalid_tool_calls += 1
+            return str(e), True
+        self.tool_calls += 1
+        with span("tool.run", **{"penny.tool": tool.name}):
+            return tool.run_args(args), False
+
+    async def _arun_tool(self, tool_use: Dict[str, Any]):
+        try:
+            tool, args = self._parse(tool_use)
+        except (ValueError, ValidationError) as e:
+            self.invalid_tool_calls += 1
+            return str(e), True
+        self.tool_calls += 1
+        with span("tool.run", **{"penny.tool": tool.name}):
+            return await tool.arun_args(args), False
+
+    def _tool_result(self, tool_use: Dict[str, Any], content: str, is_error: bool) -> Dict[str, Any]:
+        return {"type": "tool_result", "tool_use_id": tool_use["id"], "content": content, "is_error": is_error}
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "model_calls": self.model_calls,
+            "tool_calls": self.tool_calls,
+            "invalid_tool_calls": self.invalid_tool_calls,
+        }
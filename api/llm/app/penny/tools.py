@@ -1,25 +1,54 @@
 from langchain.tools import BaseTool
 from langchain.chains import RetrievalQA
-import boto3
 import json
 from langchain.agents import Tool
 from langchain_community.chat_models import BedrockChat
 from langchain_community.retrievers import AmazonKendraRetriever
-from pydantic import EmailStr, Field
+from pydantic import BaseModel, EmailStr, Field
 from email_validator import validate_email, EmailNotValidError
-import requests
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import ClassVar, Literal, Type
 import os
+import threading
+import time
+from penny.backends import close_async_client, get_backend
+from penny.clients import get_client
+from penny.knowledge_base import PRODUCT_SEARCH_ROUTES, AnswerCache, KnowledgeBase
+from penny.resilience import get_bedrock_client, model_scope
+from penny.stages import selfie_feedback
+from penny.verification import VerificationPipeline
 
-bedrock = boto3.client(service_name='bedrock-runtime')
-API_ENDPOINT = os.environ["apiEndpoint"]
 
-def setup_knowledge_base():
+def get_retriever():
+    """
+    Retriever used by the knowledge base, selected with `retrieverBackend`:
+    "kendra" (default) queries the Kendra index, "local" searches an embedded copy of the product catalog.
+    """
+    backend = os.environ.get("retrieverBackend", "kendra")
+    if backend == "local":
+        # the embedding model stack is only needed, and only installed, for this backend
+        from penny.catalog_index import CatalogIndex, LocalCatalogRetriever, SentenceTransformerEmbedder
+
+        index = CatalogIndex.build(
+            csv_path=os.environ.get("catalogPath", "data/AnyBankProductCatalog.csv"),
+            index_dir=os.environ.get("catalogIndexDir", "data/catalog-index"),
+            embed=SentenceTransformerEmbedder(os.environ.get("embeddingModel", "sentence-transformers/all-MiniLM-L6-v2")),
+        )
+        return LocalCatalogRetriever(index=index, k=int(os.environ.get("retrieverTopK", 4)))
+    if backend == "kendra":
+        return AmazonKendraRetriever(index_id=os.environ["kendraIndexId"], client=get_client('kendra'))
+    raise ValueError("Unknown retrieverBackend: " + backend)
+
+
+def setup_knowledge_base(model_id=None, client=None, retriever=None, verbose=False):
     """
     We assume that the product knowledge base is simply a text file.
     """
     llm = BedrockChat(
-        model_id='anthropic.claude-3-5-sonnet-20240620-v1:0', 
-        client=bedrock,
+        # summarising a few passages doesn't need the agent's model; e.g. a Claude Haiku model will do
+        model_id=model_id or os.environ.get("productSearchModel", 'anthropic.claude-3-5-sonnet-20240620-v1:0'),
+        client=client or get_bedrock_client(),
         model_kwargs={
             "temperature": 1,
             "top_k": 250,
@@ -28,85 +57,258 @@ def setup_knowledge_base():
         }
     )
 
-    retriever = AmazonKendraRetriever(index_id=os.environ["kendraIndexId"])
+    retriever = retriever or get_retriever()
 
     knowledge_base = RetrievalQA.from_chain_type(
-        llm=llm, chain_type="stuff", retriever=retriever, verbose=True
+        llm=llm, chain_type="stuff", retriever=retriever, verbose=verbose
     )
     return knowledge_base
 
 
+_knowledge_base = None
+# the lazy singletons below are built by the warm-up thread while requests may already need them
+_singletons_lock = threading.Lock()
+
+
+def get_knowledge_base() -> KnowledgeBase:
+    """Process-wide knowledge base; the retrieval chain is only built when first queried."""
+    global _knowledge_base
+    if _knowledge_base is None:
+        with _singletons_lock:
+            if _knowledge_base is None:
+                route = os.environ.get("productSearchRoute", "synthesize")
+                if route not in PRODUCT_SEARCH_ROUTES:
+                    raise ValueError("Unknown productSearchRoute: " + route)
+                cache = AnswerCache(
+                    max_entries=int(os.environ.get("productSearchCacheSize", 1024)),
+                    ttl_seconds=float(os.environ.get("productSearchCacheTtlSeconds", 3600)),
+                )
+                _knowledge_base = KnowledgeBase(
+                    setup_knowledge_base,
+                    cache,
+                    route=route,
+                    passage_token_budget=int(os.environ.get("productSearchPassageTokens", 600)),
+                )
+    return _knowledge_base
+
+
+class ProductSearchArgs(BaseModel):
+    question: str = Field(description="the customer's question about AnyBank or its products")
+
+
+class EmailValidationArgs(BaseModel):
+    email: str = Field(description="the email address the customer gave")
+
+
+class IDVerificationArgs(BaseModel):
+    id_file_name: str = Field(description="file name of the uploaded identity document")
+    first_name: str = Field(description="the customer's first name as they gave it")
+    last_name: str = Field(description="the customer's last name as they gave it")
+
+
+class SelfieVerificationArgs(BaseModel):
+    id_file_name: str = Field(description="file name of the verified identity document")
+    selfie_file_name: str = Field(description="file name of the uploaded selfie")
+
+
+class SaveDataArgs(BaseModel):
+    email: str
+    account_type: Literal["CHEQUING", "SAVINGS"]
+    first_name: str
+    last_name: str
+    id_file_name: str
+    selfie_file_name: str
+
+
 class product_search(BaseTool):
     name = "ProductSearch"
     description = "Use this tool when you need to give some information about AnyBank or it's products. " \
                     "It takes the the question as input" \
                   "It will return the relevant information for you to answer the question."
+    args_model: ClassVar[Type[BaseModel]] = ProductSearchArgs
 
+    # the knowledge base answers with its own model (productSearchModel), whichever model the turn uses
     def _run(self, question):
-        knowledge_base = setup_knowledge_base()
-        response = knowledge_base.run(question)
+        with model_scope(None):
+            response = get_knowledge_base().run(question)
+        return response
+
+    async def _arun(self, question: str):
+        with model_scope(None):
+            response = await get_knowledge_base().arun(question)
         return response
 
-    def _arun(self, query: str):
-        raise NotImplementedError("This tool does not support async")
+    def run_args(self, args: ProductSearchArgs):
+        return self._run(args.question)
+
+    async def arun_args(self, args: ProductSearchArgs):
+        return await self._arun(args.question)
     
     
+def request_id_verification(file_name, first_name, last_name):
+    # names are sent as given; verify-id normalises spacing, accents and punctuation itself
+    required_field_values = {"FIRST_NAME": first_name.strip(), "LAST_NAME": last_name.strip()}
+    return get_backend().verify_id(file_name, required_field_values)
+
+
+def request_face_comparison(id_file_name, selfie_file_name):
+    return get_backend().verify_face(id_file_name, selfie_file_name)
+
+
+_verification_pipeline = None
+
+
+def get_verification_pipeline() -> VerificationPipeline:
+    """Process-wide pool that verifies uploads in the background; the verification tools read from it."""
+    global _verification_pipeline
+    if _verification_pipeline is None:
+        with _singletons_lock:
+            if _verification_pipeline is None:
+                _verification_pipeline = VerificationPipeline(
+                    verify_id=request_id_verification,
+                    compare_faces=request_face_comparison,
+                    max_workers=int(os.environ.get("verificationWorkers", 8)),
+                )
+    return _verification_pipeline
+
+
+class AccountLookupCache:
+    """
+    EmailValidation results of one conversation, each valid for `ttl_seconds`, so an email
+    the user enters again is not looked up again.
+    """
+
+    def __init__(self, ttl_seconds=60, clock=time.monotonic):
+        self.ttl_seconds = ttl_seconds
+        self.clock = clock
+        self._entries = {}
+
+    def get(self, email):
+        entry = self._entries.get(email)
+        if entry is None or entry[1] <= self.clock():
+            return None
+        return entry[0]
+
+    def put(self, email, response):
+        self._entries[email] = (response, self.clock() + self.ttl_seconds)
+
+    def discard(self, email):
+        self._entries.pop(email, None)
+
+
+# lookup cache and onboarding state of the conversation whose turn is running; tools are shared between conversations
+_account_lookups: ContextVar = ContextVar("account_lookups", default=None)
+_onboarding: ContextVar = ContextVar("onboarding", default=None)
+
+
+@contextmanager
+def conversation_scope(account_lookups, onboarding=None):
+    """
+    Make `account_lookups` the lookup cache the tools use for the duration of a turn, and
+    `onboarding` the OnboardingState the verification tools record their results in.
+    """
+    token = _account_lookups.set(account_lookups)
+    onboarding_token = _onboarding.set(onboarding)
+    try:
+        yield
+    finally:
+        _onboarding.reset(onboarding_token)
+        _account_lookups.reset(token)
+
+
 class email_validator(BaseTool):
     name = "EmailValidation"
     description = "Use this tool when email needs to be validated. " \
                   "It will return a sentence whether the email is validated or not."
+    args_model: ClassVar[Type[BaseModel]] = EmailValidationArgs
+
+    def lookup(self, email):
+        email = email.lower()
+        cached = self._cached(email)
+        return cached if cached is not None else self._remember(email, get_backend().get_account(email))
+
+    async def alookup(self, email):
+        email = email.lower()
+        cached = self._cached(email)
+        return cached if cached is not None else self._remember(email, await get_backend().aget_account(email))
+
+    def _cached(self, email):
+        account_lookups = _account_lookups.get()
+        return account_lookups.get(email) if account_lookups is not None else None
+
+    def _remember(self, email, response_json):
+        account_lookups = _account_lookups.get()
+        if account_lookups is not None and response_json["statusCode"] == 200:
+            account_lookups.put(email, response_json)
+        return response_json
 
     def _run(self, query):
         query: EmailStr
 
         try:
-            emailInfo = validate_email(query, check_deliverability=False)
-            email = emailInfo.normalized
-
-            url = API_ENDPOINT + '/account'
-            params = {'email': email.lower()}
-            r = requests.get(url = url, params = params, timeout=300)
+            email = validate_email(query, check_deliverability=False).normalized
+            return self._respond(email, self.lookup(email))
+            
+        except EmailNotValidError as e:
+            return "Respond that {} is not valid. Ask the user to try again".format(query)
 
-            print(r.json())
-            if r.json()["statusCode"] != 200:
-                return "Respond that our onboarding service is currently unavailable and to try again later."
+    async def _arun(self, query: str):
+        try:
+            email = validate_email(query, check_deliverability=False).normalized
+            return self._respond(email, await self.alookup(email))
 
-            return "The email {} is valid. ".format(email) + "If account already exists with this email, ask the user to try again. Current status: " + r.json()["body"] 
-            
         except EmailNotValidError as e:
             return "Respond that {} is not valid. Ask the user to try again".format(query)
 
-    def _arun(self, query: str):
-        raise NotImplementedError("This tool does not support async")
+    def run_args(self, args: EmailValidationArgs):
+        return self._run(args.email)
+
+    async def arun_args(self, args: EmailValidationArgs):
+        return await self._arun(args.email)
+
+    def _respond(self, email, response_json):
+        if response_json["statusCode"] != 200:
+            return "Respond that our onboarding service is currently unavailable and to try again later."
+
+        return "The email {} is valid. ".format(email) + "If account already exists with this email, ask the user to try again. Current status: " + response_json["body"]
     
 class document_verification(BaseTool):
     name = "IDVerification"
     description = "Use this tool to verify the user ID. " \
                     "It takes the id_file_name, first_name and last_name as inputs." \
                   "It will return a sentence whether the ID is verified or not"
+    args_model: ClassVar[Type[BaseModel]] = IDVerificationArgs
+
+    def verify(self, file_name, first_name, last_name):
+        return get_verification_pipeline().verify_id(file_name, first_name, last_name)
+
+    async def averify(self, file_name, first_name, last_name):
+        return await get_verification_pipeline().averify_id(file_name, first_name, last_name)
 
     def _run(self, input=""):
         file_name, first_name, last_name = input.split(",")
         file_name = file_name.replace(" ", "")
-        required_field_values = {"FIRST_NAME": first_name.replace(" ", ""), "LAST_NAME": last_name.replace(" ", "")}
-        print(required_field_values)
+        return self._respond(file_name, self.verify(file_name, first_name, last_name))
+        
+    async def _arun(self, input=""):
+        file_name, first_name, last_name = input.split(",")
+        file_name = file_name.replace(" ", "")
+        return self._respond(file_name, await self.averify(file_name, first_name, last_name))
 
-        url = API_ENDPOINT + '/verifyId'
-        body = {
-            'file_name': file_name,
-            'required_field_values': required_field_values
-        }
-        r = requests.post(url=url, json=body, timeout=300)
+    def run_args(self, args: IDVerificationArgs):
+        return self._respond(args.id_file_name, self.verify(args.id_file_name, args.first_name, args.last_name))
 
-        print(r.json())
-        if r.json()["statusCode"] != 200:
+    async def arun_args(self, args: IDVerificationArgs):
+        return self._respond(args.id_file_name, await self.averify(args.id_file_name, args.first_name, args.last_name))
+
+    def _respond(self, file_name, response_json):
+        if response_json["statusCode"] != 200:
             return "Respond that our onboarding service is currently unavailable and to try again later."
 
-        print("Post successful")
-        return "id_file_name: " + file_name + ". If the document has been verified. ask the user to upload a selfie for face verification. If not, ask them to try again. Current status: " + r.json()["body"] 
-        
-    def _arun(self, query: str):
-        raise NotImplementedError("This tool does not support async")
+        onboarding = _onboarding.get()
+        if onboarding is not None:
+            onboarding.record_id_verification(file_name, response_json["body"] == "Document has been verified")
+        return "id_file_name: " + file_name + ". If the document has been verified. ask the user to upload a selfie for face verification. If not, ask them to try again. Current status: " + response_json["body"]
 
 
 class selfie_verification(BaseTool):
@@ -114,28 +316,40 @@ class selfie_verification(BaseTool):
     description = "Use this tool to verify the user selfie and compare faces. " \
                     "It takes the id file name and selfie file name as inputs." \
                   "It will return a sentence whether there is a face match"
+    args_model: ClassVar[Type[BaseModel]] = SelfieVerificationArgs
+
+    def compare(self, id_file_name, selfie_file_name):
+        return get_verification_pipeline().compare_faces(id_file_name, selfie_file_name)
+
+    async def acompare(self, id_file_name, selfie_file_name):
+        return await get_verification_pipeline().acompare_faces(id_file_name, selfie_file_name)
 
     def _run(self, input=""):
-        id_file_name, selfie_file_name = input.split(",")
-        id_file_name = id_file_name.replace(" ", "")
-        selfie_file_name = selfie_file_name.replace(" ", "")
-        print("Face comparison starting. Id file name is " + id_file_name + "and selfie file name is " + selfie_file_name)
+        id_file_name, selfie_file_name = input.replace(" ", "").split(",")
+        return self._respond(self.compare(id_file_name, selfie_file_name), selfie_file_name)
+        
+    async def _arun(self, input=""):
+        id_file_name, selfie_file_name = input.replace(" ", "").split(",")
+        return self._respond(await self.acompare(id_file_name, selfie_file_name), selfie_file_name)
 
-        url = API_ENDPOINT + '/verifyFace'
-        body = {
-            'id_file_name': id_file_name,
-            'selfie_file_name': selfie_file_name
-        }
-        r = requests.post(url=url, json=body, timeout=300)
+    def run_args(self, args: SelfieVerificationArgs):
+        return self._respond(self.compare(args.id_file_name, args.selfie_file_name), args.selfie_file_name)
+
+    async def arun_args(self, args: SelfieVerificationArgs):
+        return self._respond(await self.acompare(args.id_file_name, args.selfie_file_name), args.selfie_file_name)
 
-        if r.status_code != 200:
+    def _respond(self, response_json, selfie_file_name):
+        if response_json["statusCode"] != 200:
             return "Respond that our onboarding service is currently unavailable and to try again later."
 
-        print(r.json())
-        return "If the face has been verified, ask the user to confirm they want to proceed. If not verified, ask them to try again. Current status: " + r.json()["body"]
-        
-    def _arun(self, query: str):
-        raise NotImplementedError("This tool does not support async")
+        onboarding = _onboarding.get()
+        if onboarding is not None:
+            onboarding.record_face_verification(selfie_file_name, response_json["body"] == "Face match verified")
+
+        status = response_json["body"]
+        if response_json["body"] != "Face match verified":
+            status += ". " + selfie_feedback(response_json.get("details"))
+        return "If the face has been verified, ask the user to confirm they want to proceed. If not verified, ask them to try again. Current status: " + status
     
     
 class finish_onboarding(BaseTool):
@@ -143,11 +357,46 @@ class finish_onboarding(BaseTool):
     description = "Use this tool when you need save user data. " \
                     "It takes the email, account_type (CHEQUING or SAVINGS), first_name, last_name, id_file_name, selfie_file name as inputs as a single string comma separated." \
                   "It will return a sentence whether the onboarding successfully or not."
+    args_model: ClassVar[Type[BaseModel]] = SaveDataArgs
 
-    def _run(self, input=""):
-        email, account_type, first_name, last_name, id_file_name, selfie_file_name = input.replace(" ", "").split(",")
+    def save(self, email, account_type, first_name, last_name, id_file_name, selfie_file_name):
+        body = self._request_body(email, account_type, first_name, last_name, id_file_name, selfie_file_name)
+        return get_backend().create_account(body)
+
+    async def asave(self, email, account_type, first_name, last_name, id_file_name, selfie_file_name):
+        body = self._request_body(email, account_type, first_name, last_name, id_file_name, selfie_file_name)
+        return await get_backend().acreate_account(body)
 
-        url = API_ENDPOINT + '/account'
+    def _run(self, input=""):
+        args = input.replace(" ", "").split(",")
+        # a wrong number of fields still fails in save, as before
+        refusal = self._unverified(*args[4:]) if len(args) == 6 else None
+        return refusal or self._respond(self.save(*args))
+
+    async def _arun(self, input=""):
+        args = input.replace(" ", "").split(",")
+        # a wrong number of fields still fails in save, as before
+        refusal = self._unverified(*args[4:]) if len(args) == 6 else None
+        return refusal or self._respond(await self.asave(*args))
+
+    def run_args(self, args: SaveDataArgs):
+        return self._unverified(args.id_file_name, args.selfie_file_name) or self._respond(self.save(**args.model_dump()))
+
+    async def arun_args(self, args: SaveDataArgs):
+        return self._unverified(args.id_file_name, args.selfie_file_name) or self._respond(await self.asave(**args.model_dump()))
+
+    def _unverified(self, id_file_name=None, selfie_file_name=None):
+        # the create-account API trusts its caller, so only documents verified in this conversation are saved
+        onboarding = _onboarding.get()
+        if onboarding is not None and not onboarding.ready_to_save(id_file_name, selfie_file_name):
+            return "The ID and selfie have not both been verified. Ask the user to upload the document that still needs verifying."
+        return None
+
+    def _request_body(self, email, account_type, first_name, last_name, id_file_name, selfie_file_name):
+        account_lookups = _account_lookups.get()
+        if account_lookups is not None:
+            # the account is about to exist; don't answer a later EmailValidation from the cache
+            account_lookups.discard(email.lower())
         body = {
             'email': email,
             'account_type': account_type,
@@ -156,17 +405,15 @@ class finish_onboarding(BaseTool):
             'id_file_name': id_file_name,
             'selfie_file_name': selfie_file_name
         }
-        print(body)
-        r = requests.post(url=url, json=body, timeout=300)
-        print(r)
+        return body
 
-        if r.status_code != 200:
+    def _respond(self, response_json):
+        if response_json["statusCode"] == 409:
+            return "Inform user that an account already exists with this email. Current status: " + response_json["body"]
+        if response_json["statusCode"] != 200:
             return "Something went wrong with creating an account. Please try again later."
 
-        return "Inform user of the status. Current status: " + r.json()["body"]
-
-    def _arun(self, query: str):
-        raise NotImplementedError("This tool does not support async")
+        return "Inform user of the status. Current status: " + response_json["body"]
 
 
 def get_tools():
@@ -174,7 +421,6 @@ def get_tools():
     # see here: https://langchain-langchain.vercel.app/docs/use_cases/agents/custom_agent_with_plugin_retrieval#tool-retriever
 
     # we only use one tool for now, but this is highly extensible!
-    knowledge_base = setup_knowledge_base()
     tools = [
         product_search(),
         email_validator(),
@@ -0,0 +1,127 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import BinaryIO, Optional, Tuple
+
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
+
+from penny.telemetry import span
+
+CHUNK_SIZE = 1024 * 1024
+
+# leading bytes of every file type the onboarding flow accepts, and the extension objects get
+FILE_SIGNATURES = {
+    b"\x89PNG\r\n\x1a\n": ("image/png", ".png"),
+    b"\xff\xd8\xff": ("image/jpeg", ".jpg"),
+    b"%PDF-": ("application/pdf", ".pdf"),
+}
+ALLOWED_CONTENT_TYPES = {"image/png", "image/jpeg", "image/jpg", "application/pdf"}
+
+
+class UploadRejected(Exception):
+    """The upload breaks a size or type limit; `status_code` is the HTTP status to answer with."""
+
+    def __init__(self, message: str, status_code: int = 400):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def sniff_file_type(head: bytes) -> Optional[Tuple[str, str]]:
+    for signature, file_type in FILE_SIGNATURES.items():
+        if head.startswith(signature):
+            return file_type
+    return None
+
+
+class DocumentStore:
+    """
+    Stores uploaded identity documents and selfies in S3.
+
+    Objects are named by the SHA-256 of their content, computed chunk by chunk, so a file that
+    was already stored is detected and not uploaded again. Large files go up as multipart
+    uploads through the shared S3 client.
+    """
+
+    def __init__(self, s3_client, bucket: str, max_bytes: int = 10 * 1024 * 1024, multipart_threshold: int = 8 * 1024 * 1024, known_keys: int = 4096):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.max_bytes = max_bytes
+        self.transfer_config = TransferConfig(multipart_threshold=multipart_threshold, multipart_chunksize=multipart_threshold)
+        self.known_keys = known_keys
+        self.duplicates = 0
+        self._stored: "OrderedDict[str, None]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def check_declared(self, content_type: Optional[str], content_length: Optional[int]) -> None:
+        """Reject an upload from its declared type and size, before the body is read."""
+        if content_type and content_type not in ALLOWED_CONTENT_TYPES:
+            raise UploadRejected("Unsupported file type " + content_type, status_code=415)
+        if content_length is not None and content_length > self.max_bytes:
+            raise UploadRejected("File is larger than {} MB".format(self.max_bytes // (1024 * 1024)), status_code=413)
+
+    def read(self, fileobj: BinaryIO, content_type: Optional[str] = None) -> Tuple[bytes, str]:
+        """Read an upload for preprocessing, enforcing the size and type limits; returns its bytes and sniffed type."""
+        self.check_declared(content_type, None)
+        fileobj.seek(0)
+        data = fileobj.read(self.max_bytes + 1)
+        if len(data) > self.max_bytes:
+            raise UploadRejected("File is larger than {} MB".format(self.max_bytes // (1024 * 1024)), status_code=413)
+        file_type = sniff_file_type(data[:16])
+        if file_type is None:
+            raise UploadRejected("Unsupported file type", status_code=415)
+        return data, file_type[0]
+
+    def store(self, fileobj: BinaryIO, content_type: Optional[str] = None) -> Tuple[str, bool]:
+        """Upload `fileobj`; returns the object name and whether it had to be uploaded."""
+        self.check_declared(content_type, None)
+        digest, extension = self._hash(fileobj)
+        obj_name = "my-doc-" + digest[:32] + extension
+
+        with span("s3.upload", **{"s3.bucket": self.bucket, "s3.key": obj_name}) as current:
+            if self._exists(obj_name):
+                self.duplicates += 1
+                current.set_attribute("s3.duplicate", True)
+                return obj_name, False
+
+            fileobj.seek(0)
+            self.s3_client.upload_fileobj(fileobj, self.bucket, obj_name, Config=self.transfer_config)
+            current.set_attributes({"s3.duplicate": False, "s3.bytes": fileobj.tell()})
+        self._remember(obj_name)
+        return obj_name, True
+
+    def _hash(self, fileobj: BinaryIO) -> Tuple[str, str]:
+        fileobj.seek(0)
+        head = fileobj.read(CHUNK_SIZE)
+        file_type = sniff_file_type(head)
+        if file_type is None:
+            raise UploadRejected("Unsupported file type", status_code=415)
+
+        sha256 = hashlib.sha256()
+        size = 0
+        chunk = head
+        while chunk:
+            size += len(chunk)
+            if size > self.max_bytes:
+                raise UploadRejected("File is larger than {} MB".format(self.max_bytes // (1024 * 1024)), status_code=413)
+            sha256.update(chunk)
+            chunk = fileobj.read(CHUNK_SIZE)
+        return sha256.hexdigest(), file_type[1]
+
+    def _exists(self, obj_name: str) -> bool:
+        with self._lock:
+            if obj_name in self._stored:
+                self._stored.move_to_end(obj_name)
+                return True
+        try:
+            self.s3_client.head_object(Bucket=self.bucket, Key=obj_name)
+        except ClientError:
+            return False
+        self._remember(obj_name)
+        return True
+
+    def _remember(self, obj_name: str) -> None:
+        with self._lock:
+            self._stored[obj_name] = None
+            while len(self._stored) > self.known_keys:
+                self._stored.popitem(last=False)
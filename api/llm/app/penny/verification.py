@@ -0,0 +1,93 @@
+import asyncio
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Hashable, Optional
+
+from penny.history import OnboardingState
+
+
+def _name_key(name: str) -> str:
+    # the verification request strips spaces and the comparison is case-insensitive
+    return name.replace(" ", "").lower()
+
+
+class VerificationPipeline:
+    """
+    Runs ID and selfie verification in a background worker pool as soon as the files land,
+    so the IDVerification / SelfieVerification tools usually find the result waiting.
+
+    Results are cached by object key (plus the names an ID is checked against). Failed or
+    unavailable checks are not cached, so the tool call retries them.
+    """
+
+    def __init__(
+        self,
+        verify_id: Callable[[str, str, str], dict],
+        compare_faces: Callable[[str, str], dict],
+        max_workers: int = 8,
+        max_entries: int = 1024,
+    ):
+        self._verify_id = verify_id
+        self._compare_faces = compare_faces
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="verification")
+        self._futures: "OrderedDict[Hashable, Future]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def prefetch(self, state: OnboardingState) -> None:
+        """Start every check the uploaded files in `state` allow; the ID and selfie checks run concurrently."""
+        if state.id_file_name and state.first_name and state.last_name:
+            self.submit_id(state.id_file_name, state.first_name, state.last_name)
+        if state.id_file_name and state.selfie_file_name:
+            self.submit_face(state.id_file_name, state.selfie_file_name)
+
+    def submit_id(self, file_name: str, first_name: str, last_name: str) -> Future:
+        key = ("id", file_name, _name_key(first_name), _name_key(last_name))
+        return self._submit(key, self._verify_id, file_name, first_name, last_name)
+
+    def submit_face(self, id_file_name: str, selfie_file_name: str) -> Future:
+        key = ("face", id_file_name, selfie_file_name)
+        return self._submit(key, self._compare_faces, id_file_name, selfie_file_name)
+
+    def verify_id(self, file_name: str, first_name: str, last_name: str) -> dict:
+        return self.submit_id(file_name, first_name, last_name).result()
+
+    def compare_faces(self, id_file_name: str, selfie_file_name: str) -> dict:
+        return self.submit_face(id_file_name, selfie_file_name).result()
+
+    async def averify_id(self, file_name: str, first_name: str, last_name: str) -> dict:
+        return await asyncio.wrap_future(self.submit_id(file_name, first_name, last_name))
+
+    async def acompare_faces(self, id_file_name: str, selfie_file_name: str) -> dict:
+        return await asyncio.wrap_future(self.submit_face(id_file_name, selfie_file_name))
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self) -> dict:
+        return {"entries": len(self._futures), "hits": self.hits, "misses": self.misses}
+
+    def _submit(self, key: Hashable, fn: Callable[..., dict], *args) -> Future:
+        with self._lock:
+            future = self._futures.get(key)
+            if future is not None and not self._failed(future):
+                self._futures.move_to_end(key)
+                self.hits += 1
+                return future
+
+            self.misses += 1
+            future = self._executor.submit(fn, *args)
+            self._futures[key] = future
+            while len(self._futures) > self.max_entries:
+                self._futures.popitem(last=False)
+            return future
+
+    @staticmethod
+    def _failed(future: Future) -> bool:
+        if not future.done():
+            return False
+        error: Optional[BaseException] = future.exception()
+        return error is not None or future.result().get("statusCode") != 200
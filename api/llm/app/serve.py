@@ -0,0 +1,39 @@
+"""
+Production entry point of the LLM service: uvicorn with one worker process per vCPU.
+
+Each worker builds its own agent, tools and clients when it starts (see main.build_service)
+and only reports ready once they exist. On SIGTERM the workers stop accepting connections
+and let the turns in progress finish for up to `drainSeconds` before shutting down.
+"""
+import os
+
+import uvicorn
+
+
+def available_cpus() -> int:
+    """vCPUs this container may use: its cgroup CPU quota if it has one, otherwise the CPUs it can run on."""
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()
+        if quota != "max":
+            return max(1, round(int(quota) / int(period)))
+    except (OSError, ValueError):
+        pass
+    return len(os.sched_getaffinity(0))
+
+
+def worker_count() -> int:
+    if os.environ.get("sessionStore", "memory") == "memory":
+        # conversations kept in one worker's memory would be lost on the others
+        return 1
+    return int(os.environ.get("webWorkers", 0)) or available_cpus()
+
+
+if __name__ == "__main__":
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=int(os.environ.get("port", 80)),
+        workers=worker_count(),
+        timeout_graceful_shutdown=int(os.environ.get("drainSeconds", 30)),
+    )
@@ -0,0 +1,154 @@
+"""
+Model calls per completed onboarding for the ReAct agent and the tool-calling agent.
+
+Replays the same scripted onboarding conversations (greeting, product question, email,
+account type, names, ID and selfie uploads, confirmation) through PennyAgent in both agent
+modes. A scripted stand-in for Bedrock answers invoke_model the way Claude would in each
+mode (ReAct text, or tool_use blocks) and the onboarding API is replaced by an in-memory
+backend, so the benchmark runs offline and counts every model call.
+
+A model sometimes formats a tool call wrongly. In ReAct mode a mangled tool name costs an
+extra iteration and a wrong number of comma separated fields fails the tool and the whole
+turn, which the customer then has to repeat. In tool-calling mode an invalid argument goes
+back to the model as an error result. Set how often each happens with --react-error-rate
+and --tool-error-rate; the stage engine is off so every turn reaches the model.
+
+Usage (from api/llm):
+    PYTHONPATH=app python benchmarks/agent_modes.py --conversations 200 --react-error-rate 0.1
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import os
+
+for name, value in {
+    "AWS_DEFAULT_REGION": "us-east-1",
+    "apiEndpoint": "http://localhost",
+    "kendraIndexId": "benchmark",
+    "idBucketName": "benchmark",
+}.items():
+    os.environ.setdefault(name, value)
+
+from langchain_community.chat_models import BedrockChat
+
+import penny.backends
+import penny.tools
+from penny.PennyAgent import PennyAgent
+from penny.knowledge_base import KnowledgeBase
+
+from fakes import PRODUCT_ANSWER, ScriptedBedrock
+
+CUSTOMER = {
+    "email": "jane.doe@example.com",
+    "account_type": "CHEQUING",
+    "first_name": "Mary Ann",
+    "last_name": "Doe",
+    "id_file_name": "my-doc-id.png",
+    "selfie_file_name": "my-doc-selfie.png",
+}
+SCRIPT = [
+    "Hi",
+    "I'd like to open an account",
+    CUSTOMER["email"],
+    "What is the monthly fee on a chequing account?",
+    CUSTOMER["account_type"],
+    CUSTOMER["first_name"],
+    CUSTOMER["last_name"],
+    "[System] uploaded file-name: " + CUSTOMER["id_file_name"],
+    "[System] uploaded file-name: " + CUSTOMER["selfie_file_name"],
+    "Yes, that's all correct",
+]
+TURN_ATTEMPTS = 3
+
+
+def ok(body):
+    return {"statusCode": 200, "body": body}
+
+
+class InMemoryBackend:
+    """Onboarding API stand-in; records the accounts it creates."""
+
+    def __init__(self):
+        self.accounts = []
+
+    def get_account(self, email):
+        return ok("Account with given email does not exist. Proceed with account opening.")
+
+    async def aget_account(self, email):
+        return self.get_account(email)
+
+    def create_account(self, account):
+        self.accounts.append(account)
+        return ok("New account created successfully. Welcome email on its way")
+
+    async def acreate_account(self, account):
+        return self.create_account(account)
+
+    def verify_id(self, file_name, required_field_values):
+        return ok("Document has been verified")
+
+    def verify_face(self, id_file_name, selfie_file_name):
+        return ok("Face match verified")
+
+
+class ProductAnswers:
+    def run(self, question):
+        return PRODUCT_ANSWER
+
+    async def arun(self, question):
+        return self.run(question)
+
+
+async def replay(agent):
+    """Run the script; returns the number of turns that failed and had to be repeated."""
+    agent.seed_agent()
+    failed_turns = 0
+    for message in SCRIPT:
+        for _ in range(TURN_ATTEMPTS):
+            agent.human_step(message)
+            try:
+                await agent.astep()
+                break
+            except Exception:
+                failed_turns += 1
+    return failed_turns
+
+
+def run(mode, args):
+    bedrock = ScriptedBedrock(react_error_rate=args.react_error_rate, tool_error_rate=args.tool_error_rate, seed=args.seed)
+    llm = BedrockChat(model_id="anthropic.claude-3-5-sonnet-20240620-v1:0", client=bedrock, model_kwargs={"temperature": 0.5})
+    template = PennyAgent.from_llm(llm, verbose=False, assistant_name="Penny", use_tools=True, use_stage_engine=False, agent_mode=mode)
+    backend = penny.backends._backend = InMemoryBackend()
+
+    failed_turns, completed = 0, 0
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(args.conversations):
+            saved = len(backend.accounts)
+            failed_turns += asyncio.run(replay(template.spawn()))
+            completed += len(backend.accounts) > saved
+
+    # ReAct splits SaveData's input on commas and drops spaces, e.g. "Mary Ann" is saved as "MaryAnn"
+    as_given = sum(account == CUSTOMER for account in backend.accounts)
+    print("{:<13} completed {:>4}/{} ({} with the details as given)   model calls {:>5}   per onboarding {:5.2f}   failed turns {:>3}   ~{:.0f} input tokens per call".format(
+        mode, completed, args.conversations, as_given, bedrock.calls, bedrock.calls / max(completed, 1), failed_turns,
+        bedrock.input_chars / 4 / max(bedrock.calls, 1)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--conversations", type=int, default=100)
+    parser.add_argument("--react-error-rate", type=float, default=0.1, help="share of ReAct tool calls formatted wrongly")
+    parser.add_argument("--tool-error-rate", type=float, default=0.0, help="share of tool_use calls with invalid arguments")
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    penny.tools._knowledge_base = KnowledgeBase(ProductAnswers)
+    print("{} conversations of {} turns".format(args.conversations, len(SCRIPT)))
+    for mode in ("react", "tool_calling"):
+        run(mode, args)
+    penny.tools.get_verification_pipeline().shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+"""
+Fault injection for the Bedrock resilience layer (penny.resilience): sends the same model
+calls through a plain client and through ResilientBedrock while `fakes.FaultyBedrock`
+injects the ways Bedrock fails under load, and reports how many calls still succeed, how
+many requests Bedrock received and the latency of the successful calls.
+
+Scenarios:
+  throttling  more calls per second than the on-demand quota allows (--quota)
+  tail        a share of calls is much slower than the rest; hedging on and off
+  outage      the main model is unavailable; falling back to the smaller model
+
+"plain" sends each call once to the bare client (boto3's own retries are off for Bedrock,
+see penny.clients). Everything runs offline and in-process.
+
+Usage (from api/llm):
+    PYTHONPATH=app python benchmarks/bedrock_faults.py --calls 300 --concurrency 16
+"""
+import argparse
+import json
+import os
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+from penny.resilience import AdaptiveRateLimiter, ResilientBedrock
+
+from fakes import FaultyBedrock, Latency, ScriptedBedrock
+
+MODEL = "anthropic.claude-3-5-sonnet-20240620-v1:0"
+FAST_MODEL = "anthropic.claude-3-haiku-20240307-v1:0"
+BODY = json.dumps({
+    "anthropic_version": "bedrock-2023-05-31",
+    "max_tokens": 512,
+    "messages": [{"role": "user", "content": "What is the monthly fee on a chequing account?"}],
+})
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def run_calls(client, calls, concurrency):
+    def call(_):
+        started = time.perf_counter()
+        try:
+            client.invoke_model(modelId=MODEL, body=BODY, accept="application/json", contentType="application/json")
+        except Exception:
+            return None
+        return time.perf_counter() - started
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        latencies = list(pool.map(call, range(calls)))
+    succeeded = [latency for latency in latencies if latency is not None]
+    result = {
+        "succeeded": len(succeeded),
+        "failed": calls - len(succeeded),
+        "elapsed_s": round(time.perf_counter() - started, 2),
+    }
+    if succeeded:
+        result.update(
+            p50_ms=round(statistics.median(succeeded) * 1000),
+            p95_ms=round(percentile(succeeded, 0.95) * 1000),
+            p99_ms=round(percentile(succeeded, 0.99) * 1000),
+        )
+    return result
+
+
+def scenarios(args):
+    """(scenario, configuration, fault options, client options; None for a plain client)."""
+    return [
+        ("throttling", "plain", dict(quota=args.quota), None),
+        ("throttling", "resilient", dict(quota=args.quota), dict()),
+        ("tail", "plain", dict(slow_rate=args.slow_rate, slow_seconds=args.slow_seconds), None),
+        ("tail", "resilient", dict(slow_rate=args.slow_rate, slow_seconds=args.slow_seconds), dict()),
+        ("tail", "resilient+hedging", dict(slow_rate=args.slow_rate, slow_seconds=args.slow_seconds), dict(hedge_after=args.hedge_after_ms / 1000)),
+        ("outage", "plain", dict(down_models=[MODEL]), None),
+        ("outage", "resilient", dict(down_models=[MODEL]), dict()),
+        ("outage", "resilient+fallback", dict(down_models=[MODEL]), dict(fallback_model_id=FAST_MODEL)),
+    ]
+
+
+def run(args):
+    report = []
+    for scenario, configuration, faults, options in scenarios(args):
+        if args.scenario not in ("all", scenario):
+            continue
+        bedrock = FaultyBedrock(ScriptedBedrock(Latency(args.llm_latency)), **faults)
+        client = bedrock
+        if options is not None:
+            client = ResilientBedrock(bedrock, rate_limiter=AdaptiveRateLimiter(), seed=7, **options)
+        result = run_calls(client, args.calls, args.concurrency)
+        result.update(scenario=scenario, configuration=configuration, requests=sum(bedrock.requests.values()), throttled=bedrock.throttled)
+        if options is not None:
+            result["models"] = client.stats()["models"]
+            client.shutdown()
+        report.append(result)
+    return report
+
+
+def print_report(report):
+    print("  {:<11} {:<19} {:>9} {:>7} {:>9} {:>9} {:>7} {:>7} {:>7} {:>9}".format(
+        "scenario", "configuration", "succeeded", "failed", "requests", "throttled", "p50 ms", "p95 ms", "p99 ms", "elapsed s"))
+    for row in report:
+        print("  {scenario:<11} {configuration:<19} {succeeded:>9} {failed:>7} {requests:>9} {throttled:>9} "
+              "{p50:>7} {p95:>7} {p99:>7} {elapsed_s:>9}".format(
+                  p50=row.get("p50_ms", "-"), p95=row.get("p95_ms", "-"), p99=row.get("p99_ms", "-"), **row))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenario", default="all", choices=["all", "throttling", "tail", "outage"])
+    parser.add_argument("--calls", type=int, default=300)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--llm-latency", type=float, default=0.2, help="simulated Bedrock latency in seconds")
+    parser.add_argument("--quota", type=float, default=20, help="requests per second Bedrock accepts before throttling")
+    parser.add_argument("--slow-rate", type=float, default=0.05, help="share of calls that are slow")
+    parser.add_argument("--slow-seconds", type=float, default=2.0, help="extra latency of a slow call")
+    parser.add_argument("--hedge-after-ms", type=float, default=500)
+    parser.add_argument("--json", help="also write the report to this file")
+    args = parser.parse_args()
+
+    report = run(args)
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,78 @@
+"""
+Concurrent-turn throughput of one LLM service worker.
+
+Replaces the Bedrock model with a fake chat model that blocks for a fixed latency (the way
+the boto3 call inside BedrockChat does), then fires concurrent /question turns from separate
+sessions at the FastAPI app in-process.
+
+Usage (from api/llm):
+    PYTHONPATH=app python benchmarks/concurrent_turns.py --sessions 50 --latency 0.5
+"""
+import argparse
+import asyncio
+import os
+import time
+
+for name, value in {
+    "AWS_DEFAULT_REGION": "us-east-1",
+    "apiEndpoint": "http://localhost",
+    "kendraIndexId": "benchmark",
+    "idBucketName": "benchmark",
+}.items():
+    os.environ.setdefault(name, value)
+
+import httpx
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+
+import main
+
+
+class BlockingFakeChatModel(BaseChatModel):
+    """Answers immediately with a final answer after a blocking sleep, like a boto3 invoke_model call."""
+
+    latency: float = 0.5
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        time.sleep(self.latency)
+        message = AIMessage(content="Final Answer: Happy to help with that! <END_OF_TURN>")
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    @property
+    def _llm_type(self) -> str:
+        return "blocking-fake"
+
+
+async def run_session(client: httpx.AsyncClient, turns: int) -> int:
+    session_id = (await client.get("/")).json()["session_id"]
+    for _ in range(turns):
+        response = await client.post("/question", json={"message": "hello"}, headers={"X-Session-Id": session_id})
+        response.raise_for_status()
+    return turns
+
+
+async def run(sessions: int, turns: int) -> None:
+    await main.startup()
+    await main.warm_up
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://penny") as client:
+        started = time.perf_counter()
+        completed = await asyncio.gather(*[run_session(client, turns) for _ in range(sessions)])
+        elapsed = time.perf_counter() - started
+
+    total_turns = sum(completed)
+    serial_estimate = total_turns * main.get_template_agent().agent_executor.agent.llm_chain.llm.latency
+    print(f"sessions={sessions} turns={total_turns} elapsed={elapsed:.2f}s")
+    print(f"throughput={total_turns / elapsed:.1f} turns/s (a blocking event loop would need ~{serial_estimate:.1f}s)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sessions", type=int, default=50)
+    parser.add_argument("--turns", type=int, default=2)
+    parser.add_argument("--latency", type=float, default=0.5, help="simulated Bedrock latency in seconds")
+    args = parser.parse_args()
+
+    main.get_template_agent().agent_executor.agent.llm_chain.llm = BlockingFakeChatModel(latency=args.latency)
+    asyncio.run(run(args.sessions, args.turns))
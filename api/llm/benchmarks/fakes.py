@@ -0,0 +1,388 @@
+"""
+Offline stand-ins for Bedrock and the AWS services the LLM service calls, for the benchmarks.
+
+`ScriptedBedrock` answers like Claude following the onboarding stages, in ReAct text or
+with tool_use blocks, optionally after an injected latency. The other fakes keep their
+state in memory and implement only the calls the service and the onboarding library
+make. `install` puts them in the shared client cache, so the service and LocalBackend use
+them in place of boto3 clients; call it before importing `main`.
+"""
+import io
+import json
+import random
+import re
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+import penny.clients
+from penny.knowledge_base import normalize_question
+
+EMAIL = re.compile(r"[\w.+-]+@[\w-]+\.[\w.]+")
+UPLOAD = re.compile(r"uploaded file-name: (\S+)")
+USER_LINE = re.compile(r"^User: (.*)$", re.MULTILINE)
+ACCOUNT_TYPES = ("CHEQUING", "SAVINGS")
+PRODUCT_ANSWER = "The AnyBank chequing account has no monthly fee."
+
+
+class Latency:
+    """Blocking sleep of `seconds`, give or take `jitter` (a fraction), like a boto3 call."""
+
+    def __init__(self, seconds=0.0, jitter=0.2, seed=7):
+        self.seconds = seconds
+        self.jitter = jitter
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if self.seconds <= 0:
+            return
+        with self._lock:
+            factor = 1 + self._random.uniform(-self.jitter, self.jitter)
+        time.sleep(self.seconds * factor)
+
+
+def client_error(code, operation):
+    return ClientError({"Error": {"Code": code, "Message": code}}, operation)
+
+
+def onboarding_details(user_lines):
+    """The details a customer gave so far, read from their messages in order."""
+    texts = list(dict.fromkeys(line.strip() for line in user_lines))
+    details = {"uploads": list(dict.fromkeys(match.group(1) for text in texts for match in UPLOAD.finditer(text)))}
+    emails = [text for text in texts if EMAIL.fullmatch(text)]
+    details["email"] = emails[0] if emails else None
+    account_types = [text for text in texts if text.upper() in ACCOUNT_TYPES]
+    if account_types:
+        details["account_type"] = account_types[0].upper()
+        names = texts[texts.index(account_types[0]) + 1:][:2]
+        details["first_name"], details["last_name"] = (names + [None, None])[:2]
+    return details
+
+
+def tool_for(user_lines):
+    """The tool Claude calls for the customer's latest message, with its arguments, or None."""
+    text = user_lines[-1].strip()
+    details = onboarding_details(user_lines)
+    if EMAIL.fullmatch(text):
+        return "EmailValidation", {"email": text}
+    if "?" in text:
+        return "ProductSearch", {"question": text}
+    upload = UPLOAD.search(text)
+    if upload and upload.group(1) == details["uploads"][0]:
+        return "IDVerification", {
+            "id_file_name": upload.group(1), "first_name": details["first_name"], "last_name": details["last_name"]}
+    if upload:
+        return "SelfieVerification", {"id_file_name": details["uploads"][0], "selfie_file_name": upload.group(1)}
+    if text.lower().startswith("yes"):
+        return "SaveData", {
+            "email": details["email"], "account_type": details["account_type"],
+            "first_name": details["first_name"], "last_name": details["last_name"],
+            "id_file_name": details["uploads"][0], "selfie_file_name": details["uploads"][-1],
+        }
+    return None
+
+
+class ScriptedBedrock:
+    """
+    Answers invoke_model (and its streaming variant) like Claude following the onboarding
+    stages: a tool call when the stage needs one, then a reply once the tool result is in.
+    Requests with "tools" are answered with tool_use blocks, agent prompts with ReAct text,
+    anything else (e.g. the product search chain) with a canned answer.
+
+    `react_error_rate` / `tool_error_rate` are the shares of tool calls formatted wrongly:
+    a mangled tool name or a missing comma separated field in ReAct mode, a missing
+    argument in tool-calling mode.
+    """
+
+    def __init__(self, latency=None, react_error_rate=0.0, tool_error_rate=0.0, seed=7):
+        self.latency = latency or Latency()
+        self.react_error_rate = react_error_rate
+        self.tool_error_rate = tool_error_rate
+        self.random = random.Random(seed)
+        self.calls = 0
+        self.input_chars = 0
+        self.tool_use_id = 0
+        self._lock = threading.Lock()
+
+    def invoke_model(self, modelId, body, accept=None, contentType=None, **kwargs):
+        response = self._respond(body)
+        return {"body": io.BytesIO(json.dumps(response).encode())}
+
+    def invoke_model_with_response_stream(self, modelId, body, accept=None, contentType=None, **kwargs):
+        response = self._respond(body)
+        text = "".join(block.get("text", "") for block in response["content"])
+        events = [{"type": "message_start"}, {"type": "content_block_start"}]
+        events += [{"type": "content_block_delta", "delta": {"type": "text_delta", "text": token}}
+                   for token in re.findall(r"\S+\s*|\s+", text)]
+        events.append({"type": "content_block_stop"})
+        return {"body": [{"chunk": {"bytes": json.dumps(event).encode()}} for event in events]}
+
+    def _respond(self, body):
+        with self._lock:
+            self.calls += 1
+            self.input_chars += len(body)
+        self.latency.wait()
+        request = json.loads(body)
+        if "tools" in request:
+            return self._tool_calling(request)
+        prompt = "".join(
+            block if isinstance(block, str) else block["text"]
+            for message in request["messages"]
+            for block in ([message["content"]] if isinstance(message["content"], str) else message["content"])
+        )
+        if "<Conversation history>" in prompt:
+            return self._react(prompt)
+        return self._text(PRODUCT_ANSWER)
+
+    def _react(self, prompt):
+        history, _, scratchpad = prompt.rpartition("<Conversation history>\n")[2].partition("\n\n")
+        call = tool_for(USER_LINE.findall(history))
+        observations = re.findall(r"Observation: (.*)", scratchpad)
+        if call is None or (observations and "is not a valid tool" not in observations[-1]):
+            return self._text("Final Answer: Happy to help with that!")
+
+        name, args = call
+        fields = list(args.values())
+        if not observations and self._chance(self.react_error_rate):
+            if len(fields) > 1 and self._chance(0.5):
+                fields = fields[:-1]
+            else:
+                name = "the " + name + " tool"
+        action = "Thought: I need a tool\nDecision: Do I need to use a tool? y\nAction: {}\nAction Input: {}".format(name, ", ".join(fields))
+        return self._text(action)
+
+    def _tool_calling(self, request):
+        user_lines = USER_LINE.findall(request["messages"][0]["content"])
+        last = request["messages"][-1]["content"]
+        if isinstance(last, list):
+            if any(result["is_error"] for result in last):
+                return self._tool_use(*tool_for(user_lines))
+            return self._text("Happy to help with that!")
+
+        call = tool_for(user_lines)
+        if call is None:
+            return self._text("Happy to help with that!")
+        name, args = call
+        if self._chance(self.tool_error_rate):
+            args = dict(list(args.items())[:-1])
+        return self._tool_use(name, args)
+
+    def _chance(self, rate):
+        with self._lock:
+            return self.random.random() < rate
+
+    def _text(self, text):
+        return {"content": [{"type": "text", "text": text}], "stop_reason": "end_turn"}
+
+    def _tool_use(self, name, args):
+        with self._lock:
+            self.tool_use_id += 1
+            block = {"type": "tool_use", "id": "toolu_{}".format(self.tool_use_id), "name": name, "input": args}
+        return {"content": [block], "stop_reason": "tool_use"}
+
+
+class ExtractiveBedrock:
+    """
+    Answers the product search chain the way a model summarising its passages would: with
+    the catalog line that shares most words with the question. Responses take
+    `first_token_seconds` plus time per input and output token, like a Claude model, and
+    report their token usage as Bedrock does.
+    """
+
+    def __init__(self, first_token_seconds=0.5, seconds_per_input_token=0.0, seconds_per_output_token=0.01):
+        self.first_token_seconds = first_token_seconds
+        self.seconds_per_input_token = seconds_per_input_token
+        self.seconds_per_output_token = seconds_per_output_token
+
+    def invoke_model(self, modelId, body, accept=None, contentType=None, **kwargs):
+        request = json.loads(body)
+        content = request["messages"][-1]["content"]
+        question = content if isinstance(content, str) else "".join(block["text"] for block in content)
+        context = request.get("system", "").partition("----------------\n")[2]
+        answer = "According to the AnyBank catalog: " + self.best_line(context, question)
+        usage = {"input_tokens": (len(body) + 3) // 4, "output_tokens": (len(answer) + 3) // 4}
+        time.sleep(self.first_token_seconds + usage["input_tokens"] * self.seconds_per_input_token
+                   + usage["output_tokens"] * self.seconds_per_output_token)
+        response = {"content": [{"type": "text", "text": answer}], "stop_reason": "end_turn", "usage": usage}
+        return {"body": io.BytesIO(json.dumps(response).encode())}
+
+    @staticmethod
+    def best_line(context, question):
+        words = set(normalize_question(question).split())
+        lines = [line.strip(" -") for line in context.splitlines() if line.strip(" -")]
+        if not lines:
+            return "I don't know."
+        return max(lines, key=lambda line: len(words & set(normalize_question(line).split())))
+
+
+class FaultyBedrock:
+    """
+    Injects Bedrock's failure modes in front of another fake: ThrottlingException once
+    `quota` requests were accepted in the last second (like an on-demand quota) and
+    for a random `throttle_rate` share of calls, a `slow_seconds` delay on a `slow_rate`
+    share of calls (the latency tail), and ServiceUnavailableException for every call to a
+    model in `down_models`. Counts the requests each model received.
+    """
+
+    def __init__(self, bedrock, quota=None, throttle_rate=0.0, slow_rate=0.0, slow_seconds=0.0, down_models=(), seed=7):
+        self.bedrock = bedrock
+        self.quota = quota
+        self.throttle_rate = throttle_rate
+        self.slow_rate = slow_rate
+        self.slow_seconds = slow_seconds
+        self.down_models = set(down_models)
+        self.random = random.Random(seed)
+        self.requests = {}
+        self.throttled = 0
+        self._recent = []
+        self._lock = threading.Lock()
+
+    def invoke_model(self, modelId, **kwargs):
+        self._admit(modelId, "InvokeModel")
+        return self.bedrock.invoke_model(modelId=modelId, **kwargs)
+
+    def invoke_model_with_response_stream(self, modelId, **kwargs):
+        self._admit(modelId, "InvokeModelWithResponseStream")
+        return self.bedrock.invoke_model_with_response_stream(modelId=modelId, **kwargs)
+
+    def _admit(self, model_id, operation):
+        with self._lock:
+            now = time.monotonic()
+            self.requests[model_id] = self.requests.get(model_id, 0) + 1
+            self._recent = [sent for sent in self._recent if sent > now - 1]
+            over_quota = self.quota is not None and len(self._recent) >= self.quota
+            throttle = over_quota or self.random.random() < self.throttle_rate
+            slow = self.random.random() < self.slow_rate
+            if throttle:
+                self.throttled += 1
+            else:
+                self._recent.append(now)
+        if model_id in self.down_models:
+            raise client_error("ServiceUnavailableException", operation)
+        if throttle:
+            raise client_error("ThrottlingException", operation)
+        if slow:
+            time.sleep(self.slow_seconds)
+
+
+class FakeS3:
+    def __init__(self, latency=None):
+        self.latency = latency or Latency()
+        self.objects = {}
+
+    def upload_fileobj(self, fileobj, Bucket, Key, Config=None, **kwargs):
+        self.latency.wait()
+        self.objects[(Bucket, Key)] = fileobj.read()
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.latency.wait()
+        self.objects[(Bucket, Key)] = Body if isinstance(Body, bytes) else Body.read()
+
+    def head_object(self, Bucket, Key, **kwargs):
+        self.latency.wait()
+        if (Bucket, Key) not in self.objects:
+            raise client_error("404", "HeadObject")
+        return {"ETag": '"{}"'.format(hash(self.objects[(Bucket, Key)]) & 0xFFFFFFFF), "ContentLength": len(self.objects[(Bucket, Key)])}
+
+    def get_object(self, Bucket, Key, **kwargs):
+        self.latency.wait()
+        if (Bucket, Key) not in self.objects:
+            raise client_error("NoSuchKey", "GetObject")
+        return {"Body": io.BytesIO(self.objects[(Bucket, Key)])}
+
+
+class FakeTextract:
+    """AnalyzeID reading the same names off every document."""
+
+    def __init__(self, latency=None, names=("MARY ANN", "DOE")):
+        self.latency = latency or Latency()
+        self.names = names
+
+    def analyze_id(self, DocumentPages, **kwargs):
+        self.latency.wait()
+        first_name, last_name = self.names
+        fields = [
+            {"Type": {"Text": field_type}, "ValueDetection": {"Text": value, "Confidence": 99.0}}
+            for field_type, value in (("FIRST_NAME", first_name), ("LAST_NAME", last_name), ("DOCUMENT_NUMBER", "X1234567"))
+        ]
+        return {"IdentityDocuments": [{"DocumentIndex": 1, "IdentityDocumentFields": fields}]}
+
+
+class FakeRekognition:
+    FACE = {"BoundingBox": {"Width": 0.3, "Height": 0.4, "Left": 0.35, "Top": 0.2}, "Confidence": 99.9}
+
+    def __init__(self, latency=None):
+        self.latency = latency or Latency()
+
+    def detect_faces(self, Image, **kwargs):
+        self.latency.wait()
+        return {"FaceDetails": [self.FACE]}
+
+    def compare_faces(self, SourceImage, TargetImage, **kwargs):
+        self.latency.wait()
+        return {"FaceMatches": [{"Similarity": 99.1, "Face": self.FACE}], "UnmatchedFaces": []}
+
+
+class FakeDynamoDB:
+    def __init__(self, latency=None):
+        self.latency = latency or Latency()
+        self.items = {}
+        self._lock = threading.Lock()
+
+    def get_item(self, TableName, Key, **kwargs):
+        self.latency.wait()
+        item = self.items.get((TableName, Key["email"]["S"]))
+        return {"Item": item} if item is not None else {}
+
+    def put_item(self, TableName, Item, ConditionExpression=None, **kwargs):
+        self.latency.wait()
+        key = (TableName, Item["email"]["S"])
+        with self._lock:
+            if ConditionExpression and key in self.items:
+                error = client_error("ConditionalCheckFailedException", "PutItem")
+                error.response["Item"] = self.items[key]
+                raise error
+            self.items[key] = Item
+        return {}
+
+
+class FakeSQS:
+    def __init__(self, latency=None):
+        self.latency = latency or Latency()
+        self.messages = []
+
+    def send_message(self, QueueUrl, MessageBody, **kwargs):
+        self.latency.wait()
+        self.messages.append(MessageBody)
+        return {"MessageId": str(len(self.messages))}
+
+
+class FakeKendra:
+    def __init__(self, latency=None):
+        self.latency = latency or Latency()
+
+    def retrieve(self, IndexId, QueryText, **kwargs):
+        self.latency.wait()
+        item = {
+            "Id": "1", "DocumentId": "catalog", "DocumentURI": "s3://catalog/AnyBankProductCatalog.csv",
+            "DocumentTitle": "AnyBank Product Catalog", "Content": PRODUCT_ANSWER, "DocumentAttributes": [],
+            "ScoreAttributes": {"ScoreConfidence": "HIGH"},
+        }
+        return {"QueryId": "q", "ResultItems": [item]}
+
+
+def install(bedrock, aws_latency=None):
+    """Replace the shared boto3 clients with the fakes; returns them by service name."""
+    clients = {
+        "bedrock-runtime": bedrock,
+        "s3": FakeS3(aws_latency),
+        "textract": FakeTextract(aws_latency),
+        "rekognition": FakeRekognition(aws_latency),
+        "dynamodb": FakeDynamoDB(aws_latency),
+        "sqs": FakeSQS(aws_latency),
+        "kendra": FakeKendra(aws_latency),
+    }
+    penny.clients._clients.update(clients)
+    return clients
@@ -0,0 +1,223 @@
+"""
+Offline load test of the LLM service: replays scripted onboarding conversations against the
+FastAPI app in-process and reports throughput and latency percentiles.
+
+Bedrock is replaced by `fakes.ScriptedBedrock` (deterministic replies after an injected
+latency) and S3, Textract, Rekognition, DynamoDB, SQS and Kendra by in-memory fakes. The
+onboarding tools run with toolBackend=local, i.e. the Lambda functions' library in-process
+in place of API Gateway and Lambda. Each session creates a conversation, asks a product
+question, opens an account with the ID and selfie from api/lambdas/test and confirms it.
+
+Reports turns/sec, p50/p95/p99 per endpoint and per stage of the script, and memory per
+session. Turns rejected with 429 are sent again after their Retry-After, as the demo
+application would, and count towards their latency. With --json the report is also written to a file, and --max-p95-ms makes the run
+fail when any endpoint's p95 is above the limit, so it can gate CI.
+
+Usage (from api/llm):
+    PYTHONPATH=app:../lambdas python benchmarks/load_test.py --sessions 50 --concurrency 10 --llm-latency 0.5
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import resource
+import sys
+import time
+from collections import defaultdict
+
+for name, value in {
+    "AWS_DEFAULT_REGION": "us-east-1",
+    "apiEndpoint": "http://localhost",
+    "kendraIndexId": "benchmark",
+    "idBucketName": "benchmark",
+    "toolBackend": "local",
+    "customerTableName": "customers",
+    "welcomeQueueUrl": "https://sqs.us-east-1.amazonaws.com/000000000000/WelcomeEmailQueue",
+    "retrieverBackend": "kendra",
+}.items():
+    os.environ.setdefault(name, value)
+
+import httpx
+
+import fakes
+
+# times a turn answered with 429 is sent again, after its Retry-After
+MAX_RETRIES = 3
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "lambdas", "test")
+
+
+def read_fixture(name):
+    with open(os.path.join(FIXTURES, name), "rb") as f:
+        return f.read()
+
+
+def script(n, id_image, selfie_image):
+    """(stage, endpoint, message or upload) for one customer's onboarding."""
+    return [
+        ("greeting", "/question", "Hi"),
+        ("open account", "/question", "I'd like to open an account"),
+        ("email", "/question", "customer{}@example.com".format(n)),
+        ("product question", "/question", "What is the monthly fee on a chequing account?"),
+        ("account type", "/question", "CHEQUING"),
+        ("first name", "/question", "Mary Ann"),
+        ("last name", "/question", "Doe"),
+        ("id upload", "/uploadDoc", ("passport.png", id_image)),
+        ("selfie upload", "/uploadDoc", ("selfie.png", selfie_image)),
+        ("confirmation", "/question", "Yes, that's all correct"),
+    ]
+
+
+class Timings:
+    def __init__(self):
+        self.by_endpoint = defaultdict(list)
+        self.by_stage = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.retries = 0
+
+    @contextlib.asynccontextmanager
+    async def timed(self, endpoint, stage):
+        started = time.perf_counter()
+        yield
+        elapsed = time.perf_counter() - started
+        self.by_endpoint[endpoint].append(elapsed)
+        self.by_stage[stage].append(elapsed)
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))]
+
+
+def summary(values):
+    return {
+        "count": len(values),
+        "p50_ms": round(percentile(values, 50) * 1000, 1),
+        "p95_ms": round(percentile(values, 95) * 1000, 1),
+        "p99_ms": round(percentile(values, 99) * 1000, 1),
+    }
+
+
+async def run_session(client, n, timings, images):
+    async with timings.timed("GET /", "new session"):
+        response = await client.get("/")
+    headers = {"X-Session-Id": response.json()["session_id"]}
+
+    for stage, endpoint, payload in script(n, *images):
+        async with timings.timed("POST " + endpoint, stage):
+            for attempt in range(MAX_RETRIES + 1):
+                if endpoint == "/uploadDoc":
+                    response = await client.post(endpoint, files={"file": (payload[0], payload[1], "image/png")}, headers=headers)
+                else:
+                    response = await client.post(endpoint, json={"message": payload}, headers=headers)
+                if response.status_code != 429 or attempt == MAX_RETRIES:
+                    break
+                timings.retries += 1
+                await asyncio.sleep(float(response.headers["Retry-After"]))
+        if response.status_code != 200:
+            # the rest of the script assumes this turn went through
+            timings.errors["{} {}".format(endpoint, response.status_code)] += 1
+            return
+
+
+def load_service(bedrock, aws_latency):
+    """Import the app with the fakes in place of the AWS clients it creates at import time."""
+    clients = fakes.install(bedrock, aws_latency)
+    import main
+    return main, clients
+
+
+async def run(args):
+    bedrock = fakes.ScriptedBedrock(latency=fakes.Latency(args.llm_latency))
+    main, clients = load_service(bedrock, fakes.Latency(args.aws_latency, seed=11))
+    images = (read_fixture("passport.png"), read_fixture("selfie.png"))
+    timings = Timings()
+    await main.startup()
+    await main.warm_up
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://penny", timeout=None) as client:
+        # warm-up: starts the image workers and builds the product search chain
+        for n in range(args.warmup):
+            await run_session(client, "-warmup-{}".format(n), Timings(), images)
+
+        sessions_before = main.get_sessions().stats()
+        accounts_before = len(clients["dynamodb"].items)
+        bedrock_calls_before = bedrock.calls
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        semaphore = asyncio.Semaphore(args.concurrency)
+
+        async def limited(n):
+            async with semaphore:
+                await run_session(client, n, timings, images)
+
+        started = time.perf_counter()
+        await asyncio.gather(*[limited(n) for n in range(args.sessions)])
+        elapsed = time.perf_counter() - started
+
+    sessions_after = main.get_sessions().stats()
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    await main.shutdown()
+
+    turns = sum(len(values) for endpoint, values in timings.by_endpoint.items() if endpoint != "GET /")
+    new_sessions = max(1, sessions_after["sessions"] - sessions_before["sessions"])
+    return {
+        "sessions": args.sessions,
+        "concurrency": args.concurrency,
+        "llm_latency_s": args.llm_latency,
+        "aws_latency_s": args.aws_latency,
+        "elapsed_s": round(elapsed, 2),
+        "turns": turns,
+        "turns_per_s": round(turns / elapsed, 1),
+        "bedrock_calls": bedrock.calls - bedrock_calls_before,
+        "accounts_created": len(clients["dynamodb"].items) - accounts_before,
+        "retries": timings.retries,
+        "errors": dict(timings.errors),
+        "endpoints": {endpoint: summary(values) for endpoint, values in timings.by_endpoint.items()},
+        "stages": {stage: summary(values) for stage, values in timings.by_stage.items()},
+        "memory_per_session_kb": {
+            # the session registry's own estimate of the history it holds, and the process's peak RSS growth
+            "estimated": round((sessions_after["memory_bytes"] - sessions_before["memory_bytes"]) / new_sessions / 1024, 1),
+            "peak_rss": round((rss_after - rss_before) / new_sessions, 1),
+        },
+    }
+
+
+def print_report(report):
+    print("{sessions} sessions ({concurrency} at a time), {turns} turns in {elapsed_s}s: {turns_per_s} turns/s, "
+          "{bedrock_calls} Bedrock calls, {accounts_created} accounts created".format(**report))
+    for title, rows in (("endpoint", report["endpoints"]), ("stage", report["stages"])):
+        print("  {:<22} {:>6} {:>9} {:>9} {:>9}".format(title, "count", "p50 ms", "p95 ms", "p99 ms"))
+        for name, row in rows.items():
+            print("  {:<22} {count:>6} {p50_ms:>9} {p95_ms:>9} {p99_ms:>9}".format(name, **row))
+    print("  memory per session: ~{estimated} KB of history, {peak_rss} KB peak RSS growth".format(**report["memory_per_session_kb"]))
+    if report["retries"]:
+        print("  {retries} turns sent again after a 429".format(**report))
+    if report["errors"]:
+        print("  errors: " + ", ".join("{} x{}".format(key, count) for key, count in report["errors"].items()))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sessions", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--llm-latency", type=float, default=0.5, help="simulated Bedrock latency in seconds")
+    parser.add_argument("--aws-latency", type=float, default=0.02, help="simulated latency of other AWS calls in seconds")
+    parser.add_argument("--warmup", type=int, default=1, help="sessions run before measuring")
+    parser.add_argument("--json", help="also write the report to this file")
+    parser.add_argument("--max-p95-ms", type=float, help="exit with status 1 if any endpoint's p95 is above this")
+    args = parser.parse_args()
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        report = asyncio.run(run(args))
+
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    if args.max_p95_ms is not None:
+        slow = [endpoint for endpoint, row in report["endpoints"].items() if row["p95_ms"] > args.max_p95_ms]
+        if slow or report["errors"]:
+            print("FAILED: p95 above {} ms for {}; errors {}".format(args.max_p95_ms, ", ".join(slow) or "none", report["errors"]))
+            sys.exit(1)
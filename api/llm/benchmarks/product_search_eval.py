@@ -0,0 +1,216 @@
+"""
+Offline evaluation of the ProductSearch routes (`productSearchRoute`, `productSearchModel`):
+questions derived from AnyBankProductCatalog.csv are answered by the knowledge base in each
+configuration, and the configurations are compared on latency, model tokens, the tokens
+handed to the agent, and how well the answers agree.
+
+The questions are catalog lines that state a figure (an amount, a rate, a count) with the
+figure blanked out and the product in front, e.g. "Checking accounts: For an annual fee of
+___, customers will receive". An answer recalls the fact when it contains the figure, and
+agrees with the baseline (synthesis with the agent's model, the service's default) by its
+word overlap (F1) with the baseline's answer to the same question.
+
+Retrieval uses the local catalog index with a hashing embedder, so neither Kendra nor
+sentence-transformers is needed, and every configuration sees the same passages. The
+models are `fakes.ExtractiveBedrock` with rough latency profiles of a large and a small
+Claude model; with --live they are called on Bedrock, using the environment's AWS
+credentials, so the agreement figures are real.
+
+Usage (from api/llm):
+    PYTHONPATH=app python benchmarks/product_search_eval.py --questions-per-product 3
+"""
+import argparse
+import csv
+import functools
+import io
+import json
+import os
+import random
+import re
+import statistics
+import sys
+import tempfile
+import time
+import zlib
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+import numpy as np
+
+from penny.catalog_index import CatalogIndex, LocalCatalogRetriever
+from penny.history import estimate_tokens
+from penny.knowledge_base import FILLER_WORDS, KnowledgeBase, normalize_question
+from penny.tools import setup_knowledge_base
+
+from fakes import ExtractiveBedrock
+
+CATALOG = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "..", "infra", "data", "AnyBankProductCatalog.csv")
+LARGE_MODEL = "anthropic.claude-3-5-sonnet-20240620-v1:0"
+SMALL_MODEL = "anthropic.claude-3-haiku-20240307-v1:0"
+# time to first token and per output token, roughly as a large and a small Claude model on Bedrock
+PROFILES = {
+    LARGE_MODEL: dict(first_token_seconds=0.8, seconds_per_input_token=0.00005, seconds_per_output_token=0.015),
+    SMALL_MODEL: dict(first_token_seconds=0.3, seconds_per_input_token=0.00002, seconds_per_output_token=0.005),
+}
+# amounts and rates first, then other numbers
+FIGURES = (re.compile(r"\$\d[\d,]*(?:\.\d+)?|\d+(?:\.\d+)?%"), re.compile(r"\b\d+(?:\.\d+)?\b"))
+
+csv.field_size_limit(sys.maxsize)
+
+
+def derive_questions(csv_path, per_product, seed):
+    """(product, question, expected figure) for up to `per_product` figures of each product."""
+    rng = random.Random(seed)
+    questions = []
+    with open(csv_path, newline="", encoding="utf-8") as catalog:
+        for row in csv.DictReader(catalog):
+            product = row["product"].strip()
+            candidates = []
+            for line in row["product information"].splitlines():
+                line = line.strip(" -\t")
+                if not 30 <= len(line) <= 200:
+                    continue
+                match = FIGURES[0].search(line) or FIGURES[1].search(line)
+                if match:
+                    candidates.append((product, "{}: {}___{}".format(product, line[:match.start()], line[match.end():]), match.group(0)))
+            questions += rng.sample(candidates, min(per_product, len(candidates)))
+    return questions
+
+
+def hashing_embedder(dimension=4096):
+    """Bag-of-words vectors hashed into `dimension` buckets; enough to find a product's passages."""
+    def embed(texts):
+        matrix = np.zeros((len(texts), dimension), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for word in re.findall(r"[a-z0-9$%]+", text.lower()):
+                if word not in FILLER_WORDS:
+                    matrix[row, zlib.crc32(word.encode()) % dimension] += 1
+        return matrix / np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-9)
+    embed.model_name = "hashing-{}".format(dimension)
+    return embed
+
+
+class UsageMeter:
+    """Counts the calls and the input and output tokens Bedrock reports for a client."""
+
+    def __init__(self, client):
+        self.client = client
+        self.calls = 0
+        self.input_tokens = 0
+        self.output_tokens = 0
+
+    def invoke_model(self, **kwargs):
+        response = self.client.invoke_model(**kwargs)
+        body = response["body"].read()
+        usage = json.loads(body).get("usage", {})
+        self.calls += 1
+        self.input_tokens += usage.get("input_tokens", 0)
+        self.output_tokens += usage.get("output_tokens", 0)
+        return dict(response, body=io.BytesIO(body))
+
+
+def normalize_figure(text):
+    return text.replace(",", "").replace(" ", "").lower()
+
+
+def word_f1(answer, reference):
+    answer_words, reference_words = normalize_question(answer).split(), normalize_question(reference).split()
+    common = len(set(answer_words) & set(reference_words))
+    if not common:
+        return 0.0
+    precision, recall = common / len(set(answer_words)), common / len(set(reference_words))
+    return 2 * precision * recall / (precision + recall)
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def client_for(model_id, live):
+    if live:
+        from penny.resilience import get_bedrock_client
+
+        return UsageMeter(get_bedrock_client())
+    return UsageMeter(ExtractiveBedrock(**PROFILES.get(model_id, PROFILES[SMALL_MODEL])))
+
+
+def evaluate(route, model_id, questions, retriever, args):
+    client = client_for(model_id or LARGE_MODEL, args.live)
+    knowledge_base = KnowledgeBase(
+        functools.partial(setup_knowledge_base, model_id=model_id or LARGE_MODEL, client=client, retriever=retriever),
+        route=route,
+        passage_token_budget=args.passage_tokens,
+    )
+    answers, latencies = [], []
+    for _, question, _ in questions:
+        started = time.perf_counter()
+        answers.append(knowledge_base.run(question))
+        latencies.append(time.perf_counter() - started)
+    return answers, latencies, client, knowledge_base
+
+
+def run(args):
+    questions = derive_questions(args.catalog, args.questions_per_product, args.seed)
+    with tempfile.TemporaryDirectory() as index_dir:
+        index = CatalogIndex.build(args.catalog, index_dir, hashing_embedder())
+        retriever = LocalCatalogRetriever(index=index, k=args.top_k)
+        configurations = [
+            ("synthesize", args.large_model),
+            ("synthesize", args.small_model),
+            ("passages", None),
+            ("auto", args.small_model),
+        ]
+        report = []
+        baseline = None
+        for route, model_id in configurations:
+            answers, latencies, client, knowledge_base = evaluate(route, model_id, questions, retriever, args)
+            baseline = baseline or answers
+            recalled = [normalize_figure(expected) in normalize_figure(answer) for answer, (_, _, expected) in zip(answers, questions)]
+            report.append({
+                "route": route,
+                "model": model_id or "-",
+                "questions": len(questions),
+                "fact_recall": round(sum(recalled) / len(questions), 3),
+                "agreement_f1": round(statistics.mean(word_f1(answer, reference) for answer, reference in zip(answers, baseline)), 3),
+                "p50_ms": round(statistics.median(latencies) * 1000),
+                "p95_ms": round(percentile(latencies, 0.95) * 1000),
+                "model_calls": client.calls,
+                "model_input_tokens": round(client.input_tokens / len(questions)),
+                "model_output_tokens": round(client.output_tokens / len(questions)),
+                "agent_tokens": round(statistics.mean(estimate_tokens(answer) for answer in answers)),
+                "answered_from": knowledge_base.stats()["answered_from"],
+            })
+    return report
+
+
+def print_report(report):
+    print("  {:<10} {:<42} {:>6} {:>9} {:>6} {:>7} {:>7} {:>6} {:>9} {:>10} {:>9}".format(
+        "route", "model", "recall", "agreement", "p50 ms", "p95 ms", "calls", "in tok", "out tok", "agent tok", "passages"))
+    for row in report:
+        print("  {route:<10} {model:<42} {fact_recall:>6} {agreement_f1:>9} {p50_ms:>6} {p95_ms:>7} {model_calls:>7} "
+              "{model_input_tokens:>6} {model_output_tokens:>9} {agent_tokens:>10} {passages:>9}".format(
+                  passages=row["answered_from"]["passages"], **row))
+    print("  recall: answers containing the catalog figure; agreement: word F1 with the first row's answers; "
+          "tokens are per question, agent tok is what ProductSearch hands to the agent")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--catalog", default=CATALOG)
+    parser.add_argument("--questions-per-product", type=int, default=3)
+    parser.add_argument("--top-k", type=int, default=int(os.environ.get("retrieverTopK", 4)), help="passages retrieved per question")
+    parser.add_argument("--passage-tokens", type=int, default=int(os.environ.get("productSearchPassageTokens", 600)),
+                        help="passages up to this size go to the agent as they are with the auto route")
+    parser.add_argument("--large-model", default=LARGE_MODEL)
+    parser.add_argument("--small-model", default=SMALL_MODEL)
+    parser.add_argument("--live", action="store_true", help="call the models on Bedrock instead of the stand-ins")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--json", help="also write the report to this file")
+    args = parser.parse_args()
+
+    report = run(args)
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
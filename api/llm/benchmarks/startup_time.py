@@ -0,0 +1,92 @@
+"""
+Startup time of the LLM service: how long `import main` takes in a fresh interpreter, how
+long building the agent, session registry and AWS clients takes after it, and which
+packages the import time is spent in (from `python -X importtime`).
+
+Each run is a separate process, so nothing is imported or built yet; the medians over the
+runs are reported. No AWS call is made: building only creates the boto3 clients.
+
+Usage (from api/llm):
+    PYTHONPATH=app:../lambdas python benchmarks/startup_time.py --runs 5
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+from collections import defaultdict
+
+ENVIRONMENT = {
+    "AWS_DEFAULT_REGION": "us-east-1",
+    "apiEndpoint": "http://localhost",
+    "kendraIndexId": "benchmark",
+    "idBucketName": "benchmark",
+}
+
+PROBE = """
+import json, time
+started = time.perf_counter()
+import main
+imported = time.perf_counter()
+main.build_service()
+built = time.perf_counter()
+print(json.dumps({"import_s": imported - started, "build_s": built - imported}))
+"""
+
+
+def parse_importtime(stderr):
+    """Import time in seconds spent in each top-level package's own modules."""
+    totals = defaultdict(float)
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, _, name = line[len("import time:"):].split("|")
+        totals[name.strip().split(".")[0]] += int(self_us) / 1e6
+    return totals
+
+
+def run_once():
+    env = dict(os.environ)
+    for name, value in ENVIRONMENT.items():
+        env.setdefault(name, value)
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", PROBE], env=env, capture_output=True, text=True, check=True
+    )
+    timings = json.loads(completed.stdout.strip().splitlines()[-1])
+    return timings, parse_importtime(completed.stderr)
+
+
+def run(runs, top):
+    timings = defaultdict(list)
+    packages = defaultdict(list)
+    for _ in range(runs):
+        result, imported = run_once()
+        for name, seconds in result.items():
+            timings[name].append(seconds)
+        for package, seconds in imported.items():
+            packages[package].append(seconds)
+    slowest = sorted(packages.items(), key=lambda item: statistics.median(item[1]), reverse=True)[:top]
+    return {
+        "runs": runs,
+        "import_ms": round(statistics.median(timings["import_s"]) * 1000, 1),
+        "build_ms": round(statistics.median(timings["build_s"]) * 1000, 1),
+        "packages_ms": {package: round(statistics.median(values) * 1000, 1) for package, values in slowest},
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=10, help="number of packages to list")
+    parser.add_argument("--json", help="also write the report to this file")
+    args = parser.parse_args()
+
+    report = run(args.runs, args.top)
+    print("import main: {import_ms} ms, building the agent and clients: {build_ms} ms (median of {runs} runs)".format(**report))
+    print("slowest imports:")
+    for package, ms in report["packages_ms"].items():
+        print("  {:<28} {:>8} ms".format(package, ms))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
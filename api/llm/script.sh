@@ -10,7 +10,11 @@ aws ecr create-repository --repository-name ${IMAGE}
 
 aws ecr get-login-password --region $AWS_REGION | docker login --username AWS --password-stdin $AWS_ACCOUNT.dkr.ecr.$AWS_REGION.amazonaws.com
 
-docker build --no-cache -t $IMAGE:latest . 
+# the product catalog searched by retrieverBackend=local
+mkdir -p data && cp ../../infra/data/AnyBankProductCatalog.csv data/
+
+# build from api/ so the image can include the onboarding library shared with the Lambda functions
+docker build --no-cache --build-arg LOCAL_RETRIEVER=${LOCAL_RETRIEVER:-false} -t $IMAGE:latest -f Dockerfile .. 
 
 TAG=$(date +%Y%m%d_%H%M%S)
 
@@ -15,14 +15,20 @@ import * as s3deploy from 'aws-cdk-lib/aws-s3-deployment';
 import * as elbv2 from 'aws-cdk-lib/aws-elasticloadbalancingv2';
 import * as cloudfront from 'aws-cdk-lib/aws-cloudfront';
 import * as origins from 'aws-cdk-lib/aws-cloudfront-origins';
+import * as sqs from 'aws-cdk-lib/aws-sqs';
+import { SqsEventSource } from 'aws-cdk-lib/aws-lambda-event-sources';
 
 
 export class PennyInfraStack extends cdk.Stack {
   private customerTable: dynamodb.Table
+  private sessionTable: dynamodb.Table
   private verifyIdLambda: lambda.Function
   private verifyFaceLambda: lambda.Function
   private getAccountLambda: lambda.Function
+  private getAccountsLambda: lambda.Function
   private createAccountLambda: lambda.Function
+  private sendWelcomeEmailLambda: lambda.Function
+  private welcomeEmailQueue: sqs.Queue
   private api: apigateway.RestApi
   private idBucket: s3.Bucket
   private catalogBucket: s3.Bucket
@@ -40,12 +46,16 @@ export class PennyInfraStack extends cdk.Stack {
     this.createParameters()
 
     this.createCustomerTable()
+    this.createSessionTable()
     this.createIDsBucket()
+    this.createWelcomeEmailQueue()
 
     this.createLambda_verifyId()
     this.createLambda_verifyFace()
     this.createLambda_getAccount()
+    this.createLambda_getAccounts()
     this.createLambda_createAccount()
+    this.createLambda_sendWelcomeEmail()
     
     this.createApi()
     this.createSesIdentities()
@@ -82,10 +92,20 @@ export class PennyInfraStack extends cdk.Stack {
 
   }
 
+  // conversation state of the LLM service, so any task can serve any turn
+  createSessionTable = () => {
+    this.sessionTable = new dynamodb.Table(this, 'SessionTable', {
+      partitionKey: { name: 'sessionId', type: dynamodb.AttributeType.STRING },
+      billingMode: dynamodb.BillingMode.PAY_PER_REQUEST,
+      timeToLiveAttribute: 'expiresAt',
+      removalPolicy: RemovalPolicy.DESTROY,
+    })
+  }
+
   createLambda_verifyId = () => {
     this.verifyIdLambda = new lambda.Function(this, 'VerifyId', {
       runtime: lambda.Runtime.PYTHON_3_11,
-      code: lambda.Code.fromAsset('../api/lambdas'),
+      code: lambda.Code.fromAsset('../api/lambdas', { exclude: ['benchmarks', 'test'] }),
       handler: 'verify-id.main',
       timeout: Duration.seconds(10),
       environment: {
@@ -104,7 +124,14 @@ export class PennyInfraStack extends cdk.Stack {
   createLambda_verifyFace = () => {
     this.verifyFaceLambda = new lambda.Function(this, 'VerifyFace', {
       runtime: lambda.Runtime.PYTHON_3_11,
-      code: lambda.Code.fromAsset('../api/lambdas'),
+      // bundles Pillow (api/lambdas/requirements.txt), used to crop the ID face
+      code: lambda.Code.fromAsset('../api/lambdas', {
+        exclude: ['benchmarks', 'test'],
+        bundling: {
+          image: lambda.Runtime.PYTHON_3_11.bundlingImage,
+          command: ['bash', '-c', 'pip install -r requirements.txt -t /asset-output && cp -au . /asset-output'],
+        },
+      }),
       handler: 'verify-face.main',
       timeout: Duration.seconds(10),
       environment: {
@@ -126,7 +153,7 @@ export class PennyInfraStack extends cdk.Stack {
     this.verifyFaceLambda.addToRolePolicy(new iam.PolicyStatement(
       {
         effect: iam.Effect.ALLOW, 
-        actions: ['rekognition:CompareFaces'],
+        actions: ['rekognition:CompareFaces', 'rekognition:DetectFaces'],
         resources: [
           `*`,
         ]
@@ -137,7 +164,7 @@ export class PennyInfraStack extends cdk.Stack {
   createLambda_getAccount = () => {
     this.getAccountLambda = new lambda.Function(this, 'GetAccount', {
       runtime: lambda.Runtime.PYTHON_3_11,
-      code: lambda.Code.fromAsset('../api/lambdas'),
+      code: lambda.Code.fromAsset('../api/lambdas', { exclude: ['benchmarks', 'test'] }),
       handler: 'get-account.main',
       environment: {
         'tableName': this.customerTable.tableName,
@@ -153,14 +180,45 @@ export class PennyInfraStack extends cdk.Stack {
     )
   }
 
+  createLambda_getAccounts = () => {
+    this.getAccountsLambda = new lambda.Function(this, 'GetAccounts', {
+      runtime: lambda.Runtime.PYTHON_3_11,
+      code: lambda.Code.fromAsset('../api/lambdas', { exclude: ['benchmarks', 'test'] }),
+      handler: 'get-accounts.main',
+      timeout: Duration.seconds(30),
+      environment: {
+        'tableName': this.customerTable.tableName,
+      }
+    })
+
+    this.getAccountsLambda.addToRolePolicy(new iam.PolicyStatement(
+      {
+        effect: iam.Effect.ALLOW, 
+        actions: ['dynamodb:BatchGetItem'],
+        resources: [this.customerTable.tableArn]
+      }),
+    )
+  }
+
+  createWelcomeEmailQueue = () => {
+    const deadLetterQueue = new sqs.Queue(this, 'WelcomeEmailDLQ', {
+      retentionPeriod: Duration.days(14),
+    })
+
+    this.welcomeEmailQueue = new sqs.Queue(this, 'WelcomeEmailQueue', {
+      visibilityTimeout: Duration.seconds(60),
+      deadLetterQueue: { queue: deadLetterQueue, maxReceiveCount: 5 },
+    })
+  }
+
   createLambda_createAccount = () => {
     this.createAccountLambda = new lambda.Function(this, 'CreateAccount', {
       runtime: lambda.Runtime.PYTHON_3_11,
-      code: lambda.Code.fromAsset('../api/lambdas'),
+      code: lambda.Code.fromAsset('../api/lambdas', { exclude: ['benchmarks', 'test'] }),
       handler: 'create-account.main',
       environment: {
         'tableName': this.customerTable.tableName,
-        'sesIdentityEmail': this.sesBankEmail.valueAsString
+        'welcomeQueueUrl': this.welcomeEmailQueue.queueUrl
       }
     })
 
@@ -172,7 +230,36 @@ export class PennyInfraStack extends cdk.Stack {
       }),
     )
 
-    this.createAccountLambda.addToRolePolicy(new iam.PolicyStatement(
+    this.welcomeEmailQueue.grantSendMessages(this.createAccountLambda)
+  }
+
+  createLambda_sendWelcomeEmail = () => {
+    this.sendWelcomeEmailLambda = new lambda.Function(this, 'SendWelcomeEmail', {
+      runtime: lambda.Runtime.PYTHON_3_11,
+      code: lambda.Code.fromAsset('../api/lambdas', { exclude: ['benchmarks', 'test'] }),
+      handler: 'send-welcome-email.main',
+      timeout: Duration.seconds(30),
+      environment: {
+        'tableName': this.customerTable.tableName,
+        'sesIdentityEmail': this.sesBankEmail.valueAsString
+      }
+    })
+
+    this.sendWelcomeEmailLambda.addEventSource(new SqsEventSource(this.welcomeEmailQueue, {
+      batchSize: 10,
+      maxBatchingWindow: Duration.seconds(5),
+      reportBatchItemFailures: true,
+    }))
+
+    this.sendWelcomeEmailLambda.addToRolePolicy(new iam.PolicyStatement(
+      {
+        effect: iam.Effect.ALLOW, 
+        actions: ['dynamodb:GetItem', 'dynamodb:UpdateItem'],
+        resources: [this.customerTable.tableArn]
+      }),
+    )
+
+    this.sendWelcomeEmailLambda.addToRolePolicy(new iam.PolicyStatement(
       {
         effect: iam.Effect.ALLOW, 
         actions: ['ses:SendEmail', 'ses:SendRawEmail'],
@@ -257,6 +344,23 @@ export class PennyInfraStack extends cdk.Stack {
       }),
       {methodResponses: [this.methodResponse]}
     )
+
+    // back-office bulk existence checks: POST {"emails": [...]}
+    // only callers signing with IAM credentials allowed to execute-api:Invoke it may enumerate accounts
+    const accountBatch = account.addResource('batch', {
+      defaultCorsPreflightOptions: this.defaultCorsPreflightOptions,
+    })
+
+    accountBatch.addMethod('POST', new apigateway.LambdaIntegration(this.getAccountsLambda, {
+        proxy: false,
+        integrationResponses: [this.integrationResponse],
+        passthroughBehavior: apigateway.PassthroughBehavior.WHEN_NO_TEMPLATES,
+      }),
+      {
+        methodResponses: [this.methodResponse],
+        authorizationType: apigateway.AuthorizationType.IAM,
+      }
+    )
   }
 
 
@@ -417,7 +521,13 @@ export class PennyInfraStack extends cdk.Stack {
     taskDefinition.addToTaskRolePolicy(new iam.PolicyStatement({
       effect: iam.Effect.ALLOW,
       resources: [`${this.idBucket.bucketArn}/*`],
-      actions: ['s3:PutObject']
+      actions: ['s3:PutObject', 's3:GetObject', 's3:AbortMultipartUpload']
+    }));
+
+    taskDefinition.addToTaskRolePolicy(new iam.PolicyStatement({
+      effect: iam.Effect.ALLOW,
+      resources: [this.idBucket.bucketArn],
+      actions: ['s3:ListBucket']
     }));
 
     taskDefinition.addToTaskRolePolicy(new iam.PolicyStatement({
@@ -426,6 +536,27 @@ export class PennyInfraStack extends cdk.Stack {
       actions: ['kendra:Retrieve']
     }));
 
+    // used when the tools run the onboarding library in-process (toolBackend=local)
+    taskDefinition.addToTaskRolePolicy(new iam.PolicyStatement({
+      effect: iam.Effect.ALLOW,
+      resources: ['*'],
+      actions: ['textract:AnalyzeID', 'rekognition:CompareFaces', 'rekognition:DetectFaces']
+    }));
+
+    taskDefinition.addToTaskRolePolicy(new iam.PolicyStatement({
+      effect: iam.Effect.ALLOW,
+      resources: [this.customerTable.tableArn],
+      actions: ['dynamodb:GetItem', 'dynamodb:PutItem']
+    }));
+
+    taskDefinition.addToTaskRolePolicy(new iam.PolicyStatement({
+      effect: iam.Effect.ALLOW,
+      resources: [this.sessionTable.tableArn],
+      actions: ['dynamodb:GetItem', 'dynamodb:PutItem', 'dynamodb:DeleteItem']
+    }));
+
+    this.welcomeEmailQueue.grantSendMessages(taskDefinition.taskRole)
+
     const container = taskDefinition.addContainer("LLMContainer", {
       image: ecs.ContainerImage.fromEcrRepository(
         ecr.Repository.fromRepositoryName(this, 'EcrRepo', "penny-workshop"),
@@ -435,10 +566,17 @@ export class PennyInfraStack extends cdk.Stack {
       environment: {
         'apiEndpoint': this.api.url,
         'kendraIndexId': this.kendraIndex.attrId,
-        'idBucketName': this.idBucket.bucketName
+        'idBucketName': this.idBucket.bucketName,
+        'customerTableName': this.customerTable.tableName,
+        'welcomeQueueUrl': this.welcomeEmailQueue.queueUrl,
+        'sessionStore': 'dynamodb',
+        'sessionTableName': this.sessionTable.tableName,
+        'drainSeconds': '30'
       },
       containerName: 'LLMContainer',
-      cpu: 1024
+      cpu: 1024,
+      // room for the workers to finish their turns (drainSeconds) before being killed
+      stopTimeout: cdk.Duration.seconds(45)
     })
     
     container.addPortMappings({
@@ -470,9 +608,11 @@ export class PennyInfraStack extends cdk.Stack {
       port: 80,
       targets: [this.llmService],
       healthCheck: {
-        path: '/',
+        path: '/ready',
         interval: cdk.Duration.seconds(60),
       },
+      // stop sending new turns to a task being replaced; turns already running finish
+      deregistrationDelay: cdk.Duration.seconds(30),
     })
 
     const corsHeadersPolicy = new cloudfront.ResponseHeadersPolicy(this, 'CorsHeadersPolicy', {
@@ -482,6 +622,7 @@ export class PennyInfraStack extends cdk.Stack {
         accessControlAllowMethods: ['GET', 'HEAD', 'OPTIONS', 'PUT', 'POST', 'PATCH', 'DELETE'],
         accessControlAllowHeaders: ['*'],
         accessControlAllowCredentials: false,
+        accessControlExposeHeaders: ['Retry-After'],
         originOverride: true,
       },
     });
@@ -15,7 +15,8 @@ class App extends React.Component {
     super(props);
 
     this.state = {
-      chats: []
+      chats: [],
+      sessionId: null
     }
   }
   componentDidMount() {
@@ -25,7 +26,10 @@ class App extends React.Component {
 
     fetch(LLM_API_ENDPOINT, request)
     .then(response => response.json())
-    .then(data => console.log("GET Agent Call successful"))
+    .then(data => {
+      console.log("GET Agent Call successful")
+      this.setState({sessionId: data.session_id})
+    })
     .catch(error => console.log('Error:', error));
   }
 
@@ -42,6 +46,7 @@ class App extends React.Component {
       <div className="App">
         <ChatPopup
           llmApiEndpoint={LLM_API_ENDPOINT}
+          sessionId={this.state.sessionId}
           chats={this.state.chats}
           handleAddChat={this.handleAddChat}
         />
@@ -19,6 +19,7 @@ class ChatPopup extends React.Component  {
                 >
                     <ChatPopupBody 
                         llmApiEndpoint={this.props.llmApiEndpoint}
+                        sessionId={this.props.sessionId}
                         chats={this.props.chats}
                         handleAddChat={this.props.handleAddChat}
                     />
@@ -73,8 +73,9 @@ class ChatPopupBody extends React.Component  {
             const request = {
                 method: 'POST',
                 headers: { 
-                    'Accept': 'application/json',
+                    'Accept': 'text/event-stream',
                     'Content-Type': 'application/json',
+                    'X-Session-Id': this.props.sessionId,
                 },
                 body: requestBody
             };
@@ -88,29 +89,88 @@ class ChatPopupBody extends React.Component  {
                 chats: [...prevState.chats, waitPennyChat],
                 inputValue: '',
         }));
-        fetch(this.props.llmApiEndpoint + 'question', request)
-        .then(response => response.json())
-        .then(data => {
-                console.log("POST Agent Call successful: " + JSON.stringify(data.message))
-
-                let newPennyChat = {
-                    user: 'Penny',
-                    message: data.message,
+        let streamed = ''
+        this.fetchRetrying(this.props.llmApiEndpoint + 'questionStream', request)
+        .then(response => this.readEventStream(response, (event, data) => {
+                if (event === 'token') {
+                    // render partial tokens in place of "Penny is typing..."
+                    streamed += data.token
+                    this.replaceLastPennyChat(streamed)
+                }
+                else if (event === 'done') {
+                    console.log("POST Agent Call successful: " + JSON.stringify(data.message))
+                    let newPennyChat = this.replaceLastPennyChat(data.message)
+                    this.props.handleAddChat(newPennyChat)
+                }
+                else if (event === 'error') {
+                    console.log('Error:', data.detail)
                 }
+            }))
+        .catch(error => console.log('Error:', error));
+            
+    }
 
-                let chats = [...this.state.chats];
-                chats.pop();
-                chats.push(newPennyChat);
+    fetchRetrying(url, request, retries = 3) {
+        // the service answers 429 with Retry-After when it is at capacity; send the turn again then
+        return fetch(url, request).then(response => {
+            if (response.status === 429 && retries > 0) {
+                const seconds = parseInt(response.headers.get('Retry-After'), 10) || 1
+                return new Promise(resolve => setTimeout(resolve, seconds * 1000))
+                    .then(() => this.fetchRetrying(url, request, retries - 1))
+            }
+            return response
+        })
+    }
 
-                this.setState({
-                    chats: chats,
-                    inputValue: '',
+    replaceLastPennyChat(message) {
+        let newPennyChat = {
+            user: 'Penny',
+            message: message,
+        }
+
+        this.setState(prevState => {
+            let chats = [...prevState.chats];
+            chats.pop();
+            chats.push(newPennyChat);
+            return {chats: chats};
+        });
+
+        return newPennyChat
+    }
+
+    async readEventStream(response, onEvent) {
+        // parse a text/event-stream body into (event, data) pairs as chunks arrive
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+
+        while (true) {
+            const { done, value } = await reader.read();
+            if (done) {
+                break;
+            }
+            buffer += decoder.decode(value, { stream: true });
+
+            let boundary = buffer.indexOf('\n\n');
+            while (boundary !== -1) {
+                const rawEvent = buffer.slice(0, boundary);
+                buffer = buffer.slice(boundary + 2);
+
+                let event = 'message';
+                let data = '';
+                rawEvent.split('\n').forEach(line => {
+                    if (line.startsWith('event: ')) {
+                        event = line.slice(7);
+                    }
+                    else if (line.startsWith('data: ')) {
+                        data += line.slice(6);
+                    }
                 });
+                onEvent(event, JSON.parse(data));
 
-                this.props.handleAddChat(newPennyChat)
-            })
-        .catch(error => console.log('Error:', error));
-            
+                boundary = buffer.indexOf('\n\n');
+            }
+        }
     }
 
     handleSelectFile(event) {
@@ -126,6 +186,7 @@ class ChatPopupBody extends React.Component  {
             method: 'POST',
             headers: { 
                 'Accept': 'application/json',
+                'X-Session-Id': this.props.sessionId,
             },
             body: formData
         };
@@ -146,7 +207,7 @@ class ChatPopupBody extends React.Component  {
             inputValue: '',
         }));
 
-        fetch(url, request)
+        this.fetchRetrying(url, request)
         .then(response => response.json())
         .then(data => {
             console.log("data" + JSON.stringify(data))